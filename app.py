@@ -13,12 +13,15 @@ import sqlite3
 from config import get_config, app_paths # app_paths here is likely an AppPaths instance from config.py
 
 # Models and utilities
-from models import db, User, BackupRecord, CustomerService
+from models import db, User, BackupRecord, CustomerService, DatabaseManager
 # Note: You have DatabaseBackup and GPGBackup imported globally here,
 # and also imported within create_app and from utils.
 # It's better to import them where they are used (e.g., within create_app or blueprints).
 # For now, keeping your imports as is, but noting potential redundancy.
 from backup import DatabaseBackup
+from backup_jobs import BackupJobManager
+from backup_wal import WalArchiver
+from backup_scheduler import BackupScheduler
 from backup_gpg import GPGBackup # This is likely a different GPGBackup than utils.gpg_backup
 from flask_login import LoginManager    
 #from blueprints.gpg import gpg_bp  # Import your GPG blueprint
@@ -96,6 +99,7 @@ def create_app(config_name=None):
     # Create tables within app context
     with app.app_context():
         db.create_all()
+        DatabaseManager.ensure_schema() # Columns added since the tables were created
         app.logger.info(f"Database initialized at: {app.config['APP_PATHS'].database_file}") # Use app.config['APP_PATHS']
 
     # Setup security headers (pass app.config here)
@@ -113,8 +117,31 @@ def create_app(config_name=None):
 
     # --- NEW: Store managers in app.extensions for easy access in blueprints/routes ---
     app.extensions['backup_manager'] = backup_manager
+    # Lets retention remove the BackupRecord rows of the backups it deletes
+    backup_manager.retention.app = app
+    # ...and verify-all record its results on them
+    backup_manager.verifier.app = app
+
+    def release_database_connections():
+        with app.app_context():
+            db.engine.dispose()
+    # Restores swap the database file; pooled connections to the old file are closed around the swap
+    backup_manager.release_connections = release_database_connections
     app.extensions['gpg_backup'] = gpg_backup_from_backup_gpg # Your original GPGBackup
+    # Encrypted backups and their restores stream through it
+    backup_manager.gpg = gpg_backup_from_backup_gpg
     app.extensions['utility_gpg_backup'] = utility_gpg_backup_instance # The one from utils
+    # Backups run on a worker pool so /backup/create returns immediately
+    app.extensions['backup_jobs'] = BackupJobManager(app, backup_manager, utility_gpg_backup_instance)
+    # Continuous WAL shipping for point-in-time restore (switches the database to WAL mode)
+    if app.config.get('BACKUP_WAL_ARCHIVING_ENABLED'):
+        backup_manager.wal_archiver = WalArchiver(backup_manager)
+        backup_manager.wal_archiver.start()
+        app.extensions['wal_archiver'] = backup_manager.wal_archiver
+    # Periodic backups and retention cleanup; one worker process runs them (see BackupScheduler)
+    if app.config.get('AUTO_BACKUP_ENABLED') and not app.config.get('TESTING'):
+        app.extensions['backup_scheduler'] = BackupScheduler(app, backup_manager, app.extensions['backup_jobs'])
+        app.extensions['backup_scheduler'].start()
     # app.extensions['db'] = db # You might also store db here if needed, but db.session is usually enough
 
 
@@ -3,22 +3,113 @@ Database Backup System with Pathlib Integration
 Handles SQLite database backups with proper path management
 """
 
+import os
 import sqlite3
 import shutil
 import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
-import gzip
+from typing import List, Optional, Dict, Any, Callable, Tuple, Set
 import json
+import hashlib
+
+from backup_compression import (Codec, CompressionTuner, ChecksumFile, get_codec, codec_for_format, codec_for_path,
+                                parse_level, file_checksum, default_compression_threads, DEFAULT_BLOCK_SIZE, AUTO_LEVEL,
+                                CHECKSUM_ALGORITHM)
+from backup_dedup import ChunkStore, ContentDefinedChunker, MANIFEST_SUFFIX
+from backup_differential import (PageHasher, DIFFERENTIAL_TYPE, DIFF_SUFFIX, PAGE_HASH_SUFFIX, is_differential,
+                                 page_hash_path, read_page_hashes, write_differential, read_differential_header,
+                                 apply_differential)
+from backup_lock import BackupCoordinator
+from backup_catalog import BackupCatalog, ENCRYPTED_SUFFIX, ENCRYPTED_SUFFIXES
+from backup_gpg import GPGBackup
+from backup_wal import recovery_window, restore_to_time, prune_generations
+from backup_retention import RetentionPolicy, RetentionExecutor, plan_retention, format_plan
+from backup_verify import BackupVerifier
+from backup_container import (ContainerWriter, ContainerReader, read_container_header, CONTAINER_SUFFIX,
+                              CONTAINER_FORMAT)
+from utils.encryption import EnvelopeEncryption, ENGINE_NAME as ENVELOPE_ENGINE, ENVELOPE_SUFFIX
 
 # We don't need app_paths or get_config here if the config object is always passed in __init__
 # from config import app_paths, get_config
 
+# Files SQLite keeps next to a database; a restored file must not inherit the old file's
+SQLITE_SIDE_FILES = ('-wal', '-shm', '-journal')
+
+
+class _SnapshotReader:
+    """File-like reader over the pages of a read-locked database snapshot"""
+
+    def __init__(self, fd: int, page_size: int, page_count: int, connection: Optional[sqlite3.Connection] = None):
+        self.fd = fd
+        self.page_size = page_size
+        self.page_count = page_count
+        self.connection = connection # Holds the read transaction; queries on it see the same pages
+        self.size = page_size * page_count
+        self.position = 0
+
+    def read(self, n: int = -1) -> bytes:
+        remaining = self.size - self.position
+        if n is None or n < 0 or n > remaining:
+            n = remaining
+        if n <= 0:
+            return b''
+        # pread keeps the shared descriptor's offset untouched, so several
+        # snapshots can read through it concurrently
+        data = os.pread(self.fd, n, self.position)
+        if not data:
+            raise IOError(f"Short read from database snapshot at offset {self.position}")
+        self.position += len(data)
+        return data
+
+
+class _TimedReader:
+    """Pass-through reader that counts the bytes and the time spent waiting on its source"""
+
+    def __init__(self, source):
+        self.source = source
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def read(self, n: int = -1) -> bytes:
+        started = time.monotonic()
+        data = self.source.read(n)
+        self.seconds += time.monotonic() - started
+        self.bytes += len(data)
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        pass # The source belongs to whoever opened it
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
 
 class DatabaseBackup:
     """Database backup manager using pathlib"""
 
+    # How often to retry draining the WAL before giving up on a streaming snapshot
+    SNAPSHOT_ATTEMPTS = 3
+
+    # Backups that must reflect the database at the moment they are requested
+    UNCOALESCED_TYPES = ('pre_restore',)
+
+    # Database header bytes every commit may rewrite (change counter, page count, freelist,
+    # version-valid-for and library version), blanked when fingerprinting page 1
+    VOLATILE_HEADER_FIELDS = ((24, 40), (92, 100))
+
+    # Encryption engines for create_backup's encrypt_to, with the suffix each one's output gets
+    ENCRYPTION_ENGINES = {'gpg': ENCRYPTED_SUFFIX, ENVELOPE_ENGINE: ENVELOPE_SUFFIX}
+
     def __init__(self, config=None):
         """
         Initialize backup manager.
@@ -40,6 +131,66 @@ class DatabaseBackup:
         self.app_paths.log_dir.mkdir(parents=True, exist_ok=True)
         self.app_paths.temp_dir.mkdir(parents=True, exist_ok=True) # Ensure temp_dir also exists
 
+        # Long-lived descriptor used by streaming snapshots (see _get_snapshot_fd)
+        self._snapshot_fd = None
+        self._snapshot_fd_lock = threading.Lock()
+
+        # Ratio/throughput history used by the 'auto' compression level
+        self.compression_tuner = CompressionTuner(
+            self.app_paths.backup_dir / 'compression_history.json',
+            target_seconds=float(self.config.get('BACKUP_AUTO_TARGET_SECONDS', 60)),
+            target_mb_s=float(self.config.get('BACKUP_AUTO_TARGET_MB_S', 0)),
+            sample_chunks=int(self.config.get('BACKUP_AUTO_SAMPLE_CHUNKS', 4)),
+            sample_size=int(self.config.get('BACKUP_COMPRESSION_BLOCK_SIZE', DEFAULT_BLOCK_SIZE)),
+            resample_hours=float(self.config.get('BACKUP_AUTO_RESAMPLE_HOURS', 24))
+        )
+
+        # Shared chunk store behind 'dedup' backups (manifests live next to the other backups)
+        self.chunk_store = ChunkStore(
+            self.app_paths.backup_dir / 'chunks',
+            ContentDefinedChunker(int(self.config.get('BACKUP_DEDUP_AVG_CHUNK_SIZE', 64 * 1024))),
+            gc_grace_seconds=float(self.config.get('BACKUP_DEDUP_GC_GRACE_SECONDS', 3600))
+        )
+
+        # Serializes (and coalesces) backups across worker processes sharing backup_dir
+        self.coordinator = BackupCoordinator(self.app_paths.backup_dir, self.logger,
+                                             float(self.config.get('BACKUP_LOCK_TIMEOUT_SECONDS', 3600)))
+
+        # Index of backup_dir behind list_backups/get_backup_stats
+        self.catalog = BackupCatalog(self.app_paths.backup_dir, self.logger)
+
+        # Deletes what retention plans drop, in background batches
+        self.retention = RetentionExecutor(self, int(self.config.get('BACKUP_RETENTION_BATCH_SIZE', 100)))
+
+        # Checks the whole backup set on a process pool (verify-all)
+        self.verifier = BackupVerifier(self)
+
+        # Checksums hashed while writing, by backup path, until _create_backup records them
+        self._written_checksums: Dict[str, str] = {}
+        # (engine, recipients) by backup path, for backups _open_backup_writer encrypts as it writes
+        self._encryption_recipients: Dict[str, Tuple[str, List[str]]] = {}
+
+        # The 'aes-gcm' encryption engine; its recipient keys live in encryption_keys_dir
+        self.envelope = EnvelopeEncryption(
+            self.app_paths.encryption_keys_dir,
+            passphrase=self.config.get('BACKUP_ENCRYPTION_KEY_PASSPHRASE'),
+            chunk_size=int(self.config.get('BACKUP_ENCRYPTION_CHUNK_SIZE', 1024 * 1024)),
+            workers=int(self.config.get('BACKUP_ENCRYPTION_WORKERS', 0)),
+            logger=self.logger
+        )
+
+        # Continuous WAL archiver (backup_wal.WalArchiver), attached by the app factory when enabled
+        self.wal_archiver = None
+
+        # Closes the app's pooled database connections around a restore, attached by the app factory
+        self.release_connections: Optional[Callable[[], None]] = None
+
+        # backup_gpg.GPGBackup streaming .gpg backups in and out, attached by the app factory (created on first use otherwise)
+        self.gpg = None
+        self.wal_archive_dir = self.app_paths.backup_dir / 'wal'
+        # (generation directories and their mtimes, window) from the last get_recovery_window
+        self._recovery_window_cache: Optional[Tuple[tuple, Optional[Dict[str, datetime]]]] = None
+
 
     def _setup_logging(self):
         """Setup logging for backup operations"""
@@ -62,28 +213,109 @@ class DatabaseBackup:
 
         return logger
 
-    def create_backup(self, format='zip', include_attachments=False, backup_type='manual', description='Manual backup', user_id=None) -> Optional[Path]:
+    def create_backup(self, format='zip', include_attachments=False, backup_type='manual', description='Manual backup', user_id=None,
+                      progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+                      codec: Optional[str] = None, level: Optional[int] = None, coalesce: bool = True,
+                      encrypt_to: Optional[str] = None, encryption_engine: Optional[str] = None,
+                      discard_output: bool = False) -> Optional[Path]:
         """
         Create a database backup based on the requested format and other options.
 
         Args:
-            format (str): The desired backup format ('zip', 'json', 'csv', 'gz').
-                          Currently, 'zip' and 'gz' will result in .gz compressed DBs.
+            format (str): The desired backup format ('zip', 'gz', 'bz2', 'xz', 'db', 'dedup', 'chunked',
+                          'json', 'csv'). 'zip' and 'gz' give gzip, 'bz2' bzip2, 'xz' lzma and
+                          'db' an uncompressed copy; 'dedup' writes a manifest into the shared
+                          chunk store; 'chunked' writes a seekable .bkc container (see
+                          backup_container) of independently compressed chunks; 'json' and
+                          'csv' fall back to the default codec.
             include_attachments (bool): Whether to include attachments (not implemented here yet).
-            backup_type (str): Type of backup (manual, pre_restore, etc.).
+            backup_type (str): Type of backup (manual, pre_restore, differential, etc.).
+                               'differential' stores only the pages changed since the last
+                               full backup; without a usable full backup it makes a full one.
             description (str): Description for the backup record.
             user_id (int): ID of the user creating the backup.
+            progress_callback (callable): Optional callable receiving progress event dicts
+                                          ({'stage': 'snapshot', 'fraction': ..., ...}).
+            codec (str): Codec name from the backup_compression registry; overrides 'format'.
+            level (int|str): Codec level (gzip/bz2 1-9, lzma 0-9) or 'auto' to pick one from
+                             sampled/recorded throughput (see _choose_auto_level); defaults to
+                             BACKUP_COMPRESSION_LEVEL or the codec's own default.
+            coalesce (bool): Return the result of an identical backup already running in any
+                             process sharing backup_dir instead of taking another snapshot.
+                             Pre-restore backups never coalesce.
+            encrypt_to (str): Recipient(s), comma separated; the compressed stream is encrypted
+                              as it is written, giving a single .gpg or .enc file (see
+                              _open_backup_writer). Not available for 'dedup' and differential backups.
+            encryption_engine (str): 'gpg' or 'aes-gcm' (utils.encryption); defaults to
+                                     BACKUP_ENCRYPTION_ENGINE. 'chunked' containers always
+                                     seal their chunks with aes-gcm.
+            discard_output (bool): The caller deletes the returned file once done with it (e.g.
+                                   after encrypting a copy). For an unchanged database
+                                   BACKUP_SKIP_UNCHANGED = 'skip' then links instead, so the
+                                   file returned is always this run's own name, and no
+                                   other caller is coalesced onto the run.
 
         Returns:
             Path to created backup file or None if failed.
         """
+        # Only one backup runs at a time across threads, processes and hosts sharing backup_dir
+        if encrypt_to:
+            try:
+                encryption_engine = self.resolve_encryption_engine(encryption_engine, format)
+            except ValueError as e:
+                self.logger.error(str(e))
+                return None
+        else:
+            encryption_engine = None
+        # A run whose output the caller deletes has its own key, so no other process coalesces onto it
+        key = json.dumps([format, codec, None if level is None else str(level), backup_type, include_attachments,
+                          encrypt_to, encryption_engine, discard_output])
         try:
-            # Determine compression based on the 'format' requested from the UI
-            compress = False # Default to no compression
-            if format.lower() == 'zip' or format.lower() == 'gz':
-                compress = True
+            return self.coordinator.run(
+                key,
+                lambda: self._create_backup(format, include_attachments, backup_type, progress_callback, codec, level,
+                                            encrypt_to, encryption_engine, discard_output),
+                coalesce=coalesce and backup_type not in self.UNCOALESCED_TYPES
+            )
+        except TimeoutError as e:
+            self.logger.error(f"Backup not started: {str(e)}")
+            return None
 
-            self.logger.debug(f"Starting backup creation. format='{format}', compress={compress}, include_attachments={include_attachments}")
+    def _create_backup(self, format, include_attachments, backup_type, progress_callback, codec, level,
+                       encrypt_to=None, encryption_engine=None, discard_output=False) -> Optional[Path]:
+        """Body of create_backup, run while holding the backup lock"""
+        backup_path = None
+        try:
+            if encrypt_to:
+                try:
+                    self.check_encryptable(format, backup_type)
+                except ValueError as e:
+                    self.logger.error(str(e))
+                    return None
+            # Determine the codec from an explicit name or the 'format' requested from the UI
+            backup_codec = self.resolve_codec(format, codec)
+            dedup = self.is_dedup_format(format)
+            if level is None:
+                level = self.config.get('BACKUP_COMPRESSION_LEVEL')
+            auto_level = parse_level(level) == AUTO_LEVEL and not dedup
+            if auto_level:
+                level, auto_details = self._choose_auto_level(backup_codec)
+            elif dedup and parse_level(level) == AUTO_LEVEL:
+                level = None # Chunks are compressed one by one; the tuner's estimates do not apply
+            level = backup_codec.resolve_level(parse_level(level))
+            compress = backup_codec.compresses
+
+            differential_base = None
+            if backup_type == DIFFERENTIAL_TYPE:
+                differential_base = self._find_differential_base()
+                if differential_base:
+                    dedup = False
+                else:
+                    self.logger.warning("No full backup with page hashes to diff against; creating a full backup instead")
+            container = self.is_container_format(format) and not differential_base
+
+            self.logger.debug(f"Starting backup creation. format='{format}', codec={backup_codec.name}, level={level}, "
+                              f"include_attachments={include_attachments}")
             # Use self.app_paths for database_file
             self.logger.debug(f"Database file: {self.app_paths.database_file}")
             # Use self.app_paths for backup_dir
@@ -100,26 +332,86 @@ class DatabaseBackup:
             self.logger.debug(f"Generated base backup name: {backup_name}")
 
             # Adjust filename for compression if needed
-            final_backup_name = backup_name
-            if compress:
-                final_backup_name += ".gz"
-                self.logger.debug("Compression enabled, updated backup name to .gz: %s", final_backup_name)
-            elif format.lower() == 'json':
-                 self.logger.warning(f"JSON format requested, but only SQLite DB backup is supported. Creating .db backup.")
-            elif format.lower() == 'csv':
-                 self.logger.warning(f"CSV format requested, but only SQLite DB backup is supported. Creating .db backup.")
+            final_backup_name = backup_name + self.backup_extension(format, backup_codec)
+            if differential_base:
+                final_backup_name = backup_name + DIFF_SUFFIX + backup_codec.extension
+                self.logger.debug("Differential backup against %s: %s", differential_base[0].name, final_backup_name)
+            elif dedup:
+                self.logger.debug("Deduplicated backup, writing manifest: %s", final_backup_name)
+            elif container:
+                self.logger.debug("Chunked container of %s chunks: %s", backup_codec.name, final_backup_name)
+            elif compress:
+                self.logger.debug("Compression enabled, updated backup name to %s: %s", backup_codec.extension, final_backup_name)
+            if encrypt_to and not container:
+                final_backup_name += self.ENCRYPTION_ENGINES[encryption_engine]
 
             # Construct final backup path using self.app_paths.backup_dir
             backup_path = self.app_paths.backup_dir / final_backup_name
+            suffix = final_backup_name[len(backup_name):]
+            sequence = 1
+            while backup_path.exists():
+                # Timestamps have one-second resolution; never overwrite a backup taken in the same second
+                sequence += 1
+                backup_name = self.app_paths.get_backup_filename(backup_type=backup_type, timestamp=f"{timestamp}_{sequence}")
+                backup_path = self.app_paths.backup_dir / (backup_name + suffix)
             self.logger.debug(f"Final backup path: {backup_path}")
 
+            # Nothing changed since the last backup of this kind: reuse it instead of copying again
+            # (never for encrypted backups: the previous one may be for another recipient)
+            fingerprint = None
+            if self.config.get('BACKUP_SKIP_UNCHANGED', 'link') != 'off' and not differential_base and not encrypt_to:
+                fingerprint = self._database_fingerprint()
+                previous = self._find_unchanged_backup(fingerprint, backup_path) if fingerprint else None
+                if previous:
+                    reused = self._reuse_unchanged_backup(previous, backup_path, link_only=discard_output)
+                    if reused:
+                        return reused
+
             # Create backup
-            if compress:
-                self.logger.debug("Calling _create_compressed_backup (will result in .gz)")
-                success = self._create_compressed_backup(backup_path)
+            stats: Dict[str, Any] = {'codec': backup_codec.name, 'compression_level': level}
+            if fingerprint:
+                stats['fingerprint'] = fingerprint
+            if auto_level:
+                stats['compression_auto'] = auto_details
+            # Full backups record per-page hashes for later differentials
+            page_hasher = None
+            if (self.config.get('BACKUP_PAGE_HASHES_ENABLED', True) and not dedup and not differential_base
+                    and not encrypt_to and not container):
+                page_hasher = PageHasher()
+            if encrypt_to:
+                recipients = [recipient.strip() for recipient in encrypt_to.split(',') if recipient.strip()]
+                self._encryption_recipients[str(backup_path)] = (encryption_engine, recipients)
+                stats['encrypted'] = True
+                stats['encryption_engine'] = encryption_engine
+            started = time.monotonic()
+            if differential_base:
+                self.logger.debug(f"Calling _create_differential_backup (pages compressed with {backup_codec.name})")
+                success = self._create_differential_backup(backup_path, differential_base, stats, progress_callback,
+                                                           backup_codec, level)
+            elif dedup:
+                self.logger.debug(f"Calling _create_dedup_backup (chunks compressed with {backup_codec.name})")
+                success = self._create_dedup_backup(backup_path, stats, progress_callback, backup_codec, level)
+            elif compress or encrypt_to or container:
+                success = False
+                use_streaming = self._can_hold_snapshot()
+                if use_streaming:
+                    self.logger.debug(f"Calling _create_streaming_backup (snapshot streamed into {backup_codec.name})")
+                    success = self._create_streaming_backup(backup_path, stats, progress_callback, backup_codec, level,
+                                                            page_hasher)
+                if not success:
+                    self.logger.debug(f"Calling _create_compressed_backup (will result in {backup_codec.extension})")
+                    if page_hasher:
+                        page_hasher = PageHasher() # Drop pages hashed by a failed streaming attempt
+                    success = self._create_compressed_backup(backup_path, progress_callback, backup_codec, level,
+                                                             page_hasher)
             else:
                 self.logger.debug("Calling _create_simple_backup (will result in .db)")
-                success = self._create_simple_backup(backup_path)
+                success = self._create_simple_backup(backup_path, progress_callback)
+            stats['duration_seconds'] = round(time.monotonic() - started, 3)
+            if 'throughput_mb_s' not in stats and stats['duration_seconds'] > 0:
+                # Same figure for every path, so streaming and temp-file runs can be compared
+                source_mb = self.app_paths.database_file.stat().st_size / (1024 * 1024)
+                stats['throughput_mb_s'] = round(source_mb / stats['duration_seconds'], 2)
 
             if success:
                 self.logger.debug("Backup file created: %s, checking size.", backup_path)
@@ -131,11 +423,24 @@ class DatabaseBackup:
                          backup_path.unlink()
                      return None # Return None if backup is empty or missing
 
+                if auto_level and compress and not dedup:
+                    self.compression_tuner.record(backup_codec, level, self.app_paths.database_file.stat().st_size,
+                                                  backup_path.stat().st_size, stats['duration_seconds'],
+                                                  workers=self._compression_workers())
+
+                if page_hasher:
+                    self._save_page_hashes(backup_path, page_hasher if compress else None)
+
+                stats['checksum'] = self._take_checksum(backup_path)
+                stats['checksum_algorithm'] = CHECKSUM_ALGORITHM
+
                 # Add metadata (always included by default in this method's logic if success is true)
                 self.logger.debug("Creating backup metadata for: %s", backup_path)
-                self._create_backup_metadata(backup_path)
+                self._create_backup_metadata(backup_path, stats)
+                self.catalog.upsert(backup_path)
 
-                self.logger.info(f"Backup created successfully: {backup_path} (Size: {backup_path.stat().st_size} bytes)")
+                self.logger.info(f"Backup created successfully: {backup_path} (Size: {backup_path.stat().st_size} bytes, "
+                                 f"{stats['duration_seconds']}s)")
                 return backup_path
             else:
                 self.logger.error("Backup creation failed (success flag was False)")
@@ -144,8 +449,233 @@ class DatabaseBackup:
         except Exception as e:
             self.logger.error(f"Backup creation error caught in create_backup: {str(e)}")
             return None
+        finally:
+            if backup_path is not None:
+                self._encryption_recipients.pop(str(backup_path), None)
+
+    def resolve_encryption_engine(self, engine: Optional[str] = None, format: Optional[str] = None) -> str:
+        """
+        The encryption engine to use: 'engine' if given, else BACKUP_ENCRYPTION_ENGINE.
+        'chunked' containers always use aes-gcm, which seals each chunk on its own.
+        """
+        if self.is_container_format(format):
+            if engine and engine.lower() != ENVELOPE_ENGINE:
+                self.logger.warning(f"Chunked containers are encrypted with {ENVELOPE_ENGINE}, not {engine}")
+            return ENVELOPE_ENGINE
+        engine = (engine or self.config.get('BACKUP_ENCRYPTION_ENGINE') or 'gpg').lower()
+        if engine not in self.ENCRYPTION_ENGINES:
+            raise ValueError(f"Unknown encryption engine '{engine}' (available: {', '.join(self.ENCRYPTION_ENGINES)})")
+        return engine
+
+    @staticmethod
+    def is_dedup_format(format: Optional[str]) -> bool:
+        return (format or '').lower() == 'dedup'
+
+    def check_encryptable(self, format: Optional[str], backup_type: str = 'manual'):
+        """
+        Raise ValueError if a backup of this format and type cannot be encrypted.
+
+        A dedup manifest only names chunks in the shared store: sealing it
+        would leave a file no restore can open, and the chunks it keeps alive
+        would be garbage collected once the plaintext manifest is gone. A
+        differential needs its base and page hashes in the clear, so an
+        encrypted one cannot be restored either.
+        """
+        if self.is_dedup_format(format):
+            raise ValueError("Deduplicated backups cannot be encrypted")
+        if backup_type == DIFFERENTIAL_TYPE:
+            raise ValueError("Differential backups cannot be encrypted")
+
+    @staticmethod
+    def is_container_format(format: Optional[str]) -> bool:
+        return (format or '').lower() == CONTAINER_FORMAT
+
+    def backup_extension(self, format: Optional[str], codec: Codec) -> str:
+        """Suffix appended to the .db backup name for a format and codec"""
+        if self.is_dedup_format(format):
+            return MANIFEST_SUFFIX
+        if self.is_container_format(format):
+            return codec.extension + CONTAINER_SUFFIX
+        return codec.extension
+
+    def resolve_codec(self, format: Optional[str] = 'zip', codec: Optional[str] = None) -> Codec:
+        """
+        Pick the compression codec for a backup.
+
+        An explicit codec name wins; otherwise the UI/CLI format is mapped through
+        the registry. 'dedup' backups compress their chunks with BACKUP_DEDUP_CODEC,
+        'chunked' containers with BACKUP_DEFAULT_CODEC. Formats that are not codecs ('json', 'csv') are not exported as such and
+        get BACKUP_DEFAULT_CODEC.
 
-    def _create_simple_backup(self, backup_path: Path) -> bool:
+        Raises:
+            ValueError: If the codec name is unknown
+        """
+        if codec:
+            return get_codec(codec)
+        if self.is_dedup_format(format):
+            return get_codec(self.config.get('BACKUP_DEDUP_CODEC', 'gzip'))
+        if self.is_container_format(format):
+            return get_codec(self.config.get('BACKUP_DEFAULT_CODEC', 'gzip'))
+        backup_codec = codec_for_format(format)
+        if backup_codec is None:
+            default_codec = self.config.get('BACKUP_DEFAULT_CODEC', 'gzip')
+            self.logger.warning(f"{str(format).upper()} format requested, but only SQLite DB backup is supported. "
+                                f"Creating {default_codec} backup.")
+            backup_codec = get_codec(default_codec)
+        return backup_codec
+
+    def _can_hold_snapshot(self) -> bool:
+        """
+        Whether a backup may read the live database under one long read transaction.
+
+        A held snapshot blocks writers for its whole duration in rollback-journal
+        mode, so there the stepped copy (BACKUP_INCREMENTAL_ENABLED) is used
+        instead. In WAL mode writers carry on regardless.
+        """
+        if not self.config.get('BACKUP_STREAMING_ENABLED', True):
+            return False
+        if self.config.get('BACKUP_INCREMENTAL_ENABLED', True) and self._get_journal_mode() != 'wal':
+            self.logger.debug("Rollback-journal database: using stepped copy instead of a held snapshot")
+            return False
+        return True
+
+    def _compression_workers(self) -> int:
+        return int(self.config.get('BACKUP_COMPRESSION_THREADS', 0)) or default_compression_threads()
+
+    def _choose_auto_level(self, codec: Codec):
+        """
+        Pick the level for an 'auto' backup with the compression tuner.
+
+        Sample chunks are read with pread through the snapshot descriptor rather
+        than a fresh open(): closing a descriptor on the database would drop this
+        process's SQLite locks. They need not be consistent, only representative.
+
+        Returns:
+            (level, details) as returned by CompressionTuner.choose_level
+        """
+        source_size = self.app_paths.database_file.stat().st_size
+        fd = self._get_snapshot_fd()
+        level, details = self.compression_tuner.choose_level(
+            codec, lambda offset, length: os.pread(fd, length, offset), source_size,
+            workers=self._compression_workers())
+        self.logger.info(f"Auto compression level for {codec.name}: {level} ({details})")
+        return level, details
+
+    def _report_progress(self, progress_callback, stage: str, **fields):
+        """Send a progress event to the caller; a failing callback never aborts a backup"""
+        if not progress_callback:
+            return
+        try:
+            progress_callback({'stage': stage, **fields})
+        except Exception as e:
+            self.logger.debug(f"Progress callback failed: {str(e)}")
+
+    def _get_page_size(self) -> Optional[int]:
+        """Return the page size of the live database"""
+        try:
+            conn = sqlite3.connect(str(self.app_paths.database_file))
+            try:
+                return conn.execute("PRAGMA page_size").fetchone()[0]
+            finally:
+                conn.close()
+        except Exception as e:
+            self.logger.warning(f"Could not read page size: {str(e)}")
+            return None
+
+    def _get_journal_mode(self) -> str:
+        """Return the journal mode of the live database ('delete', 'wal', ...)"""
+        try:
+            conn = sqlite3.connect(str(self.app_paths.database_file))
+            try:
+                return conn.execute("PRAGMA journal_mode").fetchone()[0].lower()
+            finally:
+                conn.close()
+        except Exception as e:
+            self.logger.warning(f"Could not read journal mode: {str(e)}")
+            return 'unknown'
+
+    def _copy_database_incrementally(self, source_conn, backup_conn, progress_callback=None) -> Dict[str, Any]:
+        """
+        Copy the database with the online backup API a few pages at a time.
+
+        Each backup step holds the source lock only for BACKUP_STEP_PAGES pages.
+        Steps are grouped into bursts whose length adapts to the measured step
+        time so that writers never wait longer than BACKUP_WRITER_LATENCY_BUDGET_MS;
+        between bursts the copy sleeps for BACKUP_STEP_SLEEP_MS so queued writers
+        can take the lock. If writers keep restarting the copy more than
+        BACKUP_MAX_RESTARTS times, it finishes with a single blocking step.
+
+        Returns:
+            Dict with step statistics (steps, restarts, pages per burst)
+        """
+        step_pages = max(1, int(self.config.get('BACKUP_STEP_PAGES', 64)))
+        budget = max(0.001, float(self.config.get('BACKUP_WRITER_LATENCY_BUDGET_MS', 50)) / 1000)
+        sleep = max(0.0, float(self.config.get('BACKUP_STEP_SLEEP_MS', 25)) / 1000)
+        max_restarts = int(self.config.get('BACKUP_MAX_RESTARTS', 5))
+
+        state = {
+            'steps': 0, 'restarts': 0, 'last_remaining': None, 'page_count': 0,
+            'step_time': None, 'burst_started': time.monotonic(), 'burst_steps': 0,
+            'steps_per_burst': 1
+        }
+
+        class _TooManyRestarts(Exception):
+            pass
+
+        def on_step(status, remaining, total):
+            now = time.monotonic()
+            state['steps'] += 1
+            state['burst_steps'] += 1
+
+            if state['last_remaining'] is not None and remaining > state['last_remaining']:
+                # Another connection wrote to the source, so SQLite restarted the copy
+                state['restarts'] += 1
+                self.logger.debug(f"Incremental backup restarted by a writer ({state['restarts']}/{max_restarts})")
+                if state['restarts'] > max_restarts:
+                    raise _TooManyRestarts()
+            state['last_remaining'] = remaining
+            state['page_count'] = total
+
+            self._report_progress(progress_callback, 'snapshot',
+                                  pages_copied=total - remaining, page_count=total,
+                                  fraction=round((total - remaining) / total, 4) if total else 1.0)
+
+            # Smooth the per-step cost and size the next burst to fit the latency budget
+            burst_elapsed = now - state['burst_started']
+            step_time = burst_elapsed / state['burst_steps']
+            state['step_time'] = step_time if state['step_time'] is None else 0.7 * state['step_time'] + 0.3 * step_time
+            state['steps_per_burst'] = max(1, int(budget / max(state['step_time'], 1e-6)))
+
+            if remaining and state['burst_steps'] >= state['steps_per_burst']:
+                time.sleep(sleep) # Yield the lock to queued writers
+                state['burst_started'] = time.monotonic()
+                state['burst_steps'] = 0
+
+        try:
+            source_conn.backup(backup_conn, pages=step_pages, progress=on_step)
+            mode = 'incremental'
+        except _TooManyRestarts:
+            self.logger.warning(f"Incremental backup restarted {state['restarts']} times by writers; "
+                                "finishing with a single-step copy")
+            source_conn.backup(backup_conn)
+            self._report_progress(progress_callback, 'snapshot', pages_copied=state['page_count'],
+                                  page_count=state['page_count'], fraction=1.0)
+            mode = 'single_step_fallback'
+
+        if state['step_time'] and state['step_time'] > budget:
+            self.logger.warning(f"A single backup step of {step_pages} pages took {state['step_time'] * 1000:.1f}ms, "
+                                f"over the {budget * 1000:.0f}ms writer budget; lower BACKUP_STEP_PAGES")
+
+        result = {
+            'copy_mode': mode,
+            'steps': state['steps'],
+            'restarts': state['restarts'],
+            'pages_per_burst': state['steps_per_burst'] * step_pages
+        }
+        self.logger.debug(f"Incremental backup finished: {result}")
+        return result
+
+    def _create_simple_backup(self, backup_path: Path, progress_callback=None) -> bool:
         """Create a simple file copy backup"""
         try:
             self.logger.debug(f"Starting _create_simple_backup to {backup_path}")
@@ -154,8 +684,11 @@ class DatabaseBackup:
             source_conn = sqlite3.connect(str(self.app_paths.database_file))
             backup_conn = sqlite3.connect(str(backup_path))
 
-            # Perform backup
-            source_conn.backup(backup_conn)
+            # Perform backup, stepping through pages so live writers are not stalled
+            if self.config.get('BACKUP_INCREMENTAL_ENABLED', True):
+                self._copy_database_incrementally(source_conn, backup_conn, progress_callback)
+            else:
+                source_conn.backup(backup_conn)
             self.logger.debug(f"SQLite backup API completed from {self.app_paths.database_file} to {backup_path}")
 
             # Close connections
@@ -195,8 +728,10 @@ class DatabaseBackup:
                 self.logger.error(f"Fallback backup failed: {str(fallback_error)}")
                 return False
 
-    def _create_compressed_backup(self, backup_path: Path) -> bool:
-        """Create a compressed backup (gzip)"""
+    def _create_compressed_backup(self, backup_path: Path, progress_callback=None,
+                                  codec: Optional[Codec] = None, level: Optional[int] = None,
+                                  page_hasher: Optional[PageHasher] = None) -> bool:
+        """Create a compressed backup (gzip unless another codec is given)"""
         try:
             self.logger.debug(f"Starting _create_compressed_backup to {backup_path}")
             # First create temporary uncompressed backup
@@ -207,7 +742,7 @@ class DatabaseBackup:
             self.logger.debug(f"Temporary backup path: {temp_backup}")
 
             # Use _create_simple_backup to create the uncompressed temp file
-            if self._create_simple_backup(temp_backup):
+            if self._create_simple_backup(temp_backup, progress_callback):
                 if not temp_backup.exists() or temp_backup.stat().st_size == 0:
                     self.logger.error(f"Temporary backup for compression is empty or missing: {temp_backup}")
                     if temp_backup.exists(): temp_backup.unlink() # Clean up empty temp file
@@ -216,8 +751,9 @@ class DatabaseBackup:
                 self.logger.debug(f"Compressing {temp_backup} to {backup_path}")
                 # Compress the backup
                 with temp_backup.open('rb') as f_in:
-                    with gzip.open(backup_path, 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
+                    with self._open_backup_writer(backup_path, codec, level) as f_out:
+                        self._copy_with_progress(f_in, f_out, temp_backup.stat().st_size,
+                                                 progress_callback=progress_callback, page_hasher=page_hasher)
 
                 # Verify compressed file size
                 if not backup_path.exists() or backup_path.stat().st_size == 0:
@@ -241,9 +777,549 @@ class DatabaseBackup:
                 backup_path.unlink()
             return False
 
-    def _create_backup_metadata(self, backup_path: Path):
+    def _get_snapshot_fd(self) -> int:
+        """
+        Return a read-only descriptor on the live database file.
+
+        The descriptor is kept open for the life of the manager: closing any
+        descriptor on a SQLite file drops every POSIX lock this process holds
+        on it, including the locks of unrelated connections. It is only
+        reopened once the database file has been replaced by a new inode.
+        """
+        with self._snapshot_fd_lock:
+            db_stat = os.stat(self.app_paths.database_file)
+            if self._snapshot_fd is not None:
+                fd_stat = os.fstat(self._snapshot_fd)
+                if (fd_stat.st_dev, fd_stat.st_ino) == (db_stat.st_dev, db_stat.st_ino):
+                    return self._snapshot_fd
+                os.close(self._snapshot_fd) # Old inode is no longer the live database
+            self._snapshot_fd = os.open(self.app_paths.database_file, os.O_RDONLY)
+            return self._snapshot_fd
+
+    @contextmanager
+    def _open_database_snapshot(self):
+        """
+        Hold a read transaction on the live database and yield a reader over its pages.
+
+        While the read transaction is open, writers cannot change the pages on
+        disk (rollback journal: they cannot take the EXCLUSIVE lock; WAL: the
+        checkpointer cannot backfill past our read mark), so the raw file is a
+        consistent snapshot. In WAL mode the log is checkpointed first and the
+        snapshot is only taken once it is empty. While the WAL archiver runs,
+        it does the checkpoint (a TRUNCATE would be blocked by its reader) and
+        the snapshot starts inside it, once the file holds every commit.
+
+        Yields:
+            _SnapshotReader positioned at the start of the database
+        """
+        if not hasattr(os, 'pread'):
+            raise RuntimeError("Streaming snapshots need os.pread, which this platform lacks")
+
+        source_conn = sqlite3.connect(str(self.app_paths.database_file), isolation_level=None)
+        try:
+            journal_mode = source_conn.execute("PRAGMA journal_mode").fetchone()[0].lower()
+            wal_file = Path(f"{self.app_paths.database_file}-wal")
+
+            archiver = self.wal_archiver if journal_mode == 'wal' and self.wal_archiver else None
+            if archiver and not archiver.is_active():
+                archiver = None
+
+            for attempt in range(self.SNAPSHOT_ATTEMPTS):
+                if archiver:
+                    def begin_snapshot():
+                        source_conn.execute("BEGIN")
+                        source_conn.execute("SELECT count(*) FROM sqlite_master").fetchone()
+
+                    if archiver.checkpoint(during=begin_snapshot):
+                        break
+                    time.sleep(0.05 * (attempt + 1))
+                    continue
+                if journal_mode == 'wal':
+                    source_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                source_conn.execute("BEGIN")
+                source_conn.execute("SELECT count(*) FROM sqlite_master").fetchone()
+                if journal_mode != 'wal' or not wal_file.exists() or wal_file.stat().st_size == 0:
+                    break
+                # A writer committed between the checkpoint and our read, so part of
+                # the snapshot lives in the WAL. Drain it again and retry.
+                source_conn.execute("ROLLBACK")
+                time.sleep(0.05 * (attempt + 1))
+            else:
+                raise RuntimeError("WAL could not be drained for a file-level snapshot")
+
+            page_size = source_conn.execute("PRAGMA page_size").fetchone()[0]
+            page_count = source_conn.execute("PRAGMA page_count").fetchone()[0]
+            self.logger.debug(f"Snapshot opened: journal_mode={journal_mode}, page_size={page_size}, page_count={page_count}")
+
+            yield _SnapshotReader(self._get_snapshot_fd(), page_size, page_count, source_conn)
+        finally:
+            if source_conn.in_transaction:
+                source_conn.execute("ROLLBACK")
+            source_conn.close()
+
+    @contextmanager
+    def _open_backup_writer(self, backup_path: Path, codec: Optional[Codec] = None, level: Optional[int] = None):
+        """
+        Open the compressed writer for a backup.
+
+        With more than one BACKUP_COMPRESSION_THREADS (0 = one per CPU) blocks are
+        compressed in parallel into a multi-stream file, on threads or, with
+        BACKUP_COMPRESSION_EXECUTOR = 'process', a process pool; otherwise a single
+        stream is used. Both restore through _restore_compressed_backup.
+
+        The compressed bytes are hashed on their way to disk; once the writer
+        closes cleanly the checksum is kept for _create_backup to pick up.
+
+        For an encrypted backup (see create_backup's encrypt_to) the
+        compressed stream goes through the engine's encrypting writer in
+        between: a GpgEncryptStream, where gpg runs alongside the compressor
+        fed from a bounded queue, or an EnvelopeEncryptStream sealing chunks
+        on its own threads. Its output is what gets hashed and written. No
+        plaintext reaches disk.
+
+        A .bkc path gets a ContainerWriter instead, compressing (and, when
+        encrypted, sealing) BACKUP_CONTAINER_CHUNK_SIZE chunks on the same
+        number of threads and writing the index when it closes.
+        """
+        codec = codec or get_codec('gzip')
+        threads = self._compression_workers()
+        block_size = int(self.config.get('BACKUP_COMPRESSION_BLOCK_SIZE', DEFAULT_BLOCK_SIZE))
+        executor = self.config.get('BACKUP_COMPRESSION_EXECUTOR', 'thread')
+        if threads > 1:
+            self.logger.debug(f"Using parallel {codec.name}: {threads} {executor} workers, {block_size} byte blocks")
+        encryption = self._encryption_recipients.get(str(backup_path))
+        if backup_path.suffix == CONTAINER_SUFFIX:
+            chunk_size = int(self.config.get('BACKUP_CONTAINER_CHUNK_SIZE', 1024 * 1024))
+            with ChecksumFile(backup_path) as raw:
+                with ContainerWriter(raw, codec, level, chunk_size=chunk_size, workers=threads, envelope=self.envelope,
+                                     recipients=encryption[1] if encryption else None) as container:
+                    yield container
+                self.logger.info(f"Chunked container written: {container.stats()}")
+            self._written_checksums[str(backup_path)] = raw.hexdigest()
+            return
+        with ChecksumFile(backup_path) as raw:
+            if encryption:
+                engine, recipients = encryption
+                if engine == ENVELOPE_ENGINE:
+                    encrypted = self.envelope.open_encrypt_stream(raw, recipients)
+                else:
+                    if self.gpg is None:
+                        self.gpg = GPGBackup(self.config)
+                    encrypted = self.gpg.open_encrypt_stream(
+                        raw, recipients, int(self.config.get('BACKUP_STREAM_BUFFER_SIZE', 1024 * 1024)),
+                        int(self.config.get('BACKUP_ENCRYPT_QUEUE_BLOCKS', 8)))
+            with (encrypted if encryption else nullcontext(raw)) as sink:
+                with codec.open_writer(sink, level, threads=threads, block_size=block_size, executor=executor) as f_out:
+                    yield f_out
+            if encryption:
+                self.logger.info(f"Encrypted ({engine}) for {', '.join(recipients)} while writing: {encrypted.stats()}")
+        self._written_checksums[str(backup_path)] = raw.hexdigest()
+
+    def _take_checksum(self, backup_path: Path) -> str:
+        """Checksum of a just-written backup: the one hashed inline, else (SQLite backup API, manifests) read back"""
+        checksum = self._written_checksums.pop(str(backup_path), None)
+        return checksum or file_checksum(backup_path)
+
+    def _copy_with_progress(self, f_in, f_out, total: int, buffer_size: int = 1024 * 1024,
+                            progress_callback=None, page_size: int = 0,
+                            page_hasher: Optional[PageHasher] = None) -> int:
+        """
+        Copy f_in into a compressor in bounded chunks, reporting 'compress' progress.
+
+        Args:
+            f_in: Source file-like object
+            f_out: Destination (usually a gzip stream)
+            total: Expected number of input bytes, for the progress fraction
+            buffer_size: Chunk size
+            progress_callback: Optional progress callable
+            page_size: When set, page counts are included in the events
+            page_hasher: Optional PageHasher fed with every chunk copied
+
+        Returns:
+            Number of bytes copied
+        """
+        copied = 0
+        while True:
+            chunk = f_in.read(buffer_size)
+            if not chunk:
+                break
+            f_out.write(chunk)
+            if page_hasher:
+                page_hasher.update(chunk)
+            copied += len(chunk)
+            fields = {
+                'bytes_compressed': copied,
+                'bytes_total': total,
+                'fraction': round(copied / total, 4) if total else 1.0
+            }
+            if page_size:
+                fields['pages_copied'] = copied // page_size
+                fields['page_count'] = total // page_size
+            self._report_progress(progress_callback, 'compress', **fields)
+        return copied
+
+    def _create_streaming_backup(self, backup_path: Path, stats: Optional[Dict[str, Any]] = None,
+                                 progress_callback=None, codec: Optional[Codec] = None,
+                                 level: Optional[int] = None, page_hasher: Optional[PageHasher] = None) -> bool:
+        """
+        Stream a consistent snapshot of the database straight into the compressor.
+
+        Unlike _create_compressed_backup no temporary .db copy is written, so
+        the database is read once and only the compressed bytes hit the disk.
+        Memory is bounded by BACKUP_STREAM_BUFFER_SIZE. Note that the source
+        read lock is held while compressing, so on a rollback-journal database
+        writers wait for the whole stream.
+
+        Args:
+            backup_path: Target compressed path
+            stats: Optional dict filled with method, byte counts and throughput
+            progress_callback: Optional callable receiving 'compress' progress events
+            codec: Compression codec (gzip if not given)
+            level: Codec level (the codec's default if not given)
+            page_hasher: Optional PageHasher fed with the snapshot pages
+
+        Returns:
+            True if the snapshot was streamed; False if the caller should fall back
+        """
+        buffer_size = int(self.config.get('BACKUP_STREAM_BUFFER_SIZE', 1024 * 1024))
+        try:
+            self.logger.debug(f"Starting _create_streaming_backup to {backup_path} (buffer {buffer_size} bytes)")
+            started = time.monotonic()
+            with self._open_database_snapshot() as snapshot:
+                with self._open_backup_writer(backup_path, codec, level) as f_out:
+                    self._copy_with_progress(snapshot, f_out, snapshot.size, buffer_size,
+                                             progress_callback, page_size=snapshot.page_size,
+                                             page_hasher=page_hasher)
+                bytes_read = snapshot.position
+                page_count = snapshot.page_count
+            duration = max(time.monotonic() - started, 1e-6)
+
+            throughput = bytes_read / duration / (1024 * 1024)
+            compressed_size = backup_path.stat().st_size
+            self.logger.info(f"Streaming backup: {bytes_read} bytes ({page_count} pages) -> {compressed_size} bytes "
+                             f"in {duration:.2f}s ({throughput:.1f} MB/s)")
+            if stats is not None:
+                stats.update({
+                    'backup_method': 'streaming_snapshot',
+                    'bytes_read': bytes_read,
+                    'page_count': page_count,
+                    'throughput_mb_s': round(throughput, 2)
+                })
+            return True
+
+        except Exception as e:
+            self.logger.warning(f"Streaming backup failed, falling back to temp-file backup: {str(e)}")
+            if backup_path.exists():
+                backup_path.unlink()
+            return False
+
+    def _create_dedup_backup(self, backup_path: Path, stats: Optional[Dict[str, Any]] = None,
+                             progress_callback=None, codec: Optional[Codec] = None,
+                             level: Optional[int] = None) -> bool:
+        """
+        Chunk a snapshot into the deduplicated store and write its manifest.
+
+        Only chunks not already in the store are compressed and written, so a
+        snapshot that differs from the last one in a few pages costs a few
+        chunks plus the manifest. The snapshot is streamed under a read lock
+        like _create_streaming_backup; on a rollback-journal database (or when
+        streaming is disabled) a stepped copy to a temp file is chunked instead,
+        so writers are not held up by the chunking.
+
+        Args:
+            backup_path: Target .manifest path
+            stats: Optional dict filled with chunk and byte counts
+            progress_callback: Optional callable receiving 'compress' progress events
+            codec: Codec for new chunks
+            level: Codec level
+
+        Returns:
+            True if the manifest was written
+        """
+        codec = codec or get_codec('gzip')
+        temp_backup = None
+        started = time.monotonic()
+
+        def on_chunk(bytes_done, total, chunks, new_chunks):
+            self._report_progress(progress_callback, 'compress', bytes_compressed=bytes_done, bytes_total=total,
+                                  fraction=round(bytes_done / total, 4) if total else None,
+                                  chunks=chunks, new_chunks=new_chunks)
+
+        try:
+            use_snapshot = self._can_hold_snapshot()
+            if use_snapshot:
+                with self._open_database_snapshot() as snapshot:
+                    result = self.chunk_store.write_backup(snapshot, backup_path, codec, level,
+                                                           snapshot.size, on_chunk)
+            else:
+                temp_backup = self.app_paths.temp_dir / f"temp_backup_{datetime.now().timestamp()}.db"
+                self.app_paths.temp_dir.mkdir(parents=True, exist_ok=True)
+                if not self._create_simple_backup(temp_backup, progress_callback):
+                    return False
+                with temp_backup.open('rb') as f_in:
+                    result = self.chunk_store.write_backup(f_in, backup_path, codec, level,
+                                                           temp_backup.stat().st_size, on_chunk)
+
+            self.catalog.add_chunk_usage(result['new_chunks'], result['new_chunk_bytes'])
+            duration = max(time.monotonic() - started, 1e-6)
+            self.logger.info(f"Deduplicated backup: {result['bytes_read']} bytes in {result['chunks']} chunks, "
+                             f"{result['new_chunks']} new ({result['bytes_written']} bytes written) in {duration:.2f}s")
+            if stats is not None:
+                stats.update({
+                    'backup_method': 'dedup_snapshot' if use_snapshot else 'dedup_temp_copy',
+                    'bytes_read': result['bytes_read'],
+                    'bytes_written': result['bytes_written'],
+                    'chunks': result['chunks'],
+                    'new_chunks': result['new_chunks'],
+                    'throughput_mb_s': round(result['bytes_read'] / duration / (1024 * 1024), 2)
+                })
+            return True
+
+        except Exception as e:
+            self.logger.error(f"Deduplicated backup failed: {str(e)}")
+            if backup_path.exists():
+                backup_path.unlink()
+            return False
+        finally:
+            if temp_backup and temp_backup.exists():
+                temp_backup.unlink()
+
+    def _save_page_hashes(self, backup_path: Path, page_hasher: Optional[PageHasher] = None):
+        """Write the .pages sidecar of a full backup (hashing the file itself if no hasher ran)"""
+        try:
+            page_hasher = page_hasher or PageHasher.from_file(backup_path)
+            page_hasher.save(page_hash_path(backup_path))
+        except Exception as e:
+            # The backup is still good; it just cannot be a differential base
+            self.logger.warning(f"Failed to save page hashes for {backup_path}: {str(e)}")
+
+    def _find_differential_base(self):
+        """
+        Find the newest full backup a differential can be taken against.
+
+        Returns:
+            (backup_path, page_digests) or None if no full backup has a .pages
+            sidecar matching the live database's page size
+        """
+        page_size = self._get_page_size()
+        sidecars = []
+        for pages_path in self.app_paths.backup_dir.glob(f"backup_*{PAGE_HASH_SUFFIX}"):
+            try:
+                sidecars.append((pages_path.stat().st_mtime, pages_path))
+            except FileNotFoundError:
+                continue
+
+        for _, pages_path in sorted(sidecars, reverse=True):
+            backup_path = pages_path.with_suffix('')
+            if not backup_path.exists() or is_differential(backup_path):
+                continue
+            try:
+                base_page_size, digests = read_page_hashes(pages_path)
+            except Exception as e:
+                self.logger.warning(f"Ignoring unreadable page hashes {pages_path}: {str(e)}")
+                continue
+            if base_page_size != page_size:
+                self.logger.info(f"Full backup {backup_path.name} has page size {base_page_size}, "
+                                 f"database now uses {page_size}; not a differential base")
+                continue
+            return backup_path, digests
+        return None
+
+    def _create_differential_backup(self, backup_path: Path, base, stats: Optional[Dict[str, Any]] = None,
+                                    progress_callback=None, codec: Optional[Codec] = None,
+                                    level: Optional[int] = None) -> bool:
+        """
+        Store only the pages that changed since a full backup.
+
+        Every page of a consistent snapshot is hashed and compared with the
+        base's .pages sidecar; changed pages and their page numbers are written
+        through the codec. Hashing runs at memory speed, so for a large
+        database with a small hot set this takes seconds where a full backup
+        takes minutes. Restore rebuilds the image from the base plus this file.
+
+        Args:
+            backup_path: Target .diff path (plus codec extension)
+            base: (base_backup_path, page_digests) from _find_differential_base
+            stats: Optional dict filled with page counts
+            progress_callback: Optional progress callable
+            codec: Codec for the differential
+            level: Codec level
+
+        Returns:
+            True if the differential was written
+        """
+        base_path, base_digests = base
+        temp_backup = None
+        temp_fd = None
+        started = time.monotonic()
+
+        def report(stage, fields):
+            self._report_progress(progress_callback, stage, **fields)
+
+        try:
+            use_snapshot = self._can_hold_snapshot()
+            if use_snapshot:
+                with self._open_database_snapshot() as snapshot:
+                    with self._open_backup_writer(backup_path, codec, level) as f_out:
+                        result = write_differential(snapshot, base_digests, base_path.name, f_out, report)
+            else:
+                temp_backup = self.app_paths.temp_dir / f"temp_backup_{datetime.now().timestamp()}.db"
+                self.app_paths.temp_dir.mkdir(parents=True, exist_ok=True)
+                if not self._create_simple_backup(temp_backup, progress_callback):
+                    return False
+                # The temp copy has no connections, so its descriptor may be closed freely
+                temp_fd = os.open(temp_backup, os.O_RDONLY)
+                page_size = self._get_page_size() or 4096
+                source = _SnapshotReader(temp_fd, page_size, temp_backup.stat().st_size // page_size)
+                with self._open_backup_writer(backup_path, codec, level) as f_out:
+                    result = write_differential(source, base_digests, base_path.name, f_out, report)
+
+            duration = max(time.monotonic() - started, 1e-6)
+            bytes_read = result['page_count'] * result['page_size']
+            self.logger.info(f"Differential backup against {base_path.name}: {result['changed_pages']} of "
+                             f"{result['page_count']} pages changed, {duration:.2f}s")
+            if stats is not None:
+                stats.update({
+                    'backup_method': 'differential_snapshot' if use_snapshot else 'differential_temp_copy',
+                    'base_backup': base_path.name,
+                    'changed_pages': result['changed_pages'],
+                    'page_count': result['page_count'],
+                    'page_size': result['page_size'],
+                    'bytes_read': bytes_read,
+                    'throughput_mb_s': round(bytes_read / duration / (1024 * 1024), 2)
+                })
+            return True
+
+        except Exception as e:
+            self.logger.error(f"Differential backup failed: {str(e)}")
+            if backup_path.exists():
+                backup_path.unlink()
+            return False
+        finally:
+            if temp_fd is not None:
+                os.close(temp_fd)
+            if temp_backup and temp_backup.exists():
+                temp_backup.unlink()
+
+    def _database_fingerprint(self) -> Optional[str]:
+        """
+        Identity of the live database contents, stored in .meta to spot unchanged databases.
+
+        The raw pages are hashed in one read transaction (see
+        _open_database_snapshot), so the cost is a sequential read of the file
+        with no rows decoded. The b-trees of the tables in
+        BACKUP_FINGERPRINT_IGNORE_TABLES and their indexes are left out: backup
+        jobs write their own BackupRecord/BackupStats rows before and after each
+        snapshot, so with those pages included no backup taken through the job
+        queue would ever look unchanged. Page 1 is hashed with the header fields
+        every commit rewrites blanked. Reads, but writes nothing.
+        """
+        ignored = {name.strip().lower() for name in
+                   str(self.config.get('BACKUP_FINGERPRINT_IGNORE_TABLES', 'backup_records,backup_stats')).split(',')
+                   if name.strip()}
+        try:
+            with self._open_database_snapshot() as reader:
+                skipped = self._btree_pages(reader.connection, ignored)
+                page_size = reader.page_size
+                block_pages = max(1, int(self.config.get('BACKUP_STREAM_BUFFER_SIZE', 1024 * 1024)) // page_size)
+                digest = hashlib.blake2b(digest_size=16)
+                page_number = 1
+                for block in iter(lambda: reader.read(block_pages * page_size), b''):
+                    if len(block) % page_size:
+                        raise IOError("Database snapshot is not a whole number of pages")
+                    view = memoryview(block)
+                    for offset in range(0, len(block), page_size):
+                        if page_number not in skipped:
+                            page = view[offset:offset + page_size]
+                            if page_number == 1:
+                                page = bytearray(page)
+                                for start, end in self.VOLATILE_HEADER_FIELDS:
+                                    page[start:end] = bytes(end - start)
+                            digest.update(page_number.to_bytes(4, 'big'))
+                            digest.update(page)
+                        page_number += 1
+                return f"pages:{digest.hexdigest()}"
+        except Exception as e:
+            self.logger.debug(f"Could not fingerprint database, backing up unconditionally: {str(e)}")
+            return None
+
+    def _btree_pages(self, conn: sqlite3.Connection, tables: Set[str]) -> Set[int]:
+        """Page numbers of the given tables and their indexes, or none if SQLite lacks the dbstat table"""
+        if not tables:
+            return set()
+        names = [name for name, table in conn.execute(
+            "SELECT name, tbl_name FROM sqlite_master WHERE type IN ('table', 'index')") if table.lower() in tables]
+        pages = set()
+        try:
+            for name in names:
+                pages.update(page for (page,) in conn.execute("SELECT pageno FROM dbstat WHERE name = ?", (name,)))
+        except sqlite3.OperationalError as e:
+            # Every page then counts: job bookkeeping alone makes the database look changed
+            self.logger.debug(f"dbstat unavailable, fingerprinting every page: {str(e)}")
+            return set()
+        return pages
+
+    def _find_unchanged_backup(self, fingerprint: str, backup_path: Path) -> Optional[Path]:
+        """The newest backup with the same extension as backup_path, if its fingerprint matches"""
+        extension = backup_path.name.partition('.')[2]
+        self.catalog.sync()
+        newest = None
+        for backup in self.catalog.list():
+            metadata = backup.get('metadata')
+            if (backup['name'].partition('.')[2] != extension or backup['differential'] or not metadata
+                    or not backup['path'].exists()):
+                continue
+            if newest is None or metadata.get('created_at', '') > newest['metadata'].get('created_at', ''):
+                newest = backup
+        if newest and newest['metadata'].get('fingerprint') == fingerprint:
+            return newest['path']
+        return None
+
+    def _reuse_unchanged_backup(self, previous: Path, backup_path: Path, link_only: bool = False) -> Optional[Path]:
+        """
+        Stand in for a backup of an unchanged database.
+
+        With BACKUP_SKIP_UNCHANGED = 'skip' the previous backup is returned as
+        is; with 'link' (default) it is hard-linked under the new name, so the
+        run still shows up as its own dated backup without copying anything.
+        The names share one inode, so the mtime stays the previous backup's;
+        the new name is dated by created_at in its own .meta (see
+        backup_catalog.backup_time) and retention keeps the data until the
+        newest name expires. Returns None if linking fails.
+
+        link_only links even in 'skip' mode, for callers that delete the
+        returned file (create_backup's discard_output).
+        """
+        if self.config.get('BACKUP_SKIP_UNCHANGED', 'link') == 'skip' and not link_only:
+            self.logger.info(f"Database unchanged since {previous.name}; skipping backup")
+            return previous
+        metadata_path = backup_path.with_suffix(backup_path.suffix + '.meta')
+        try:
+            # The .meta goes first: it is what dates the new name once the link exists
+            with previous.with_suffix(previous.suffix + '.meta').open('r') as f:
+                metadata = json.load(f)
+            metadata.update(backup_file=backup_path.name, created_at=datetime.now().isoformat(),
+                            unchanged_from=previous.name, duration_seconds=0)
+            with metadata_path.open('w') as f:
+                json.dump(metadata, f, indent=2)
+            os.link(previous, backup_path)
+            if page_hash_path(previous).exists():
+                os.link(page_hash_path(previous), page_hash_path(backup_path))
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Could not link unchanged backup {previous.name}, copying instead: {str(e)}")
+            for path in (backup_path, page_hash_path(backup_path), metadata_path):
+                if path.exists():
+                    path.unlink()
+            return None
+        self.catalog.upsert(backup_path)
+        self.logger.info(f"Database unchanged since {previous.name}; linked as {backup_path.name}")
+        return backup_path
+
+    def _create_backup_metadata(self, backup_path: Path, stats: Optional[Dict[str, Any]] = None):
         """Create metadata file for backup"""
         try:
+            stats = stats or {}
+            codec = codec_for_path(backup_path.stem if backup_path.suffix == CONTAINER_SUFFIX else backup_path)
             metadata = {
                 'backup_file': backup_path.name,
                 'created_at': datetime.now().isoformat(),
@@ -251,9 +1327,22 @@ class DatabaseBackup:
                 'source_database': str(self.app_paths.database_file),
                 'database_size': self.app_paths.database_file.stat().st_size,
                 'backup_size': backup_path.stat().st_size,
-                'compressed': backup_path.suffix == '.gz',
-                'backup_method': 'sqlite_backup_api'
+                'compressed': codec.compresses,
+                'codec': stats.get('codec', codec.name),
+                'backup_method': stats.get('backup_method', 'sqlite_backup_api')
             }
+            if backup_path.suffix == MANIFEST_SUFFIX:
+                metadata['dedup'] = True
+            if is_differential(backup_path):
+                metadata['differential'] = True
+            if backup_path.suffix == CONTAINER_SUFFIX:
+                metadata['container'] = True
+            for key in ('compression_level', 'compression_auto', 'chunks', 'new_chunks', 'bytes_written',
+                        'base_backup', 'changed_pages', 'page_size', 'duration_seconds', 'bytes_read', 'page_count', 'throughput_mb_s',
+                        'fingerprint', 'checksum', 'checksum_algorithm', 'database_size', 'encrypted',
+                        'encryption_engine'):
+                if key in stats:
+                    metadata[key] = stats[key]
 
             metadata_path = backup_path.with_suffix(backup_path.suffix + '.meta')
 
@@ -263,173 +1352,532 @@ class DatabaseBackup:
         except Exception as e:
             self.logger.warning(f"Failed to create metadata for {backup_path}: {str(e)}")
 
-    def restore_backup(self, backup_path: Path, target_path: Optional[Path] = None) -> bool:
+    def restore_backup(self, backup_path: Path, target_path: Optional[Path] = None, keep_current: bool = False) -> bool:
         """
         Restore database from backup
 
+        The backup is written to a temp file next to the target, fsynced and
+        integrity-checked (BACKUP_RESTORE_INTEGRITY_CHECK), then renamed over
+        the target. The target is never half written, and the live database is
+        only unavailable for the rename (see _swap_into_place).
+
+        With keep_current, the database being replaced is kept as a
+        'pre_restore' backup. With BACKUP_PRE_RESTORE_MODE = 'link' (default)
+        the old file is hard-linked into backup_dir at the moment of the swap
+        and compressed in the background afterwards, so no snapshot is taken
+        up front. 'full', or a backup_dir on another filesystem, takes a normal
+        pre_restore backup first.
+
         Args:
             backup_path: Path to backup file
             target_path: Target restoration path (defaults to main database)
+            keep_current: Keep the live database as a pre_restore backup (ignored for other targets)
 
         Returns:
             True if restoration successful
         """
+        staging = None
         try:
             if not backup_path.exists():
                 self.logger.error(f"Backup file not found for restore: {backup_path}")
                 return False
 
             # Access database_file from self.app_paths
-            target = target_path or self.app_paths.database_file
+            target = Path(target_path or self.app_paths.database_file)
 
             # Create target directory if needed
             target.parent.mkdir(parents=True, exist_ok=True)
 
-            # Handle compressed backups
-            if backup_path.suffix == '.gz':
-                return self._restore_compressed_backup(backup_path, target)
-            else:
-                return self._restore_simple_backup(backup_path, target)
+            # Same directory as the target, so the final rename is atomic
+            staging = target.with_name(f".{target.name}.restore-{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}")
+            if not self._restore_to(backup_path, staging):
+                return False
+            with staging.open('rb') as f:
+                os.fsync(f.fileno())
+
+            problem = self._check_restored_database(staging)
+            if problem:
+                self.logger.error(f"Database restored from {backup_path.name} failed its integrity check: {problem}")
+                return False
+
+            keep_as = None
+            if keep_current and target == Path(self.app_paths.database_file) and target.exists():
+                if self._can_link_pre_restore():
+                    keep_as = self._pre_restore_path()
+                elif not self.create_backup(format='gz', backup_type='pre_restore'):
+                    self.logger.error("Failed to create pre-restore backup; restore abandoned")
+                    return False
+
+            self._swap_into_place(staging, target, keep_as)
+            if keep_as:
+                threading.Thread(target=self._finish_pre_restore_backup, args=(keep_as,),
+                                 name='pre-restore-backup', daemon=True).start()
+            return True
 
         except Exception as e:
             self.logger.error(f"Backup restoration error: {str(e)}")
             return False
+        finally:
+            if staging is not None:
+                self._remove_database_files(staging)
+
+    def _restore_to(self, backup_path: Path, target: Path) -> bool:
+        """Write the database held by a backup to 'target' (overwritten in place; see restore_backup)"""
+        if backup_path.suffix == CONTAINER_SUFFIX:
+            return self._restore_container_backup(backup_path, target)
+        if backup_path.suffix in ENCRYPTED_SUFFIXES:
+            return self._restore_encrypted_backup(backup_path, target)
+        if backup_path.suffix == MANIFEST_SUFFIX:
+            return self._restore_dedup_backup(backup_path, target)
+        if is_differential(backup_path):
+            return self._restore_differential_backup(backup_path, target)
+        # Handle compressed backups; the codec is known from the file extension
+        codec = codec_for_path(backup_path)
+        if codec.compresses:
+            return self._restore_compressed_backup(backup_path, target, codec)
+        return self._restore_simple_backup(backup_path, target)
+
+    def _check_restored_database(self, path: Path) -> Optional[str]:
+        """Integrity check of a restored database before it is swapped in; returns the problem, or None"""
+        mode = self.config.get('BACKUP_RESTORE_INTEGRITY_CHECK', 'quick')
+        if mode == 'off':
+            return None
+        conn = sqlite3.connect(str(path))
+        try:
+            rows = [row[0] for row in conn.execute("PRAGMA integrity_check" if mode == 'full' else "PRAGMA quick_check")]
+            if rows != ['ok']:
+                return '; '.join(rows[:5])
+            if not conn.execute("SELECT count(*) FROM sqlite_master WHERE type='table'").fetchone()[0]:
+                return "no tables"
+            return None
+        except sqlite3.Error as e:
+            return str(e)
+        finally:
+            conn.close()
+
+    def _swap_into_place(self, staging: Path, target: Path, keep_as: Optional[Path] = None):
+        """
+        Rename a restored database over the target (hard-linking the old file to keep_as first).
+
+        For the live database, the app's connection pool (release_connections)
+        is emptied before the rename, so idle connections close, and
+        checkpoint, while the path still names their file. It is emptied
+        again after the rename, so connections that were checked out are
+        discarded when returned. The WAL archiver is paused and its
+        connections closed for the duration. The old file's -wal/-shm/-journal
+        are removed after the rename; SQLite would otherwise apply them to the
+        new file. Before a keep_as link the WAL is checkpointed into the old
+        file, so the link holds every commit.
+        """
+        live = target == Path(self.app_paths.database_file)
+        with (self.wal_archiver.paused() if live and self.wal_archiver else nullcontext()):
+            started = time.monotonic()
+            if live and self.release_connections:
+                self.release_connections()
+            if keep_as:
+                self._checkpoint_database(target)
+                os.link(target, keep_as)
+            os.replace(staging, target)
+            for suffix in SQLITE_SIDE_FILES:
+                Path(f"{target}{suffix}").unlink(missing_ok=True)
+            if live and self.release_connections:
+                self.release_connections()
+            if live and self.wal_archiver:
+                # The archived WAL history no longer leads to the live database
+                self.wal_archiver.request_new_generation()
+            swap_ms = (time.monotonic() - started) * 1000
+        fd = os.open(target.parent, os.O_RDONLY)
+        try:
+            os.fsync(fd) # Make the rename durable
+        finally:
+            os.close(fd)
+        self.logger.info(f"Swapped restored database into {target} ({swap_ms:.1f} ms)")
+
+    def _checkpoint_database(self, path: Path):
+        """Move everything in a WAL-mode database's -wal into the main file"""
+        conn = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+        try:
+            if conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == 'wal':
+                busy = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+                if busy:
+                    raise IOError("WAL could not be checkpointed before keeping the current database")
+        finally:
+            conn.close()
+
+    def _can_link_pre_restore(self) -> bool:
+        if self.config.get('BACKUP_PRE_RESTORE_MODE', 'link') != 'link':
+            return False
+        self.app_paths.backup_dir.mkdir(parents=True, exist_ok=True)
+        # Hard links cannot cross filesystems
+        return os.stat(self.app_paths.database_file).st_dev == os.stat(self.app_paths.backup_dir).st_dev
+
+    def _pre_restore_path(self) -> Path:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        path = self.app_paths.backup_dir / self.app_paths.get_backup_filename(backup_type='pre_restore', timestamp=timestamp)
+        sequence = 1
+        while path.exists():
+            sequence += 1
+            path = self.app_paths.backup_dir / self.app_paths.get_backup_filename(
+                backup_type='pre_restore', timestamp=f"{timestamp}_{sequence}")
+        return path
+
+    def _finish_pre_restore_backup(self, linked: Path):
+        """
+        Turn the database file kept by a restore into a regular backup (runs in the background).
+
+        It is compressed with BACKUP_PRE_RESTORE_CODEC ('none' keeps the .db)
+        and the uncompressed link removed. Until then the link is itself a
+        valid plain backup.
+        """
+        try:
+            started = time.monotonic()
+            database_size = linked.stat().st_size
+            codec = get_codec(self.config.get('BACKUP_PRE_RESTORE_CODEC', 'gzip'))
+            backup_path = linked
+            stats: Dict[str, Any] = {'codec': codec.name, 'backup_method': 'pre_restore_link',
+                                     'database_size': database_size}
+            if codec.compresses:
+                backup_path = linked.with_name(linked.name + codec.extension)
+                level = parse_level(self.config.get('BACKUP_COMPRESSION_LEVEL'))
+                level = codec.resolve_level(None if level == AUTO_LEVEL else level)
+                with linked.open('rb') as f_in, self._open_backup_writer(backup_path, codec, level) as f_out:
+                    shutil.copyfileobj(f_in, f_out, int(self.config.get('BACKUP_STREAM_BUFFER_SIZE', 1024 * 1024)))
+                stats['compression_level'] = level
+            stats['checksum'] = self._take_checksum(backup_path)
+            stats['checksum_algorithm'] = CHECKSUM_ALGORITHM
+            stats['duration_seconds'] = round(time.monotonic() - started, 3)
+            self._create_backup_metadata(backup_path, stats)
+            self.catalog.upsert(backup_path)
+            if backup_path != linked:
+                linked.unlink()
+                self.catalog.remove(linked.name)
+            self.logger.info(f"Pre-restore backup kept: {backup_path} ({stats['duration_seconds']}s)")
+        except Exception as e:
+            # The link itself is still a usable backup
+            self.logger.error(f"Failed to compress pre-restore backup {linked}: {str(e)}")
+
+    def _remove_database_files(self, path: Path):
+        for name in [str(path)] + [f"{path}{suffix}" for suffix in SQLITE_SIDE_FILES]:
+            try:
+                Path(name).unlink()
+            except FileNotFoundError:
+                pass
+
+    def restore_point_in_time(self, timestamp: datetime, target_path: Optional[Path] = None,
+                              keep_current: bool = False) -> bool:
+        """
+        Restore the database as it was at 'timestamp' from the WAL archive
+
+        Args:
+            timestamp: Point in time to recover to (local time)
+            target_path: Target restoration path (defaults to main database)
+            keep_current: Keep the live database as a pre_restore backup (see restore_backup)
+
+        Returns:
+            True if restoration successful
+        """
+        temp_image = self.app_paths.temp_dir / f"pitr_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.db"
+        try:
+            result = restore_to_time(self.wal_archive_dir, temp_image, timestamp.timestamp())
+            recovered_to = datetime.fromtimestamp(result['recovered_to'])
+            self.logger.info(f"Rebuilt database as of {recovered_to.isoformat()} from generation "
+                             f"{result['generation']} ({result['segments']} segments, {result['frames']} frames)")
+            # Hand the rebuilt image to the normal restore path so the live database is swapped the usual way
+            return self.restore_backup(temp_image, target_path, keep_current)
+        except Exception as e:
+            self.logger.error(f"Point-in-time restore to {timestamp.isoformat()} failed: {str(e)}")
+            return False
+        finally:
+            if temp_image.exists():
+                temp_image.unlink()
+
+    def get_recovery_window(self) -> Optional[Dict[str, datetime]]:
+        """
+        Earliest and latest point in time the WAL archive can restore to (None if there is no archive).
+
+        Segments are only added to or pruned from generation directories, so
+        the window is recomputed only when one of those changes mtime.
+        """
+        try:
+            with os.scandir(self.wal_archive_dir) as entries:
+                key = tuple(sorted((entry.name, entry.stat().st_mtime_ns) for entry in entries if entry.is_dir()))
+        except FileNotFoundError:
+            return None
+        cached = self._recovery_window_cache
+        if cached and cached[0] == key:
+            return cached[1]
+        window = recovery_window(self.wal_archive_dir)
+        self._recovery_window_cache = (key, window)
+        return window
 
     def _restore_simple_backup(self, backup_path: Path, target_path: Path) -> bool:
         """Restore from simple backup"""
         try:
-            shutil.copy2(backup_path, target_path)
+            # copyfile copies in the kernel (sendfile) where available; the backup's own mtime is not carried over
+            shutil.copyfile(backup_path, target_path)
             self.logger.info(f"Database restored from {backup_path} to {target_path}")
             return True
         except Exception as e:
             self.logger.error(f"Simple restore failed: {str(e)}")
             return False
 
-    def _restore_compressed_backup(self, backup_path: Path, target_path: Path) -> bool:
+    def _restore_compressed_backup(self, backup_path: Path, target_path: Path, codec: Optional[Codec] = None) -> bool:
         """Restore from compressed backup"""
         try:
-            with gzip.open(backup_path, 'rb') as f_in:
+            codec = codec or codec_for_path(backup_path)
+            with codec.open_reader(backup_path) as f_in:
                 with target_path.open('wb') as f_out:
                     shutil.copyfileobj(f_in, f_out)
 
-            self.logger.info(f"Compressed database restored from {backup_path} to {target_path}")
+            self.logger.info(f"Compressed ({codec.name}) database restored from {backup_path} to {target_path}")
             return True
         except Exception as e:
             self.logger.error(f"Compressed restore failed: {str(e)}")
             return False
 
-    def list_backups(self) -> List[Dict[str, Any]]:
-        """List all available backups with metadata"""
-        backups = []
+    def _open_container(self, backup_path: Path) -> ContainerReader:
+        """Reader over a .bkc container, opening its chunks on BACKUP_COMPRESSION_THREADS threads"""
+        return ContainerReader(backup_path, envelope=self.envelope, workers=self._compression_workers())
 
+    def _restore_container_backup(self, backup_path: Path, target_path: Path) -> bool:
+        """
+        Restore from a chunked container: chunks are decrypted, decompressed
+        and checked in parallel and each is written at its own offset.
+        """
         try:
-            # Find all backup files using self.app_paths.backup_dir
-            backup_files = list(self.app_paths.backup_dir.glob("backup_*.db*"))
+            started = time.monotonic()
+            with self._open_container(backup_path) as container:
+                size = container.extract_to(target_path)
+                chunks, workers = container.chunk_count, container.workers
+            duration = max(time.monotonic() - started, 1e-6)
+            self.logger.info(f"Chunked container restored from {backup_path} to {target_path}: {size} bytes, "
+                             f"{chunks} chunks on {workers} workers in {duration:.2f}s "
+                             f"({size / duration / (1024 * 1024):.1f} MB/s)")
+            return True
+        except Exception as e:
+            self.logger.error(f"Container restore failed: {str(e)}")
+            return False
 
-            for backup_file in sorted(backup_files, reverse=True):
-                # Skip metadata files
-                if backup_file.suffix == '.meta':
-                    continue
+    def read_backup_pages(self, backup_path: Path, first_page: int, count: int = 1) -> bytes:
+        """
+        Pages first_page.. (numbered from 1) of the database in a chunked
+        container, reading only the chunks that hold them.
 
-                # Ensure we only process files that exist and are not directories
-                if not backup_file.is_file():
-                    continue
+        Raises:
+            ValueError: If the backup is not a container, or it cannot be read
+        """
+        if backup_path.suffix != CONTAINER_SUFFIX:
+            raise ValueError(f"Page ranges can only be read from {CONTAINER_SUFFIX} containers: {backup_path.name}")
+        with self._open_container(backup_path) as container:
+            return container.read_pages(first_page, count)
 
-                # Try to get file size safely
-                file_size = 0
-                try:
-                    file_size = backup_file.stat().st_size
-                except FileNotFoundError:
-                    self.logger.warning(f"File not found during list_backups, skipping: {backup_file}")
-                    continue # Skip if file disappeared
-
-                backup_info = {
-                    'path': backup_file,
-                    'name': backup_file.name,
-                    'size': file_size,
-                    'created': datetime.fromtimestamp(backup_file.stat().st_mtime),
-                    'compressed': backup_file.suffix == '.gz'
-                }
+    def _restore_encrypted_backup(self, backup_path: Path, target_path: Path) -> bool:
+        """
+        Restore from an encrypted backup (e.g. .db.gz.gpg or .db.gz.enc) in one streaming pass.
+
+        The decrypted stream (gpg's output pipe, or an envelope file opened
+        chunk by chunk on the aes-gcm engine's threads) feeds the
+        decompressor, which writes straight into target_path; no decrypted or
+        compressed copy is written in between. Time and throughput of each
+        stage (decrypt, decompress, write) are logged.
+        """
+        try:
+            inner = Path(backup_path.stem)
+            if inner.suffix in (MANIFEST_SUFFIX, CONTAINER_SUFFIX) or is_differential(inner):
+                self.logger.error(f"Encrypted {inner.suffix} backups cannot be restored: {backup_path.name}")
+                return False
+            codec = codec_for_path(inner)
+            buffer_size = int(self.config.get('BACKUP_STREAM_BUFFER_SIZE', 1024 * 1024))
+            if backup_path.suffix == ENVELOPE_SUFFIX:
+                decrypt_stream = self.envelope.open_decrypt_stream(backup_path)
+            else:
+                if self.gpg is None:
+                    self.gpg = GPGBackup(self.config)
+                decrypt_stream = self.gpg.open_decrypt_stream(backup_path, buffer_size)
+
+            started = time.monotonic()
+            write_seconds = 0.0
+            written = 0
+            with decrypt_stream as pipe:
+                decrypted = _TimedReader(pipe)
+                with codec.open_reader(decrypted) as f_in, target_path.open('wb') as f_out:
+                    for chunk in iter(lambda: f_in.read(buffer_size), b''):
+                        write_started = time.monotonic()
+                        f_out.write(chunk)
+                        write_seconds += time.monotonic() - write_started
+                        written += len(chunk)
+            total_seconds = time.monotonic() - started
+
+            def rate(size, seconds):
+                return f"{size / (1024 * 1024) / max(seconds, 1e-6):.1f} MB/s"
+            decompress_seconds = max(0.0, total_seconds - decrypted.seconds - write_seconds)
+            self.logger.info(
+                f"Encrypted ({codec.name}) database restored from {backup_path} to {target_path} in {total_seconds:.2f}s: "
+                f"decrypt {backup_path.stat().st_size} bytes waited {decrypted.seconds:.2f}s "
+                f"({rate(decrypted.bytes, decrypted.seconds)} out), "
+                f"decompress {decompress_seconds:.2f}s ({rate(written, decompress_seconds)} out), "
+                f"write {write_seconds:.2f}s ({rate(written, write_seconds)}); "
+                f"end to end {rate(written, total_seconds)}")
+            return True
+        except Exception as e:
+            self.logger.error(f"Encrypted restore failed: {str(e)}")
+            return False
 
-                # Load metadata if available
-                metadata_path = backup_file.with_suffix(backup_file.suffix + '.meta')
-                if metadata_path.exists():
-                    try:
-                        with metadata_path.open('r') as f:
-                            metadata = json.load(f)
-                        backup_info['metadata'] = metadata
-                    except Exception as e:
-                        self.logger.warning(f"Failed to load metadata for {backup_file}: {str(e)}")
+    def _restore_differential_backup(self, backup_path: Path, target_path: Path) -> bool:
+        """Restore the base full backup, then overlay the differential's pages"""
+        try:
+            with codec_for_path(backup_path).open_reader(backup_path) as f_in:
+                header = read_differential_header(f_in)
+                base_path = backup_path.parent / header['base_backup']
+                if not base_path.exists() or is_differential(base_path):
+                    self.logger.error(f"Base backup {header['base_backup']} of {backup_path.name} is missing")
+                    return False
+                if not self._restore_to(base_path, target_path):
+                    return False
+                apply_differential(f_in, header, target_path)
 
-                backups.append(backup_info)
+            self.logger.info(f"Differential database restored from {base_path.name} + {backup_path.name} "
+                             f"({header['changed_pages']} pages) to {target_path}")
+            return True
+        except Exception as e:
+            self.logger.error(f"Differential restore failed: {str(e)}")
+            return False
 
+    def _restore_dedup_backup(self, backup_path: Path, target_path: Path) -> bool:
+        """Reassemble a deduplicated backup from its manifest, checking every chunk"""
+        try:
+            with target_path.open('wb') as f_out:
+                written = self.chunk_store.restore(backup_path, f_out)
+            self.logger.info(f"Deduplicated database restored from {backup_path} to {target_path} ({written} bytes)")
+            return True
+        except Exception as e:
+            self.logger.error(f"Deduplicated restore failed: {str(e)}")
+            return False
+
+    def list_backups(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """List available backups with metadata, newest first (served from the catalog)"""
+        try:
+            self.catalog.sync()
+            return self.catalog.list(limit)
         except Exception as e:
             self.logger.error(f"Failed to list backups: {str(e)}")
+            return []
 
-        return backups
+    def get_backup_info(self, name: str) -> Optional[Dict[str, Any]]:
+        """Catalog entry of one backup by file name, or None"""
+        try:
+            self.catalog.sync()
+            return self.catalog.get(name)
+        except Exception as e:
+            self.logger.error(f"Failed to look up backup {name}: {str(e)}")
+            return None
 
-    def cleanup_old_backups(self, retention_days: Optional[int] = None) -> int:
+    def cleanup_old_backups(self, retention_days: Optional[int] = None, dry_run: bool = False,
+                            wait: bool = False) -> int:
         """
-        Clean up old backup files
+        Apply the grandfather-father-son retention policy (see backup_retention)
+
+        The plan is made here, in one pass over backup_dir; the deletions run
+        in background batches. The newest verified backup is always kept.
 
         Args:
-            retention_days: Days to retain backups (uses config default if None)
+            retention_days: Also keep every backup younger than this (policy's keep_within_days if None);
+                WAL archive generations older than it are pruned
+            dry_run: Only plan; nothing is deleted
+            wait: Block until the deletions have finished
 
         Returns:
-            Number of files deleted
+            Number of backups deleted, or planned for deletion when not waiting
         """
-        # Access BACKUP_RETENTION_DAYS from self.config
-        retention_days = retention_days or self.config.get('BACKUP_RETENTION_DAYS', 30) # Default to 30 if not in config
-        cutoff_date = datetime.now() - timedelta(days=retention_days)
-        deleted_count = 0
+        policy = RetentionPolicy.from_config(self.config)
+        if retention_days:
+            policy.keep_within_days = retention_days
+        wal_retention_days = (retention_days or self.config.get('MAX_BACKUP_AGE_DAYS')
+                              or self.config.get('BACKUP_RETENTION_DAYS', 30))
 
         try:
-            # Use self.app_paths.backup_dir
-            backup_files = list(self.app_paths.backup_dir.glob("backup_*"))
-
-            for backup_file in backup_files:
-                # Ensure it's a file before checking stat()
-                if not backup_file.is_file():
-                    continue
-
-                try:
-                    file_date = datetime.fromtimestamp(backup_file.stat().st_mtime)
-
-                    if file_date < cutoff_date:
-                        try:
-                            backup_file.unlink()
-                            deleted_count += 1
-                            self.logger.info(f"Deleted old backup: {backup_file}")
-
-                            # Also delete associated metadata file
-                            metadata_file = backup_file.with_suffix(backup_file.suffix + '.meta')
-                            if metadata_file.exists():
-                                metadata_file.unlink()
-
-                        except Exception as e:
-                            self.logger.error(f"Failed to delete {backup_file}: {str(e)}")
-                except FileNotFoundError:
-                    self.logger.warning(f"File not found during cleanup, skipping: {backup_file}")
-                    continue # Skip if file disappeared while iterating
-
-
-            self.logger.info(f"Cleanup completed: {deleted_count} files deleted")
+            plan = self.plan_retention(policy)
+            self.logger.info(f"Retention plan: {len(plan['keep'])} kept, {len(plan['delete'])} to delete "
+                             f"({plan['bytes_to_free']} bytes), {len(plan['orphans'])} orphaned sidecars"
+                             f"{' (dry run)' if dry_run else ''}")
+            if dry_run:
+                return len(plan['delete'])
+
+            if self.wal_archive_dir.exists():
+                current = self.wal_archiver.current_generation if self.wal_archiver else None
+                cutoff = datetime.now() - timedelta(days=wal_retention_days)
+                pruned = prune_generations(self.wal_archive_dir, cutoff.timestamp(), keep=current)
+                if pruned:
+                    self.logger.info(f"Pruned {pruned} WAL archive generations older than {wal_retention_days} days")
+
+            if (plan['delete'] or plan['orphans']) and self.retention.submit(plan) and wait:
+                self.retention.wait()
+                return self.retention.last_result['deleted']
+            return len(plan['delete'])
 
         except Exception as e:
             self.logger.error(f"Cleanup failed: {str(e)}")
+            return 0
+
+    def plan_retention(self, policy: Optional[RetentionPolicy] = None) -> Dict[str, Any]:
+        """Retention plan for backup_dir under 'policy' (BACKUP_RETENTION_* config if None); deletes nothing"""
+        protected = {}
+        self.catalog.sync()
+        last_verified = self.catalog.last_verified()
+        if last_verified:
+            protected[last_verified] = 'last verified'
+        return plan_retention(self.app_paths.backup_dir, policy or RetentionPolicy.from_config(self.config),
+                              protected)
+
+    def collect_chunk_garbage(self) -> Dict[str, int]:
+        """Remove chunks that no remaining dedup manifest references"""
+        if not self.chunk_store.root.exists():
+            return {'removed': 0, 'bytes_freed': 0, 'live': 0}
+        try:
+            # A dedup backup reuses chunks by touching them; holding the backup lock keeps one
+            # from touching (and referencing) a chunk that has already been judged unreferenced
+            with self.coordinator.locked():
+                manifests = list(self.app_paths.backup_dir.glob(f"backup_*{MANIFEST_SUFFIX}"))
+                result = self.chunk_store.collect_garbage(manifests)
+            self.catalog.add_chunk_usage(-result['removed'], -result['bytes_freed'])
+            self.logger.info(f"Chunk garbage collection: {result['removed']} chunks removed "
+                             f"({result['bytes_freed']} bytes), {result['live']} referenced")
+            return result
+        except Exception as e:
+            # An unreadable manifest must not let chunks it references be deleted
+            self.logger.error(f"Chunk garbage collection skipped: {str(e)}")
+            return {'removed': 0, 'bytes_freed': 0, 'live': 0}
 
-        return deleted_count
-
-    def verify_backup(self, backup_path: Path) -> bool:
+    def verify_backup(self, backup_path: Path, deep: bool = True) -> bool:
         """
         Verify backup file integrity
 
+        The fast tier re-hashes the file and compares it with the checksum
+        recorded when it was written; a chunked container instead checks its
+        chunks against its own index in parallel. The deep tier (default) also restores
+        it into temp_dir and opens it with sqlite3. A backup without a
+        recorded checksum always gets the deep check.
+
         Args:
             backup_path: Path to backup file to verify
+            deep: Run the full restore check, not just the checksum
 
         Returns:
             True if backup is valid
         """
+        if backup_path.exists():
+            checksum_ok = None
+            if backup_path.suffix == CONTAINER_SUFFIX:
+                checksum_ok = self.verify_container(backup_path)
+            if checksum_ok is None:
+                checksum_ok = self.verify_checksum(backup_path)
+            if checksum_ok is False:
+                return False
+            if not deep:
+                if checksum_ok:
+                    return True
+                self.logger.info(f"No recorded checksum for {backup_path.name}; running the deep check")
+
         try:
             if not backup_path.exists():
                 self.logger.error(f"Backup file not found for verification: {backup_path}")
@@ -442,7 +1890,7 @@ class DatabaseBackup:
             self.app_paths.temp_dir.mkdir(parents=True, exist_ok=True) # Ensure temp dir exists
 
             # Try to restore to temporary location
-            if self.restore_backup(backup_path, temp_file):
+            if self._restore_to(backup_path, temp_file):
                 # Try to open and query the restored database
                 try:
                     conn = sqlite3.connect(str(temp_file))
@@ -455,8 +1903,11 @@ class DatabaseBackup:
                     if temp_file.exists():
                         temp_file.unlink()
 
+                    if not tables:
+                        return False  # Valid only if it has tables
+                    self._mark_verified(backup_path)
                     self.logger.info(f"Backup verification successful: {backup_path}")
-                    return len(tables) > 0  # Valid if has tables
+                    return True
 
                 except Exception as e:
                     self.logger.error(f"Database verification failed for {backup_path}: {str(e)}")
@@ -471,12 +1922,105 @@ class DatabaseBackup:
             self.logger.error(f"Backup verification error: {str(e)}")
             return False
 
+    def verify_checksum(self, backup_path: Path) -> Optional[bool]:
+        """
+        Fast verification: re-hash the file and compare with the checksum in its metadata.
+
+        Returns:
+            True if it matches, False if it does not, None if no checksum was recorded
+        """
+        metadata = self._read_metadata(backup_path)
+        expected = metadata.get('checksum')
+        algorithm = metadata.get('checksum_algorithm', CHECKSUM_ALGORITHM)
+        if not expected:
+            return None
+        started = time.monotonic()
+        actual = file_checksum(backup_path, algorithm)
+        if actual != expected:
+            self.logger.error(f"Checksum mismatch for {backup_path}: expected {expected}, got {actual}")
+            return False
+        self.logger.info(f"Checksum verified for {backup_path.name} in {time.monotonic() - started:.2f}s")
+        self._update_metadata(backup_path, checksum_verified_at=datetime.now().isoformat())
+        return True
+
+    def verify_container(self, backup_path: Path) -> Optional[bool]:
+        """
+        Fast verification of a chunked container: every chunk's stored bytes
+        against the container's own index, hashed in parallel.
+
+        Returns:
+            True if all match, False if not, None if the index cannot be read
+            here (an encrypted container and no private key for it)
+        """
+        started = time.monotonic()
+        try:
+            encryption = read_container_header(backup_path).get('encryption')
+            if encryption:
+                try:
+                    self.envelope.unwrap_data_key(encryption, backup_path.name)
+                except ValueError as e:
+                    self.logger.info(f"Chunk index of {backup_path.name} not readable here ({str(e)}); "
+                                     f"using the recorded checksum")
+                    return None
+            with self._open_container(backup_path) as container:
+                result = container.verify(deep=False)
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Container verification failed for {backup_path}: {str(e)}")
+            return False
+        if not result['ok']:
+            self.logger.error(f"Container verification failed for {backup_path}: {result['error']}")
+            return False
+        self.logger.info(f"Container verified for {backup_path.name}: {result['chunks']} chunks "
+                         f"in {time.monotonic() - started:.2f}s")
+        self._update_metadata(backup_path, checksum_verified_at=datetime.now().isoformat())
+        return True
+
+    def backup_checksum(self, backup_path: Path) -> Optional[str]:
+        """Checksum of a backup file: from its metadata when recorded, otherwise computed"""
+        metadata = self._read_metadata(backup_path)
+        if metadata.get('checksum') and metadata.get('checksum_algorithm', CHECKSUM_ALGORITHM) == CHECKSUM_ALGORITHM:
+            return metadata['checksum']
+        try:
+            return file_checksum(backup_path)
+        except OSError as e:
+            self.logger.warning(f"Could not checksum {backup_path}: {str(e)}")
+            return None
+
+    def _read_metadata(self, backup_path: Path) -> Dict[str, Any]:
+        try:
+            with backup_path.with_suffix(backup_path.suffix + '.meta').open('r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _mark_verified(self, backup_path: Path):
+        """Record a successful deep verification (retention never deletes the newest verified backup)"""
+        self._update_metadata(backup_path, verified_at=datetime.now().isoformat())
+
+    def _update_metadata(self, backup_path: Path, **fields):
+        """Merge fields into a backup's .meta sidecar (written atomically) and refresh its catalog entry"""
+        metadata_path = backup_path.with_suffix(backup_path.suffix + '.meta')
+        try:
+            metadata = {}
+            if metadata_path.exists():
+                with metadata_path.open('r') as f:
+                    metadata = json.load(f)
+            metadata.update(fields)
+            temp_path = metadata_path.with_name(metadata_path.name + '.tmp')
+            with temp_path.open('w') as f:
+                json.dump(metadata, f, indent=2)
+            os.replace(temp_path, metadata_path)
+            self.catalog.upsert(backup_path)
+        except Exception as e:
+            self.logger.warning(f"Failed to update metadata of {backup_path}: {str(e)}")
+
     def get_backup_stats(self) -> Dict[str, Any]:
-        """Get backup statistics"""
+        """Get backup statistics (from the catalog's running totals; backup_dir is only stat'ed when unchanged)"""
         try:
-            backups = self.list_backups()
+            self.catalog.sync()
+            summary = self.catalog.summary()
 
-            if not backups:
+            if not summary['total_backups']:
                 return {
                     'total_backups': 0,
                     'total_size': 0,
@@ -485,32 +2029,35 @@ class DatabaseBackup:
                     'compressed_count': 0
                 }
 
-            total_size = sum(backup['size'] for backup in backups)
-            compressed_count = sum(1 for backup in backups if backup['compressed'])
-
-            # Ensure datetime objects for oldest/newest are handled to avoid errors
-            oldest_backup_date = None
-            newest_backup_date = None
-            if backups:
-                dates = [b['created'] for b in backups]
-                if dates:
-                    oldest_backup_date = min(dates)
-                    newest_backup_date = max(dates)
-
-            return {
-                'total_backups': len(backups),
-                'total_size': total_size,
-                'total_size_mb': round(total_size / (1024 * 1024), 2),
-                'oldest_backup': oldest_backup_date,
-                'newest_backup': newest_backup_date,
-                'compressed_count': compressed_count,
-                'uncompressed_count': len(backups) - compressed_count
-            }
+            # Dedup manifests are tiny; their data is counted once, in the chunk store
+            total_size = summary['total_size'] + summary['chunk_bytes']
+
+            return dict(
+                summary,
+                total_size=total_size,
+                total_size_mb=round(total_size / (1024 * 1024), 2),
+                uncompressed_count=summary['total_backups'] - summary['compressed_count'],
+                chunk_store_size=summary['chunk_bytes'],
+                recovery_window=self.get_recovery_window()
+            )
 
         except Exception as e:
             self.logger.error(f"Failed to get backup stats: {str(e)}")
             return {}
 
+    def reconcile_stats(self) -> Dict[str, Any]:
+        """
+        Recompute the running backup totals from backup_dir and the chunk store.
+
+        The totals are updated as backups are written and deleted; this
+        corrects any drift from files changed behind the app's back or
+        updates lost to a crash.
+        """
+        result = self.catalog.reconcile(self.chunk_store.disk_usage())
+        self.logger.info(f"Backup stats reconciled: {result['sync']['updated']} updated, "
+                         f"{result['sync']['removed']} removed, {len(result['drift'])} totals corrected")
+        return result
+
 
 # Convenience functions for easy access (These are designed for standalone use or where app.config isn't available)
 def create_backup_convenience(compress=True) -> Optional[Path]: # Renamed to avoid confusion with class method
@@ -545,7 +2092,7 @@ if __name__ == "__main__":
     import sys
 
     if len(sys.argv) < 2:
-        print("Usage: python backup.py [create|restore|list|cleanup|verify]")
+        print("Usage: python backup.py [create|restore|restore-pitr|list|reindex|cleanup [--dry-run]|verify [--fast]|verify-all [--fast]|keygen RECIPIENT|extract-pages BACKUP FIRST COUNT OUTPUT]")
         sys.exit(1)
 
     command = sys.argv[1].lower()
@@ -577,6 +2124,7 @@ if __name__ == "__main__":
             self['LOG_LEVEL'] = 'INFO' # Default for CLI logging
             self['LOG_FORMAT'] = '%(asctime)s %(levelname)s: %(message)s'
             self['BACKUP_RETENTION_DAYS'] = 30 # Default for CLI cleanup
+            self['BACKUP_ENCRYPTION_KEY_PASSPHRASE'] = os.environ.get('BACKUP_ENCRYPTION_KEY_PASSPHRASE') # aes-gcm private keys
 
     # Instantiate with the CLI-specific config
     cli_config = CliConfigDict()
@@ -590,15 +2138,63 @@ if __name__ == "__main__":
                 format_idx = sys.argv.index('--format')
                 backup_format_cli = sys.argv[format_idx + 1]
             except (ValueError, IndexError):
-                print("Error: --format requires a value (e.g., zip, gz, json, csv)")
+                print("Error: --format requires a value (e.g., zip, gz, bz2, xz, db, dedup, chunked)")
+                sys.exit(1)
+
+        backup_type_cli = 'manual'
+        if '--type' in sys.argv:
+            try:
+                backup_type_cli = sys.argv[sys.argv.index('--type') + 1]
+            except IndexError:
+                print("Error: --type requires a value (e.g., manual, differential)")
+                sys.exit(1)
+
+        backup_level_cli = None
+        if '--level' in sys.argv:
+            try:
+                backup_level_cli = parse_level(sys.argv[sys.argv.index('--level') + 1])
+            except (ValueError, IndexError):
+                print("Error: --level requires a number (gzip/bz2 1-9, xz 0-9) or 'auto'")
+                sys.exit(1)
+
+        encrypt_to_cli = None
+        if '--encrypt' in sys.argv:
+            try:
+                encrypt_to_cli = sys.argv[sys.argv.index('--encrypt') + 1]
+            except IndexError:
+                print("Error: --encrypt requires a recipient (e.g., backups@example.com; comma separated for several)")
+                sys.exit(1)
+
+        encryption_engine_cli = None
+        if '--engine' in sys.argv:
+            try:
+                encryption_engine_cli = sys.argv[sys.argv.index('--engine') + 1]
+            except IndexError:
+                print(f"Error: --engine requires a value ({', '.join(DatabaseBackup.ENCRYPTION_ENGINES)})")
                 sys.exit(1)
 
-        backup_path = backup_manager.create_backup(format=backup_format_cli, include_attachments=False)
+        if '--no-stream' in sys.argv:
+            cli_config['BACKUP_STREAMING_ENABLED'] = False # Force the temp-file path for comparison
+
+        backup_path = backup_manager.create_backup(format=backup_format_cli, include_attachments=False,
+                                                   backup_type=backup_type_cli, level=backup_level_cli,
+                                                   encrypt_to=encrypt_to_cli, encryption_engine=encryption_engine_cli)
         if backup_path:
             print(f"Backup created: {backup_path}")
         else:
             print("Backup creation failed")
 
+    elif command == "keygen" and len(sys.argv) > 2:
+        # Key pair for the aes-gcm engine; the private key is only needed where backups are restored
+        try:
+            key_files = backup_manager.envelope.generate_keypair(
+                sys.argv[2], passphrase=cli_config.get('BACKUP_ENCRYPTION_KEY_PASSPHRASE'))
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        print(f"Public key: {key_files['public_key']}")
+        print(f"Private key: {key_files['private_key']}")
+
     elif command == "list":
         backups = backup_manager.list_backups()
         if backups:
@@ -609,9 +2205,18 @@ if __name__ == "__main__":
         else:
             print("No backups found")
 
+    elif command == "reindex":
+        result = backup_manager.reconcile_stats()
+        print(f"Catalog rebuilt: {result['sync']['updated']} updated, {result['sync']['removed']} removed, "
+              f"{len(result['drift'])} totals corrected")
+
     elif command == "cleanup":
-        deleted = backup_manager.cleanup_old_backups()
-        print(f"Deleted {deleted} old backup files")
+        if '--dry-run' in sys.argv[2:]:
+            for line in format_plan(backup_manager.plan_retention()):
+                print(line)
+        else:
+            deleted = backup_manager.cleanup_old_backups(wait=True)
+            print(f"Deleted {deleted} old backup files")
 
     elif command == "restore" and len(sys.argv) > 2:
         backup_path = Path(sys.argv[2])
@@ -620,12 +2225,45 @@ if __name__ == "__main__":
         else:
             print("Restore failed")
 
+    elif command == "restore-pitr" and len(sys.argv) > 2:
+        try:
+            point_in_time = datetime.fromisoformat(sys.argv[2])
+        except ValueError:
+            print("Error: restore-pitr needs an ISO timestamp (e.g., 2024-05-01T13:45:00)")
+            sys.exit(1)
+        window = backup_manager.get_recovery_window()
+        if window:
+            print(f"Recovery window: {window['earliest'].isoformat()} to {window['latest'].isoformat()}")
+        if backup_manager.restore_point_in_time(point_in_time):
+            print(f"Database restored to {point_in_time.isoformat()}")
+        else:
+            print("Point-in-time restore failed")
+
     elif command == "verify" and len(sys.argv) > 2:
         backup_path = Path(sys.argv[2])
-        if backup_manager.verify_backup(backup_path):
+        if backup_manager.verify_backup(backup_path, deep='--fast' not in sys.argv[3:]):
             print(f"Backup verified: {backup_path}")
         else:
             print(f"Backup verification failed: {backup_path}")
 
+    elif command == "extract-pages" and len(sys.argv) > 5:
+        # Pull a page range out of a chunked container without restoring it
+        try:
+            pages = backup_manager.read_backup_pages(Path(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        Path(sys.argv[5]).write_bytes(pages)
+        print(f"Wrote {len(pages)} bytes to {sys.argv[5]}")
+
+    elif command == "verify-all":
+        def print_result(result):
+            detail = f" ({result['error']})" if result['error'] else ''
+            print(f"  {result['status']:8} {result['name']} - {result['duration_seconds']}s{detail}")
+        backup_manager.verifier.verify_all(deep='--fast' not in sys.argv[2:], on_result=print_result)
+        progress = backup_manager.verifier.progress
+        print(f"Verified {progress['total']} backups in {progress['duration_seconds']}s: {progress['ok']} ok, "
+              f"{progress['failed']} failed, {progress['skipped']} skipped")
+
     else:
         print("Invalid command or missing arguments")
\ No newline at end of file
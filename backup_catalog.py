@@ -0,0 +1,346 @@
+"""
+Backup Catalog
+Persistent SQLite index of the backups in backup_dir, so listing, stats
+and lookups by name do not scan the directory or parse every .meta file
+"""
+
+import json
+import os
+import sqlite3
+from contextlib import closing, contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Dict, List, Any
+
+from backup_compression import codec_for_path
+from backup_container import CONTAINER_SUFFIX
+from backup_dedup import MANIFEST_SUFFIX
+from backup_differential import PAGE_HASH_SUFFIX, is_differential
+from utils.encryption import ENVELOPE_SUFFIX
+
+
+CATALOG_FILE = 'catalog.db'
+# Bumped whenever the schema changes; an older catalog is dropped and rebuilt by the next sync
+SCHEMA_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    meta_mtime_ns INTEGER,
+    created REAL NOT NULL,
+    codec TEXT NOT NULL,
+    compressed INTEGER NOT NULL,
+    dedup INTEGER NOT NULL,
+    differential INTEGER NOT NULL,
+    encrypted INTEGER NOT NULL,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS backups_created ON backups (created);
+CREATE TABLE IF NOT EXISTS catalog_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+-- Running totals over 'backups' (single row), kept current by the triggers below
+CREATE TABLE IF NOT EXISTS catalog_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    total INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0,
+    compressed INTEGER NOT NULL DEFAULT 0,
+    dedup INTEGER NOT NULL DEFAULT 0,
+    differential INTEGER NOT NULL DEFAULT 0,
+    encrypted INTEGER NOT NULL DEFAULT 0,
+    chunks INTEGER NOT NULL DEFAULT 0,
+    chunk_bytes INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO catalog_totals (id) VALUES (1);
+CREATE TRIGGER IF NOT EXISTS backups_totals_insert AFTER INSERT ON backups BEGIN
+    UPDATE catalog_totals SET total = total + 1, size = size + NEW.size,
+        compressed = compressed + NEW.compressed, dedup = dedup + NEW.dedup,
+        differential = differential + NEW.differential, encrypted = encrypted + NEW.encrypted;
+END;
+CREATE TRIGGER IF NOT EXISTS backups_totals_delete AFTER DELETE ON backups BEGIN
+    UPDATE catalog_totals SET total = total - 1, size = size - OLD.size,
+        compressed = compressed - OLD.compressed, dedup = dedup - OLD.dedup,
+        differential = differential - OLD.differential, encrypted = encrypted - OLD.encrypted;
+END;
+CREATE TRIGGER IF NOT EXISTS backups_totals_update AFTER UPDATE ON backups BEGIN
+    UPDATE catalog_totals SET size = size - OLD.size + NEW.size,
+        compressed = compressed - OLD.compressed + NEW.compressed, dedup = dedup - OLD.dedup + NEW.dedup,
+        differential = differential - OLD.differential + NEW.differential,
+        encrypted = encrypted - OLD.encrypted + NEW.encrypted;
+END;
+"""
+
+ENCRYPTED_SUFFIX = '.gpg'
+# Suffixes of encrypted backups: gpg and the aes-gcm envelope engine
+ENCRYPTED_SUFFIXES = (ENCRYPTED_SUFFIX, ENVELOPE_SUFFIX)
+
+_COLUMNS = 'name, size, mtime_ns, meta_mtime_ns, created, codec, compressed, dedup, differential, encrypted, metadata'
+
+
+def is_backup_file_name(name: str) -> bool:
+    """True for backup files themselves (not .meta/.pages sidecars or files still being written)"""
+    return (name.startswith('backup_') and '.db' in name
+            and not name.endswith(('.meta', PAGE_HASH_SUFFIX, '.tmp')))
+
+
+def backup_time(backup_path: Path, stat: os.stat_result, metadata: Optional[Dict[str, Any]] = None) -> float:
+    """
+    When a backup was taken, as a timestamp: its mtime, except for names
+    hard-linked to an earlier backup of an unchanged database (see
+    DatabaseBackup._reuse_unchanged_backup). Those share the earlier
+    backup's inode and mtime and are dated by created_at in their own .meta,
+    read here only when the link count says so unless already loaded.
+    """
+    if stat.st_nlink > 1:
+        if metadata is None:
+            try:
+                with backup_path.with_suffix(backup_path.suffix + '.meta').open('r') as f:
+                    metadata = json.load(f)
+            except (OSError, ValueError):
+                metadata = {}
+        try:
+            return datetime.fromisoformat(metadata['created_at']).timestamp()
+        except (KeyError, TypeError, ValueError):
+            pass
+    return stat.st_mtime
+
+
+class BackupCatalog:
+    """
+    Index of backup files kept in backup_dir/catalog.db.
+
+    DatabaseBackup updates it when it creates or deletes a backup. Anything
+    else that touches backup_dir (GPG output, manual copies, other hosts) is
+    picked up by sync(): it costs one stat of the directory when nothing was
+    added or removed, and otherwise one os.scandir pass that re-reads .meta
+    files only for entries whose size or mtime changed. The catalog itself
+    must not add or remove entries there on reads (see _connect).
+
+    Counts and sizes are running totals maintained by triggers in the same
+    transaction as each row change, so summary() reads one row plus the
+    ends of the 'created' index. reconcile() recomputes them from scratch.
+    """
+
+    def __init__(self, backup_dir: Path, logger):
+        self.backup_dir = Path(backup_dir)
+        self.path = self.backup_dir / CATALOG_FILE
+        self.logger = logger
+        with closing(self._connect()) as conn, conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                # Everything here can be rebuilt from backup_dir
+                conn.executescript("DROP TABLE IF EXISTS backups; DROP TABLE IF EXISTS catalog_state; "
+                                   "DROP TABLE IF EXISTS catalog_totals;")
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        # Not WAL: every WAL connection creates and removes -wal/-shm in backup_dir, which moves the
+        # directory mtime sync() relies on. A truncated rollback journal is created once and kept.
+        conn.execute("PRAGMA journal_mode=TRUNCATE")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # --- Updates ---
+
+    def upsert(self, backup_path: Path):
+        """Add or refresh one backup (call after its .meta has been written)"""
+        with closing(self._connect()) as conn, conn:
+            self._upsert(conn, Path(backup_path))
+
+    def remove(self, name: str):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM backups WHERE name = ?", (name,))
+
+    @contextmanager
+    def transaction(self):
+        """Connection whose changes are committed together on exit (rolled back on error)"""
+        with closing(self._connect()) as conn, conn:
+            yield conn
+
+    def last_verified(self) -> Optional[str]:
+        """Name of the newest backup whose metadata records a successful verification"""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT name FROM backups WHERE json_extract(metadata, '$.verified_at') IS NOT NULL "
+                               "ORDER BY created DESC LIMIT 1").fetchone()
+        return row['name'] if row else None
+
+    def _upsert(self, conn: sqlite3.Connection, backup_path: Path, stat: Optional[os.stat_result] = None):
+        try:
+            stat = stat or backup_path.stat()
+        except FileNotFoundError:
+            conn.execute("DELETE FROM backups WHERE name = ?", (backup_path.name,))
+            return
+        metadata_path = backup_path.with_suffix(backup_path.suffix + '.meta')
+        metadata, meta_mtime_ns, fields = None, None, {}
+        try:
+            meta_mtime_ns = metadata_path.stat().st_mtime_ns
+            with metadata_path.open('r') as f:
+                metadata = f.read()
+            fields = json.loads(metadata)
+        except FileNotFoundError:
+            metadata = None
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Failed to load metadata for {backup_path}: {str(e)}")
+            metadata = None
+        # A container's encryption is inside it, so only its metadata tells
+        encrypted = backup_path.suffix in ENCRYPTED_SUFFIXES or bool(fields.get('encrypted'))
+        # Containers keep the codec's extension under .bkc
+        codec = codec_for_path(backup_path.stem if backup_path.suffix == CONTAINER_SUFFIX else backup_path)
+        # An upsert rather than INSERT OR REPLACE: REPLACE deletes without firing the totals trigger
+        conn.execute(
+            f"INSERT INTO backups ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, "
+            "meta_mtime_ns = excluded.meta_mtime_ns, created = excluded.created, codec = excluded.codec, "
+            "compressed = excluded.compressed, dedup = excluded.dedup, differential = excluded.differential, "
+            "encrypted = excluded.encrypted, metadata = excluded.metadata",
+            (backup_path.name, stat.st_size, stat.st_mtime_ns, meta_mtime_ns, backup_time(backup_path, stat, fields),
+             codec.name,
+             int(codec.compresses), int(backup_path.suffix == MANIFEST_SUFFIX), int(is_differential(backup_path)),
+             int(encrypted), metadata)
+        )
+
+    def sync(self, force: bool = False) -> Dict[str, int]:
+        """
+        Bring the catalog in line with backup_dir.
+
+        Skipped when the directory mtime matches the last sync (entries were
+        neither added, removed nor renamed), unless force is set.
+
+        Returns:
+            Dict with the number of entries added/updated and removed
+        """
+        result = {'updated': 0, 'removed': 0}
+        # Taken before the scan, so changes made while scanning trigger the next sync
+        dir_mtime = str(os.stat(self.backup_dir).st_mtime_ns)
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT value FROM catalog_state WHERE key = 'dir_mtime_ns'").fetchone()
+            if not force and row and row['value'] == dir_mtime:
+                return result
+
+            on_disk: Dict[str, os.stat_result] = {}
+            meta_mtimes: Dict[str, int] = {}
+            with os.scandir(self.backup_dir) as entries:
+                for entry in entries:
+                    if not entry.name.startswith('backup_') or not entry.is_file():
+                        continue
+                    try:
+                        if entry.name.endswith('.meta'):
+                            meta_mtimes[entry.name[:-len('.meta')]] = entry.stat().st_mtime_ns
+                        elif is_backup_file_name(entry.name):
+                            on_disk[entry.name] = entry.stat()
+                    except FileNotFoundError:
+                        continue
+
+            known = {r['name']: (r['size'], r['mtime_ns'], r['meta_mtime_ns'])
+                     for r in conn.execute("SELECT name, size, mtime_ns, meta_mtime_ns FROM backups")}
+            for name in known.keys() - on_disk.keys():
+                conn.execute("DELETE FROM backups WHERE name = ?", (name,))
+                result['removed'] += 1
+            for name, stat in on_disk.items():
+                if known.get(name) != (stat.st_size, stat.st_mtime_ns, meta_mtimes.get(name)):
+                    self._upsert(conn, self.backup_dir / name, stat)
+                    result['updated'] += 1
+
+            conn.execute("INSERT OR REPLACE INTO catalog_state (key, value) VALUES ('dir_mtime_ns', ?)", (dir_mtime,))
+        if result['updated'] or result['removed']:
+            self.logger.debug(f"Catalog sync: {result['updated']} updated, {result['removed']} removed")
+        return result
+
+    # --- Queries ---
+
+    def _to_info(self, row: sqlite3.Row) -> Dict[str, Any]:
+        info = {
+            'path': self.backup_dir / row['name'],
+            'name': row['name'],
+            'size': row['size'],
+            'created': datetime.fromtimestamp(row['created']),
+            'compressed': bool(row['compressed']),
+            'codec': row['codec'],
+            'dedup': bool(row['dedup']),
+            'differential': bool(row['differential']),
+            'encrypted': bool(row['encrypted'])
+        }
+        if row['metadata']:
+            info['metadata'] = json.loads(row['metadata'])
+        return info
+
+    def list(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Backups, newest first"""
+        query = f"SELECT {_COLUMNS} FROM backups ORDER BY created DESC, name DESC"
+        params: tuple = ()
+        if limit is not None:
+            query += " LIMIT ?"
+            params = (limit,)
+        with closing(self._connect()) as conn:
+            return [self._to_info(row) for row in conn.execute(query, params)]
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(f"SELECT {_COLUMNS} FROM backups WHERE name = ?", (name,)).fetchone()
+        return self._to_info(row) if row else None
+
+    def summary(self) -> Dict[str, Any]:
+        """Counts, total size and date range of the catalogued backups"""
+        with closing(self._connect()) as conn:
+            totals = conn.execute("SELECT * FROM catalog_totals WHERE id = 1").fetchone()
+            # MIN/MAX on an indexed column are single index seeks
+            oldest = conn.execute("SELECT MIN(created) FROM backups").fetchone()[0]
+            newest = conn.execute("SELECT MAX(created) FROM backups").fetchone()[0]
+        return {
+            'total_backups': totals['total'],
+            'total_size': totals['size'],
+            'oldest_backup': datetime.fromtimestamp(oldest) if oldest is not None else None,
+            'newest_backup': datetime.fromtimestamp(newest) if newest is not None else None,
+            'compressed_count': totals['compressed'],
+            'dedup_count': totals['dedup'],
+            'differential_count': totals['differential'],
+            'encrypted_count': totals['encrypted'],
+            'chunk_count': totals['chunks'],
+            'chunk_bytes': totals['chunk_bytes']
+        }
+
+    # --- Chunk store usage ---
+
+    def add_chunk_usage(self, chunks: int, size: int):
+        """Record chunks written to (positive) or removed from (negative) the dedup chunk store"""
+        if chunks or size:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("UPDATE catalog_totals SET chunks = chunks + ?, chunk_bytes = chunk_bytes + ? "
+                             "WHERE id = 1", (chunks, size))
+
+    # --- Reconciliation ---
+
+    def reconcile(self, chunk_usage: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+        """
+        Resync with backup_dir and recompute the running totals from the rows.
+
+        Args:
+            chunk_usage: Measured chunk store usage ({'chunks', 'bytes'}); kept as is when None
+
+        Returns:
+            Dict with the sync result and the totals that had drifted (old, new)
+        """
+        result = {'sync': self.sync(force=True), 'drift': {}}
+        with closing(self._connect()) as conn, conn:
+            # BEGIN IMMEDIATE: no backup may be added between the recount and the write
+            conn.execute("BEGIN IMMEDIATE")
+            before = dict(conn.execute("SELECT * FROM catalog_totals WHERE id = 1").fetchone())
+            after = dict(conn.execute(
+                "SELECT 1 AS id, COUNT(*) AS total, COALESCE(SUM(size), 0) AS size, "
+                "COALESCE(SUM(compressed), 0) AS compressed, COALESCE(SUM(dedup), 0) AS dedup, "
+                "COALESCE(SUM(differential), 0) AS differential, COALESCE(SUM(encrypted), 0) AS encrypted "
+                "FROM backups"
+            ).fetchone())
+            after['chunks'] = chunk_usage['chunks'] if chunk_usage else before['chunks']
+            after['chunk_bytes'] = chunk_usage['bytes'] if chunk_usage else before['chunk_bytes']
+            conn.execute("UPDATE catalog_totals SET total = :total, size = :size, compressed = :compressed, "
+                         "dedup = :dedup, differential = :differential, encrypted = :encrypted, "
+                         "chunks = :chunks, chunk_bytes = :chunk_bytes WHERE id = 1", after)
+        result['drift'] = {key: (before[key], after[key]) for key in after if before[key] != after[key]}
+        if result['drift']:
+            self.logger.warning(f"Catalog totals had drifted: {result['drift']}")
+        return result
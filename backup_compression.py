@@ -0,0 +1,614 @@
+"""
+Backup Compression Helpers
+Codec registry (gzip/bz2/lzma/none), block-parallel writers for backup
+files, inline checksums, adaptive level selection, plus a small benchmark CLI
+"""
+
+import bz2
+import collections
+import functools
+import gzip
+import hashlib
+import json
+import lzma
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, Union, Callable, Dict, List, Tuple, Any
+
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# Algorithm of backup checksums (BackupRecord.checksum holds its 64 hex digits)
+CHECKSUM_ALGORITHM = 'sha256'
+CHECKSUM_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Level value that asks CompressionTuner to pick the level
+AUTO_LEVEL = 'auto'
+
+
+def default_compression_threads() -> int:
+    """Number of compression threads to use when the config says 'auto' (0)"""
+    return os.cpu_count() or 1
+
+
+class ChecksumFile:
+    """
+    Binary output file that hashes every byte written to it.
+
+    Codec writers are stacked on top of it, so a backup's checksum is that of
+    the bytes on disk and costs no second read. close() is idempotent; the
+    digest stays available afterwards.
+    """
+
+    def __init__(self, path: Union[str, Path], algorithm: str = CHECKSUM_ALGORITHM):
+        self.name = str(path) # gzip records the file name in its header, as with a path
+        self.algorithm = algorithm
+        self.size = 0
+        self._hash = hashlib.new(algorithm)
+        self._file = open(path, 'wb')
+
+    def write(self, data) -> int:
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def tell(self) -> int:
+        return self.size
+
+    def writable(self) -> bool:
+        return True
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def close(self):
+        self._file.close()
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def file_checksum(path: Union[str, Path], algorithm: str = CHECKSUM_ALGORITHM,
+                  buffer_size: int = CHECKSUM_BUFFER_SIZE) -> str:
+    """Hex digest of a file, read sequentially into one reused buffer"""
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+
+def _open_input(target):
+    """Binary input for a path, or the file object given"""
+    return target if hasattr(target, 'read') else open(target, 'rb')
+
+
+def _open_output(target):
+    """Binary output for a path, or the file object given; returns (file, owned)"""
+    if hasattr(target, 'write'):
+        return target, False
+    return open(target, 'wb'), True
+
+
+class ParallelBlockWriter:
+    """
+    Write a compressed file as a series of independently compressed blocks.
+
+    Input is cut into fixed-size blocks and each block becomes a complete
+    stream/member of the codec, compressed on a thread pool (zlib, bz2 and
+    lzma all release the GIL) or, optionally, a process pool. Blocks are
+    written in input order with at most two per worker in flight, which
+    bounds memory. gzip, bz2 and xz readers all decompress the concatenated
+    streams as one.
+    """
+
+    def __init__(self, path, compress_block: Callable[[bytes], bytes], threads: Optional[int] = None,
+                 block_size: int = DEFAULT_BLOCK_SIZE, executor: str = 'thread'):
+        self.compress_block = compress_block
+        self.threads = max(1, threads or default_compression_threads())
+        self.block_size = max(64 * 1024, block_size)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        # A path, or a binary file object that stays open (e.g. a ChecksumFile)
+        self._file, self._owns_file = _open_output(path)
+        if executor == 'process':
+            # spawn, not fork: the app process has threads (and their locks) we must not copy
+            self._executor = ProcessPoolExecutor(max_workers=self.threads,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='compress-block')
+        self._pending = collections.deque()
+        self._max_pending = self.threads * 2
+        self._buffer = bytearray()
+        self._blocks = 0
+        self._closed = False
+
+    def write(self, data) -> int:
+        if self._closed:
+            raise ValueError("write to closed ParallelBlockWriter")
+        self._buffer += data
+        self.bytes_in += len(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def _submit(self, block: bytes):
+        self._pending.append(self._executor.submit(self.compress_block, block))
+        self._blocks += 1
+        while len(self._pending) >= self._max_pending:
+            self._write_block(self._pending.popleft().result())
+
+    def _write_block(self, compressed: bytes):
+        self._file.write(compressed)
+        self.bytes_out += len(compressed)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._buffer or self._blocks == 0:
+                # The final partial block; an empty input still gets one valid stream
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._write_block(self._pending.popleft().result())
+        finally:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            if self._owns_file:
+                self._file.close()
+
+    def abort(self):
+        """Stop without flushing pending blocks (the output is left incomplete)"""
+        self._closed = True
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        if self._owns_file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class ParallelGzipWriter(ParallelBlockWriter):
+    """Block-parallel writer producing a standard multi-member .gz file"""
+
+    def __init__(self, path, compresslevel: int = 9, threads: Optional[int] = None,
+                 block_size: int = DEFAULT_BLOCK_SIZE, executor: str = 'thread'):
+        # mtime=0 keeps members reproducible and takes zlib's one-shot path
+        super().__init__(path, functools.partial(gzip.compress, compresslevel=compresslevel, mtime=0),
+                         threads, block_size, executor)
+        self.compresslevel = compresslevel
+
+
+# --- Codec registry ---
+
+class Codec:
+    """
+    A compression codec that backups can be written with and restored from.
+
+    Subclasses set name, extension and level range and implement
+    open_stream_writer, open_reader and block_compressor. The codec of an
+    existing backup is found from its file extension (see codec_for_path).
+    """
+
+    name = 'none'
+    extension = ''
+    levels: range = range(0)
+    default_level: Optional[int] = None
+    auto_levels: Tuple[int, ...] = () # Levels sampled by CompressionTuner
+
+    @property
+    def compresses(self) -> bool:
+        return bool(self.extension)
+
+    def resolve_level(self, level: Optional[int]) -> Optional[int]:
+        """Return the level to use, validating an explicit one against the codec's range"""
+        if not self.levels:
+            return None
+        if level is None:
+            return self.default_level
+        if level not in self.levels:
+            raise ValueError(f"Invalid level {level} for {self.name}; "
+                             f"expected {self.levels.start}-{self.levels.stop - 1}")
+        return level
+
+    def open_writer(self, path, level: Optional[int] = None, threads: int = 1,
+                    block_size: int = DEFAULT_BLOCK_SIZE, executor: str = 'thread'):
+        """
+        Open a binary writer; block-parallel when more than one worker is requested.
+
+        'path' may also be a binary file object, which the writer leaves open.
+        """
+        level = self.resolve_level(level)
+        if self.compresses and threads > 1:
+            return ParallelBlockWriter(path, self.block_compressor(level), threads, block_size, executor)
+        return self.open_stream_writer(path, level)
+
+    def open_stream_writer(self, path, level: Optional[int]):
+        return _open_output(path)[0]
+
+    def open_reader(self, path):
+        """Open a binary reader; 'path' may also be a binary file object"""
+        return _open_input(path)
+
+    def block_compressor(self, level: Optional[int]) -> Callable[[bytes], bytes]:
+        """Picklable function turning one block into a complete compressed stream (identity for 'none')"""
+        return bytes
+
+    def block_decompressor(self) -> Callable[[bytes], bytes]:
+        """Inverse of block_compressor: one complete compressed stream back into its block"""
+        return bytes
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    extension = '.gz'
+    levels = range(1, 10)
+    default_level = 9 # gzip.open's default, as used by earlier backups
+    auto_levels = (1, 3, 6, 9)
+
+    def open_stream_writer(self, path, level):
+        return gzip.open(path, 'wb', compresslevel=level)
+
+    def open_reader(self, path):
+        return gzip.open(path, 'rb')
+
+    def block_compressor(self, level):
+        return functools.partial(gzip.compress, compresslevel=level, mtime=0)
+
+    def block_decompressor(self):
+        return gzip.decompress
+
+
+class Bz2Codec(Codec):
+    name = 'bz2'
+    extension = '.bz2'
+    levels = range(1, 10)
+    default_level = 9
+    auto_levels = (1, 5, 9)
+
+    def open_stream_writer(self, path, level):
+        return bz2.open(path, 'wb', compresslevel=level)
+
+    def open_reader(self, path):
+        return bz2.open(path, 'rb')
+
+    def block_compressor(self, level):
+        return functools.partial(bz2.compress, compresslevel=level)
+
+    def block_decompressor(self):
+        return bz2.decompress
+
+
+class LzmaCodec(Codec):
+    name = 'lzma'
+    extension = '.xz'
+    levels = range(0, 10)
+    default_level = 6 # lzma's own default preset
+    auto_levels = (0, 1, 3, 6)
+
+    def open_stream_writer(self, path, level):
+        return lzma.open(path, 'wb', preset=level)
+
+    def open_reader(self, path):
+        return lzma.open(path, 'rb')
+
+    def block_compressor(self, level):
+        return functools.partial(lzma.compress, preset=level)
+
+    def block_decompressor(self):
+        return lzma.decompress
+
+
+_CODECS: Dict[str, Codec] = {}
+
+# Backup formats offered by the UI/CLI and the codec each one maps to
+FORMAT_CODECS = {
+    'zip': 'gzip', # Historical UI name; backups have always been gzip
+    'gz': 'gzip',
+    'gzip': 'gzip',
+    'bz2': 'bz2',
+    'xz': 'lzma',
+    'lzma': 'lzma',
+    'db': 'none',
+    'none': 'none'
+}
+
+
+def register_codec(codec: Codec):
+    """Make a codec available to backup, restore, verify and listing"""
+    _CODECS[codec.name] = codec
+
+
+def get_codec(name: str) -> Codec:
+    """Look up a codec by name; raises ValueError for unknown names"""
+    try:
+        return _CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown compression codec: {name}. Available: {', '.join(available_codecs())}")
+
+
+def available_codecs() -> List[str]:
+    return list(_CODECS)
+
+
+def parse_level(value: Any) -> Optional[Union[int, str]]:
+    """Parse a level from config or a form: None, AUTO_LEVEL or an int"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value == AUTO_LEVEL:
+            return AUTO_LEVEL
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"Invalid compression level: {value!r}; expected a number or '{AUTO_LEVEL}'")
+    return int(value)
+
+
+def codec_for_format(format: str) -> Optional[Codec]:
+    """Codec for a backup format name, or None if the format is not a codec"""
+    name = FORMAT_CODECS.get((format or '').lower())
+    return _CODECS.get(name) if name else None
+
+
+def codec_for_path(path: Union[str, Path]) -> Codec:
+    """Codec a backup file was written with, judged by its extension"""
+    suffix = Path(path).suffix
+    for codec in _CODECS.values():
+        if codec.extension and codec.extension == suffix:
+            return codec
+    return _CODECS['none']
+
+
+for _codec in (Codec(), GzipCodec(), Bz2Codec(), LzmaCodec()):
+    register_codec(_codec)
+
+
+class CompressionTuner:
+    """
+    Choose a codec level that meets a time or throughput target with the best ratio.
+
+    Candidate levels (Codec.auto_levels) are measured by compressing a few
+    sample chunks of the source; the results go into a JSON history per codec
+    and level. Later runs reuse the history without sampling until it is older
+    than resample_hours, and every finished backup blends its achieved ratio
+    and throughput into the history of the level it used.
+
+    Throughput is kept per compression worker, so the same history serves any
+    BACKUP_COMPRESSION_THREADS setting.
+    """
+
+    # Weight of a new measurement when blended into the history
+    SMOOTHING = 0.3
+
+    def __init__(self, history_path: Union[str, Path], target_seconds: Optional[float] = None,
+                 target_mb_s: Optional[float] = None, sample_chunks: int = 4,
+                 sample_size: int = DEFAULT_BLOCK_SIZE, resample_hours: float = 24):
+        self.history_path = Path(history_path)
+        self.target_seconds = target_seconds or None
+        self.target_mb_s = target_mb_s or None
+        self.sample_chunks = max(1, sample_chunks)
+        self.sample_size = sample_size
+        self.resample_seconds = resample_hours * 3600
+        self._lock = threading.Lock()
+
+    def required_mb_s(self, source_size: int) -> Optional[float]:
+        """Throughput the backup needs to meet the configured target(s)"""
+        required = []
+        if self.target_seconds:
+            required.append(source_size / (1024 * 1024) / self.target_seconds)
+        if self.target_mb_s:
+            required.append(self.target_mb_s)
+        return max(required) if required else None
+
+    def choose_level(self, codec: Codec, read_sample: Callable[[int, int], bytes], source_size: int,
+                     workers: int = 1) -> Tuple[Optional[int], Dict[str, Any]]:
+        """
+        Pick the level for one backup.
+
+        Args:
+            codec: Codec the backup is written with
+            read_sample: Function (offset, length) -> bytes reading the source
+            source_size: Size of the source in bytes
+            workers: Number of compression workers the backup will use
+
+        Returns:
+            (level, details) where details says whether sampling ran and what was estimated
+        """
+        if not codec.auto_levels:
+            return codec.resolve_level(None), {'sampled': False}
+
+        with self._lock:
+            history = self._load()
+            entry = history.get(codec.name)
+            stale = (not entry or time.time() - entry.get('sampled_at', 0) > self.resample_seconds
+                     or any(str(level) not in entry.get('levels', {}) for level in codec.auto_levels))
+            if stale:
+                entry = {'sampled_at': time.time(), 'levels': self._sample(codec, read_sample, source_size)}
+                history[codec.name] = entry
+                self._save(history)
+
+        required = self.required_mb_s(source_size)
+        candidates = [(level, entry['levels'][str(level)]) for level in codec.auto_levels]
+        estimates = {level: round(stats['mb_s'] * max(1, workers), 2) for level, stats in candidates}
+
+        fitting = [(level, stats) for level, stats in candidates if required is None or estimates[level] >= required]
+        if fitting:
+            level = min(fitting, key=lambda item: (item[1]['ratio'], item[0]))[0]
+        else:
+            # Nothing meets the target; the fastest level gets closest
+            level = max(candidates, key=lambda item: item[1]['mb_s'])[0]
+
+        return level, {
+            'sampled': stale,
+            'required_mb_s': round(required, 2) if required else None,
+            'estimated_mb_s': estimates[level],
+            'estimated_ratio': entry['levels'][str(level)]['ratio'],
+            'met_target': bool(fitting)
+        }
+
+    def _sample(self, codec: Codec, read_sample: Callable[[int, int], bytes], source_size: int) -> Dict[str, Dict[str, float]]:
+        """Compress evenly spaced sample chunks at every candidate level"""
+        length = min(self.sample_size, source_size) or 1
+        span = max(source_size - length, 0)
+        offsets = sorted({span * i // max(self.sample_chunks - 1, 1) for i in range(self.sample_chunks)})
+        samples = [read_sample(offset, length) for offset in offsets]
+        total_in = sum(len(sample) for sample in samples) or 1
+
+        results = {}
+        for level in codec.auto_levels:
+            compress = codec.block_compressor(level)
+            started = time.perf_counter()
+            total_out = sum(len(compress(sample)) for sample in samples)
+            seconds = max(time.perf_counter() - started, 1e-6)
+            results[str(level)] = {
+                'ratio': round(total_out / total_in, 4),
+                'mb_s': round(total_in / seconds / (1024 * 1024), 2),
+                'samples': 1
+            }
+        return results
+
+    def record(self, codec: Codec, level: int, bytes_in: int, bytes_out: int, seconds: float, workers: int = 1):
+        """Blend the ratio and per-worker throughput of a finished backup into the history"""
+        if not bytes_in or seconds <= 0 or not codec.auto_levels:
+            return
+        ratio = bytes_out / bytes_in
+        mb_s = bytes_in / seconds / (1024 * 1024) / max(1, workers)
+        with self._lock:
+            history = self._load()
+            entry = history.setdefault(codec.name, {'sampled_at': 0, 'levels': {}})
+            stats = entry['levels'].get(str(level))
+            if stats:
+                stats['ratio'] = round((1 - self.SMOOTHING) * stats['ratio'] + self.SMOOTHING * ratio, 4)
+                stats['mb_s'] = round((1 - self.SMOOTHING) * stats['mb_s'] + self.SMOOTHING * mb_s, 2)
+                stats['samples'] = stats.get('samples', 0) + 1
+            else:
+                entry['levels'][str(level)] = {'ratio': round(ratio, 4), 'mb_s': round(mb_s, 2), 'samples': 1}
+            self._save(history)
+
+    def history(self) -> Dict[str, Any]:
+        with self._lock:
+            return self._load()
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            with self.history_path.open('r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save(self, history: Dict[str, Any]):
+        temp_path = self.history_path.with_suffix('.tmp')
+        with temp_path.open('w') as f:
+            json.dump(history, f, indent=2)
+        os.replace(temp_path, self.history_path)
+
+
+def benchmark(source: Path, threads: Optional[int] = None, compresslevel: int = 9,
+              block_size: int = DEFAULT_BLOCK_SIZE) -> dict:
+    """
+    Compress 'source' with the single-stream gzip path and with ParallelGzipWriter.
+
+    Returns:
+        Dict keyed by method with seconds, MB/s, output size and ratio
+    """
+    import shutil
+    import tempfile
+
+    source_size = source.stat().st_size
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        single_path = Path(tmp) / 'single.gz'
+        started = time.monotonic()
+        with source.open('rb') as f_in, gzip.open(single_path, 'wb', compresslevel=compresslevel) as f_out:
+            shutil.copyfileobj(f_in, f_out, DEFAULT_BLOCK_SIZE)
+        results['single_stream'] = (time.monotonic() - started, single_path.stat().st_size)
+
+        parallel_path = Path(tmp) / 'parallel.gz'
+        started = time.monotonic()
+        with source.open('rb') as f_in, ParallelGzipWriter(parallel_path, compresslevel, threads, block_size) as f_out:
+            shutil.copyfileobj(f_in, f_out, DEFAULT_BLOCK_SIZE)
+        results['parallel'] = (time.monotonic() - started, parallel_path.stat().st_size)
+
+        # The parallel output must decompress to the original bytes
+        digest_in, digest_out = hashlib.sha256(), hashlib.sha256()
+        with source.open('rb') as f:
+            for chunk in iter(lambda: f.read(DEFAULT_BLOCK_SIZE), b''):
+                digest_in.update(chunk)
+        with gzip.open(parallel_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DEFAULT_BLOCK_SIZE), b''):
+                digest_out.update(chunk)
+        if digest_in.digest() != digest_out.digest():
+            raise RuntimeError("Parallel gzip output does not round-trip")
+
+    return {
+        method: {
+            'seconds': round(seconds, 3),
+            'mb_per_second': round(source_size / max(seconds, 1e-6) / (1024 * 1024), 1),
+            'output_size': size,
+            'ratio': round(size / source_size, 4) if source_size else 0
+        }
+        for method, (seconds, size) in results.items()
+    }
+
+
+if __name__ == "__main__":
+    # Benchmark: python backup_compression.py <file> [--threads N] [--level L]
+    import sys
+
+    if len(sys.argv) < 2:
+        print("Usage: python backup_compression.py <file> [--threads N] [--level L]")
+        sys.exit(1)
+
+    def option(name, default):
+        if name in sys.argv:
+            return int(sys.argv[sys.argv.index(name) + 1])
+        return default
+
+    bench_source = Path(sys.argv[1])
+    bench_threads = option('--threads', default_compression_threads())
+    bench_level = option('--level', 9)
+
+    print(f"Compressing {bench_source} ({bench_source.stat().st_size} bytes), level {bench_level}, {bench_threads} threads")
+    for method, result in benchmark(bench_source, bench_threads, bench_level).items():
+        print(f"  {method:14} {result['seconds']:8.3f}s  {result['mb_per_second']:8.1f} MB/s  "
+              f"{result['output_size']} bytes (ratio {result['ratio']})")
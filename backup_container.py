@@ -0,0 +1,439 @@
+"""
+Seekable Chunked Backup Container
+A backup file (.bkc) made of independently compressed, optionally
+encrypted chunks of fixed uncompressed size, with a footer index of their
+offsets and checksums
+
+Because every chunk stands alone, chunks are compressed, checked,
+decompressed and decrypted on a thread pool, and a reader fetches any byte
+or page range by reading only the chunks it spans.
+
+Layout:
+    magic    b'BKCNTR1\\n', u32 header length, header JSON (codec, level,
+             chunk size and, when encrypted, the envelope: cipher, nonce
+             prefix and the data key wrapped per recipient; see
+             utils.encryption)
+    chunks   stored bytes of chunk 0..n-1, back to back
+    footer   JSON index: per chunk [offset, stored length, raw length,
+             SHA-256 of the stored bytes, SHA-256 of the raw bytes], the
+             total size and the header's SHA-256. Encrypted containers seal
+             it as chunk n with the final flag.
+    trailer  u64 footer offset, u32 footer length, u32 chunk count,
+             SHA-256 of the footer, b'BKCIDX1\\n'
+
+Encrypted chunks are sealed after compression with the chunk index in the
+nonce and the header as associated data, so a chunk moved to another slot
+or a changed header fails authentication.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Iterator, Iterable, Callable, Sequence, Union
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from backup_compression import Codec, get_codec
+from backup_differential import read_page_size
+from utils.encryption import seal_chunk, open_chunk, CIPHER
+
+CONTAINER_SUFFIX = '.bkc'
+CONTAINER_FORMAT = 'chunked'
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+CHUNK_ALIGNMENT = 64 * 1024 # Largest SQLite page size, so chunks always hold whole pages
+
+_MAGIC = b'BKCNTR1\n'
+_INDEX_MAGIC = b'BKCIDX1\n'
+_LENGTH = struct.Struct('>I')
+_TRAILER = struct.Struct('>QII32s8s')
+
+# Index entry fields
+_OFFSET, _STORED, _RAW, _STORED_SHA, _RAW_SHA = range(5)
+
+
+def _pack_chunk(compress: Optional[Callable[[bytes], bytes]], cipher: Optional[AESGCM], prefix: bytes, aad: bytes,
+                index: int, data: bytes):
+    """Compress (and seal) one chunk; returns its stored bytes and index fields"""
+    raw_sha = hashlib.sha256(data).hexdigest()
+    stored = compress(data) if compress else data
+    if cipher is not None:
+        stored = seal_chunk(cipher, prefix, aad, index, False, stored)
+    return stored, len(data), hashlib.sha256(stored).hexdigest(), raw_sha
+
+
+class ContainerWriter:
+    """
+    Binary writer producing a chunked container on 'output' (a binary file object, left open).
+
+    Input is cut into chunk_size chunks that are compressed (and sealed) on
+    a thread pool (zlib, bz2, lzma and AES-GCM release the GIL), written in
+    order with at most two per worker in flight. close() writes the footer
+    index; leaving a with-block on an exception leaves the output incomplete.
+    """
+
+    def __init__(self, output, codec: Codec, level: Optional[int] = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 workers: int = 1, envelope=None, recipients: Optional[Sequence[str]] = None):
+        """
+        Args:
+            output: Binary file object at position 0 (e.g. a ChecksumFile)
+            codec: Codec compressing each chunk ('none' stores them as they are)
+            level: Codec level
+            chunk_size: Uncompressed bytes per chunk, rounded up to a multiple of 64 KiB
+            workers: Threads compressing/sealing chunks
+            envelope: utils.encryption.EnvelopeEncryption; with recipients, chunks are encrypted
+            recipients: Recipients the data key is wrapped for
+        """
+        self.output = output
+        self.codec = codec
+        self.level = codec.resolve_level(level)
+        self.chunk_size = max(CHUNK_ALIGNMENT, -(-int(chunk_size) // CHUNK_ALIGNMENT) * CHUNK_ALIGNMENT)
+        self.workers = max(1, workers)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.started = time.monotonic()
+
+        header = {'version': 1, 'codec': codec.name, 'level': self.level, 'chunk_size': self.chunk_size,
+                  'encryption': None}
+        self._cipher = None
+        self._prefix = b''
+        if recipients:
+            data_key, header['encryption'] = envelope.new_data_key(recipients)
+            self._cipher = AESGCM(data_key)
+            self._prefix = bytes.fromhex(header['encryption']['nonce_prefix'])
+        header_json = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        self._header = _MAGIC + _LENGTH.pack(len(header_json)) + header_json
+        self._compress = codec.block_compressor(self.level) if codec.compresses else None
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='container-chunk')
+        self._pending = collections.deque()
+        self._index: List[list] = []
+        self._submitted = 0
+        self._buffer = bytearray()
+        self._closed = False
+        self._write_out(self._header)
+
+    @property
+    def encrypted(self) -> bool:
+        return self._cipher is not None
+
+    def write(self, data) -> int:
+        if self._closed:
+            raise ValueError("write to closed ContainerWriter")
+        self._buffer += data
+        self.bytes_in += len(data)
+        while len(self._buffer) >= self.chunk_size:
+            chunk = bytes(self._buffer[:self.chunk_size])
+            del self._buffer[:self.chunk_size]
+            self._submit(chunk)
+        return len(data)
+
+    def _submit(self, chunk: bytes):
+        self._pending.append(self._executor.submit(_pack_chunk, self._compress, self._cipher, self._prefix,
+                                                   self._header, self._submitted, chunk))
+        self._submitted += 1
+        while len(self._pending) >= self.workers * 2:
+            self._write_chunk(*self._pending.popleft().result())
+
+    def _write_chunk(self, stored: bytes, raw_length: int, stored_sha: str, raw_sha: str):
+        self._index.append([self.bytes_out, len(stored), raw_length, stored_sha, raw_sha])
+        self._write_out(stored)
+
+    def _write_out(self, data: bytes):
+        self.output.write(data)
+        self.bytes_out += len(data)
+
+    def flush(self):
+        pass # Chunks are written once compressed; a partial chunk waits for close()
+
+    def tell(self) -> int:
+        return self.bytes_in
+
+    def writable(self) -> bool:
+        return True
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def close(self):
+        """Write the last partial chunk, the footer index and the trailer (idempotent)"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._write_chunk(*self._pending.popleft().result())
+        finally:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+
+        footer = json.dumps({'chunks': self._index, 'size': self.bytes_in,
+                             'header_sha256': hashlib.sha256(self._header).hexdigest()},
+                            separators=(',', ':')).encode('utf-8')
+        if self._cipher is not None:
+            footer = seal_chunk(self._cipher, self._prefix, self._header, len(self._index), True, footer)
+        footer_offset = self.bytes_out
+        self._write_out(footer)
+        self._write_out(_TRAILER.pack(footer_offset, len(footer), len(self._index), hashlib.sha256(footer).digest(),
+                                     _INDEX_MAGIC))
+
+    def abort(self):
+        """Stop without writing the index (the output is left incomplete)"""
+        self._closed = True
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        duration = time.monotonic() - self.started
+        return {
+            'codec': self.codec.name,
+            'chunks': len(self._index),
+            'chunk_size': self.chunk_size,
+            'encrypted': self.encrypted,
+            'workers': self.workers,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'duration_seconds': round(duration, 3),
+            'throughput_mb_s': round(self.bytes_in / (1024 * 1024) / duration, 1) if duration > 0 else None
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def read_container_header(path: Union[str, Path]) -> Dict[str, Any]:
+    """Header of a container (codec, chunk size, encryption) without reading the index"""
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f"{Path(path).name} is not a chunked backup container")
+        length = _LENGTH.unpack(f.read(_LENGTH.size))[0]
+        return json.loads(f.read(length))
+
+
+class ContainerReader:
+    """
+    Random access to a chunked container.
+
+    Opening reads the header, the trailer and the footer index only. Chunks
+    are fetched with pread, so the reader can be shared by worker threads;
+    read_chunk decrypts, decompresses and checks one chunk, and iter_chunks,
+    extract_to and verify spread that over 'workers' threads.
+    """
+
+    def __init__(self, path: Union[str, Path], envelope=None, workers: int = 1):
+        """
+        Args:
+            path: Container file
+            envelope: utils.encryption.EnvelopeEncryption holding a private key; needed for encrypted containers
+            workers: Threads used by iter_chunks, extract_to and verify
+
+        Raises:
+            ValueError: If the file is not a container, its index is damaged or no key can open it
+        """
+        self.path = Path(path)
+        self.workers = max(1, workers)
+        self._fd = os.open(self.path, os.O_RDONLY)
+        try:
+            self._open_index(envelope)
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def _pread(self, length: int, offset: int) -> bytes:
+        data = os.pread(self._fd, length, offset)
+        if len(data) != length:
+            raise ValueError(f"{self.path.name} is truncated at offset {offset}")
+        return data
+
+    def _open_index(self, envelope):
+        file_size = os.fstat(self._fd).st_size
+        if file_size < len(_MAGIC) + _LENGTH.size + _TRAILER.size or self._pread(len(_MAGIC), 0) != _MAGIC:
+            raise ValueError(f"{self.path.name} is not a chunked backup container")
+        header_length = _LENGTH.unpack(self._pread(_LENGTH.size, len(_MAGIC)))[0]
+        self._header_bytes = self._pread(len(_MAGIC) + _LENGTH.size + header_length, 0)
+        self.header = json.loads(self._header_bytes[len(_MAGIC) + _LENGTH.size:])
+        self.codec = get_codec(self.header['codec'])
+        self.chunk_size = int(self.header['chunk_size'])
+
+        footer_offset, footer_length, chunk_count, footer_sha, magic = _TRAILER.unpack(
+            self._pread(_TRAILER.size, file_size - _TRAILER.size))
+        if magic != _INDEX_MAGIC or footer_offset + footer_length + _TRAILER.size != file_size:
+            raise ValueError(f"{self.path.name} has no valid index (incomplete or truncated container)")
+        footer = self._pread(footer_length, footer_offset)
+        if hashlib.sha256(footer).digest() != footer_sha:
+            raise ValueError(f"Index of {self.path.name} failed its checksum")
+
+        self._cipher = None
+        self._prefix = b''
+        encryption = self.header.get('encryption')
+        if encryption:
+            if encryption.get('cipher') != CIPHER:
+                raise ValueError(f"Unsupported cipher in {self.path.name}: {encryption.get('cipher')}")
+            if envelope is None:
+                raise ValueError(f"{self.path.name} is encrypted; a private key is needed to read it")
+            self._cipher = AESGCM(envelope.unwrap_data_key(encryption, self.path.name))
+            self._prefix = bytes.fromhex(encryption['nonce_prefix'])
+            # The index is sealed as the chunk after the last one
+            try:
+                footer = open_chunk(self._cipher, self._prefix, self._header_bytes, chunk_count, True, footer)
+            except ValueError:
+                raise ValueError(f"Index of {self.path.name} failed authentication") from None
+        index = json.loads(footer)
+        if index['header_sha256'] != hashlib.sha256(self._header_bytes).hexdigest():
+            raise ValueError(f"Header of {self.path.name} does not match its index")
+        self.index: List[list] = index['chunks']
+        if len(self.index) != chunk_count:
+            raise ValueError(f"Index of {self.path.name} does not match its trailer")
+        self.size = int(index['size'])
+
+    @property
+    def encrypted(self) -> bool:
+        return self._cipher is not None
+
+    @property
+    def chunk_count(self) -> int:
+        return len(self.index)
+
+    def stored_length(self, number: int) -> int:
+        """Bytes chunk 'number' takes in the file"""
+        return self.index[number][_STORED]
+
+    def read_stored(self, number: int) -> bytes:
+        """Stored (compressed, possibly sealed) bytes of chunk 'number', checked against the index"""
+        entry = self.index[number]
+        stored = self._pread(entry[_STORED], entry[_OFFSET])
+        if hashlib.sha256(stored).hexdigest() != entry[_STORED_SHA]:
+            raise ValueError(f"Chunk {number} of {self.path.name} failed its checksum")
+        return stored
+
+    def read_chunk(self, number: int) -> bytes:
+        """Uncompressed bytes of chunk 'number', decrypted and checked against the index"""
+        entry = self.index[number]
+        data = self.read_stored(number)
+        if self._cipher is not None:
+            data = open_chunk(self._cipher, self._prefix, self._header_bytes, number, False, data)
+        if self.codec.compresses:
+            data = self.codec.block_decompressor()(data)
+        if len(data) != entry[_RAW] or hashlib.sha256(data).hexdigest() != entry[_RAW_SHA]:
+            raise ValueError(f"Chunk {number} of {self.path.name} failed its checksum")
+        return data
+
+    def _map(self, fn: Callable[[int], Any], numbers: Iterable[int]) -> Iterator[Any]:
+        """fn over chunk numbers on the pool, results in order, at most two per worker in flight"""
+        if self.workers == 1:
+            for number in numbers:
+                yield fn(number)
+            return
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='container-read') as executor:
+            pending = collections.deque()
+            try:
+                for number in numbers:
+                    pending.append(executor.submit(fn, number))
+                    if len(pending) >= self.workers * 2:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def iter_chunks(self, first: int = 0, last: Optional[int] = None) -> Iterator[bytes]:
+        """Uncompressed chunks first..last (inclusive; default all) in order, opened in parallel"""
+        last = self.chunk_count - 1 if last is None else last
+        return self._map(self.read_chunk, range(first, last + 1))
+
+    def read(self, offset: int, length: int) -> bytes:
+        """'length' bytes of the database from 'offset', touching only the chunks that hold them"""
+        if offset < 0 or length < 0:
+            raise ValueError("offset and length must not be negative")
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b''
+        first, last = offset // self.chunk_size, (end - 1) // self.chunk_size
+        data = b''.join(self.iter_chunks(first, last))
+        start = offset - first * self.chunk_size
+        return data[start:start + end - offset]
+
+    @property
+    def page_size(self) -> int:
+        """SQLite page size of the database held, from its first page"""
+        if not hasattr(self, '_page_size'):
+            self._page_size = read_page_size(self.read(0, 100))
+        return self._page_size
+
+    def read_pages(self, first_page: int, count: int = 1) -> bytes:
+        """SQLite pages first_page.. (numbered from 1, as in the database) without reading the rest"""
+        if first_page < 1 or count < 0:
+            raise ValueError("Pages are numbered from 1")
+        return self.read((first_page - 1) * self.page_size, count * self.page_size)
+
+    def extract_to(self, target_path: Union[str, Path]) -> int:
+        """
+        Write the database to target_path with chunks opened and written in
+        parallel (each at its own offset). Returns the number of bytes written.
+        """
+        fd = os.open(target_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.size)
+
+            def extract(number: int) -> int:
+                data = self.read_chunk(number)
+                view = memoryview(data)
+                offset = number * self.chunk_size
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    view, offset = view[written:], offset + written
+                return len(data)
+            return sum(self._map(extract, range(self.chunk_count)))
+        finally:
+            os.close(fd)
+
+    def verify(self, deep: bool = True) -> Dict[str, Any]:
+        """
+        Check every chunk in parallel: the stored bytes against the index
+        (fast), or also decrypt, decompress and check the raw bytes (deep).
+        Stops at the first bad chunk.
+
+        Returns:
+            Dict with ok, chunks, bytes checked, error and timing
+        """
+        started = time.monotonic()
+        check = self.read_chunk if deep else self.read_stored
+        checked = 0
+        error = None
+        try:
+            for data in self._map(check, range(self.chunk_count)):
+                checked += len(data)
+        except ValueError as e:
+            error = str(e)
+        return {'ok': error is None, 'deep': deep, 'chunks': self.chunk_count, 'bytes_checked': checked,
+                'error': error, 'duration_seconds': round(time.monotonic() - started, 3)}
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,292 @@
+"""
+Deduplicated Backup Store
+Splits database snapshots into content-defined chunks, stores each unique
+chunk once (compressed) and describes every backup with a small manifest
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Union, Callable, Dict, List, Iterator, Iterable, Any, Tuple
+
+from backup_compression import Codec, get_codec, available_codecs, codec_for_path
+
+
+MANIFEST_SUFFIX = '.manifest'
+MANIFEST_VERSION = 1
+
+# Byte values are split into pseudo-random classes derived from SHA-256, so chunk
+# boundaries (and therefore deduplication) stay stable across Python versions
+_BYTE_BITS = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big') for i in range(256)]
+
+
+def _byte_class(index: int, half: bool = False) -> str:
+    """Regex class of the byte values whose bits 2*index (and 2*index+1) are clear: a quarter (half) of them"""
+    mask = 1 if half else 3
+    values = [b for b in range(256) if not (_BYTE_BITS[b] >> (2 * index)) & mask]
+    return '[' + ''.join(f'\\x{b:02x}' for b in values) + ']'
+
+
+def _boundary_pattern(bits: int) -> Tuple['re.Pattern[bytes]', int]:
+    """Pattern matching random data with probability 2**-bits, and its width in bytes"""
+    bits = max(1, min(bits, 31))
+    classes = [_byte_class(i) for i in range(bits // 2)]
+    if bits % 2:
+        classes.append(_byte_class(bits // 2, half=True))
+    return re.compile(''.join(classes).encode('ascii')), len(classes)
+
+
+class ContentDefinedChunker:
+    """
+    Cut a byte stream at content-defined boundaries.
+
+    A boundary follows a short run of bytes that each fall in a given
+    pseudo-random class of byte values, so it depends only on the bytes
+    around it: an edit changes the chunks it touches and leaves the rest
+    identical to the previous snapshot. The test is a compiled regex, so
+    the scan runs in the regex engine rather than a per-byte Python loop.
+
+    Uses FastCDC-style normalized chunking: the first min_size bytes of a
+    chunk are skipped, a stricter pattern applies up to avg_size and a
+    looser one after it, which keeps chunk sizes close to avg_size. Chunks
+    never exceed max_size.
+    """
+
+    def __init__(self, avg_size: int = 64 * 1024, min_size: Optional[int] = None,
+                 max_size: Optional[int] = None):
+        self.avg_size = max(1024, avg_size)
+        self.min_size = min_size or self.avg_size // 4
+        self.max_size = max_size or self.avg_size * 4
+        bits = self.avg_size.bit_length() - 1
+        self._strict, self._strict_width = _boundary_pattern(bits + 2)
+        self._loose, self._loose_width = _boundary_pattern(bits - 2)
+
+    def describe(self) -> Dict[str, Any]:
+        return {'algorithm': 'byteclass-fastcdc', 'avg_size': self.avg_size,
+                'min_size': self.min_size, 'max_size': self.max_size}
+
+    def _cut_point(self, data: bytes, start: int, end: int) -> int:
+        """End offset of the chunk that starts at data[start] and ends by data[end]"""
+        if end - start <= self.min_size:
+            return end
+        normal = min(start + self.avg_size, end)
+        # A match must end past min_size (strict) or past avg_size (loose); its window may reach back before
+        match = self._strict.search(data, max(start, start + self.min_size + 1 - self._strict_width), normal)
+        if not match and normal < end:
+            match = self._loose.search(data, max(start, normal + 1 - self._loose_width), end)
+        return match.end() if match else end
+
+    def chunks(self, reader, read_size: int = 1024 * 1024) -> Iterator[bytes]:
+        """Yield the chunks of a file-like reader"""
+        buffer = b''
+        offset = 0 # Start of the next chunk; the consumed head is only dropped when reading more
+        eof = False
+        while True:
+            while not eof and len(buffer) - offset < self.max_size:
+                data = reader.read(max(read_size, self.max_size))
+                if not data:
+                    eof = True
+                    break
+                buffer = buffer[offset:] + data
+                offset = 0
+            if offset == len(buffer):
+                return
+            cut = self._cut_point(buffer, offset, min(len(buffer), offset + self.max_size))
+            yield buffer[offset:cut]
+            offset = cut
+
+
+class ChunkStore:
+    """
+    Content-addressed store of compressed chunks plus backup manifests.
+
+    Chunks live under root/<first two hex digits>/<sha256><codec extension>,
+    keyed by the SHA-256 of their uncompressed bytes, so a chunk shared by
+    many snapshots is written once. A manifest is a JSON list of
+    (sha256, length) pairs in file order. Chunks are removed by
+    collect_garbage once no manifest references them.
+    """
+
+    def __init__(self, root: Union[str, Path], chunker: Optional[ContentDefinedChunker] = None,
+                 gc_grace_seconds: float = 3600):
+        self.root = Path(root)
+        self.chunker = chunker or ContentDefinedChunker()
+        self.gc_grace_seconds = gc_grace_seconds
+
+    def _chunk_path(self, digest: str, codec: Codec) -> Path:
+        return self.root / digest[:2] / (digest + codec.extension)
+
+    def _find_chunk(self, digest: str, preferred: Optional[Codec] = None) -> Optional[Path]:
+        """Locate a stored chunk whatever codec it was written with"""
+        codecs = [preferred] if preferred else []
+        codecs += [get_codec(name) for name in available_codecs() if not preferred or name != preferred.name]
+        for codec in codecs:
+            path = self._chunk_path(digest, codec)
+            if path.exists():
+                return path
+        return None
+
+    def write_backup(self, reader, manifest_path: Path, codec: Codec, level: Optional[int] = None,
+                     total: int = 0, progress_callback: Optional[Callable[..., None]] = None) -> Dict[str, Any]:
+        """
+        Chunk a snapshot into the store and write its manifest.
+
+        Args:
+            reader: File-like object over the snapshot
+            manifest_path: Where to write the manifest
+            codec: Codec new chunks are compressed with
+            level: Codec level (codec default if None)
+            total: Expected snapshot size, for progress
+            progress_callback: Optional callable(bytes_done, total, chunks, new_chunks)
+
+        Returns:
+            Dict with chunk counts and bytes read/written
+        """
+        level = codec.resolve_level(level)
+        compress = codec.block_compressor(level)
+        entries: List[List[Any]] = []
+        whole_file = hashlib.sha256()
+        stats = {'chunks': 0, 'new_chunks': 0, 'bytes_read': 0, 'bytes_written': 0, 'new_chunk_bytes': 0}
+
+        for chunk in self.chunker.chunks(reader):
+            digest = hashlib.sha256(chunk).hexdigest()
+            whole_file.update(chunk)
+            entries.append([digest, len(chunk)])
+            stats['chunks'] += 1
+            stats['bytes_read'] += len(chunk)
+
+            existing = self._find_chunk(digest, codec)
+            if existing:
+                # Refresh the mtime so a concurrent collect_garbage treats it as fresh
+                os.utime(existing)
+            else:
+                path = self._chunk_path(digest, codec)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                temp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+                data = compress(chunk)
+                with temp_path.open('wb') as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+                stats['new_chunks'] += 1
+                stats['bytes_written'] += len(data)
+                stats['new_chunk_bytes'] += len(data)
+
+            if progress_callback:
+                progress_callback(stats['bytes_read'], total, stats['chunks'], stats['new_chunks'])
+
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'created_at': datetime.now().isoformat(),
+            'size': stats['bytes_read'],
+            'sha256': whole_file.hexdigest(),
+            'codec': codec.name,
+            'chunker': self.chunker.describe(),
+            'chunks': entries
+        }
+        temp_manifest = manifest_path.with_name(manifest_path.name + '.tmp')
+        with temp_manifest.open('w') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(temp_manifest, manifest_path)
+        stats['bytes_written'] += manifest_path.stat().st_size
+        return stats
+
+    @staticmethod
+    def read_manifest(manifest_path: Path) -> Dict[str, Any]:
+        with Path(manifest_path).open('r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported manifest version {manifest.get('version')} in {manifest_path}")
+        return manifest
+
+    def iter_backup(self, manifest_path: Path) -> Iterator[bytes]:
+        """
+        Yield the original snapshot bytes of a manifest, chunk by chunk.
+
+        Every chunk is checked against its hash and length, and the whole file
+        against the manifest's SHA-256.
+
+        Raises:
+            IOError: If a chunk is missing or corrupt
+        """
+        manifest = self.read_manifest(manifest_path)
+        preferred = get_codec(manifest.get('codec', 'none'))
+        whole_file = hashlib.sha256()
+        for digest, length in manifest['chunks']:
+            path = self._find_chunk(digest, preferred)
+            if not path:
+                raise IOError(f"Chunk {digest} referenced by {Path(manifest_path).name} is missing")
+            with codec_for_path(path).open_reader(path) as f:
+                chunk = f.read()
+            if len(chunk) != length or hashlib.sha256(chunk).hexdigest() != digest:
+                raise IOError(f"Chunk {digest} referenced by {Path(manifest_path).name} is corrupt")
+            whole_file.update(chunk)
+            yield chunk
+        if whole_file.hexdigest() != manifest['sha256']:
+            raise IOError(f"Reassembled {Path(manifest_path).name} does not match its checksum")
+
+    def restore(self, manifest_path: Path, f_out) -> int:
+        """Write the snapshot of a manifest to f_out; returns bytes written"""
+        written = 0
+        for chunk in self.iter_backup(manifest_path):
+            f_out.write(chunk)
+            written += len(chunk)
+        return written
+
+    def reference_counts(self, manifest_paths: Iterable[Path]) -> Dict[str, int]:
+        """Count how many live manifests reference each chunk"""
+        counts: Dict[str, int] = {}
+        for manifest_path in manifest_paths:
+            for digest, _ in self.read_manifest(manifest_path)['chunks']:
+                counts[digest] = counts.get(digest, 0) + 1
+        return counts
+
+    def collect_garbage(self, manifest_paths: Iterable[Path]) -> Dict[str, int]:
+        """
+        Delete chunks no live manifest references.
+
+        Reference counts are rebuilt from the manifests, so they can never
+        drift from what is on disk. Unreferenced chunks younger than
+        gc_grace_seconds are kept: they may belong to a backup whose manifest
+        has not been written yet.
+
+        Returns:
+            Dict with removed/kept chunk counts and bytes freed
+        """
+        counts = self.reference_counts(manifest_paths)
+        cutoff = time.time() - self.gc_grace_seconds
+        result = {'removed': 0, 'bytes_freed': 0, 'live': 0}
+        if not self.root.exists():
+            return result
+
+        for entry in self.root.glob('??/*'):
+            digest = entry.name.split('.', 1)[0]
+            if counts.get(digest, 0) > 0:
+                result['live'] += 1
+                continue
+            try:
+                stat = entry.stat()
+                if stat.st_mtime > cutoff:
+                    continue
+                entry.unlink()
+                result['removed'] += 1
+                result['bytes_freed'] += stat.st_size
+            except FileNotFoundError:
+                continue
+        return result
+
+    def disk_usage(self) -> Dict[str, int]:
+        """Number and total size of stored chunks"""
+        usage = {'chunks': 0, 'bytes': 0}
+        if self.root.exists():
+            for entry in self.root.glob('??/*'):
+                try:
+                    usage['bytes'] += entry.stat().st_size
+                    usage['chunks'] += 1
+                except FileNotFoundError:
+                    continue
+        return usage
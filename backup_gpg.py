@@ -3,12 +3,182 @@
 import subprocess
 import os
 import logging
+import queue
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional, List
+from typing import Optional, List, Dict, Any, Union
 
 # No need to import config or app_paths globally here if passed via __init__
 # from config import app_paths, get_config
 
+class GpgEncryptStream:
+    """
+    Binary writer that encrypts everything written to it with 'gpg --encrypt'.
+
+    Three stages overlap: the caller's writes (e.g. a compressor) fill a
+    bounded queue of blocks, a feeder thread writes them to gpg's stdin, and
+    a drain thread copies gpg's stdout into 'output' (left open). A slow
+    stage holds the others back once the queue or a pipe is full, so memory
+    stays at queue_blocks * block_size. close() waits for gpg and raises if
+    it failed; leaving a with-block on an exception kills gpg instead.
+    """
+
+    def __init__(self, command: List[str], output, block_size: int = 1024 * 1024, queue_blocks: int = 8):
+        self.output = output
+        self.block_size = block_size
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.producer_wait_seconds = 0.0 # Writers blocked on a full queue (encryption is the bottleneck)
+        self.feeder_wait_seconds = 0.0 # Feeder blocked on gpg's stdin
+        self.started = time.monotonic()
+        self._buffer = bytearray()
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_blocks)
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        self._returncode: Optional[int] = None
+        self._message = ''
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self._stderr)
+        self._feeder = threading.Thread(target=self._feed, name='gpg-feed', daemon=True)
+        self._drainer = threading.Thread(target=self._drain, name='gpg-drain', daemon=True)
+        self._feeder.start()
+        self._drainer.start()
+
+    def write(self, data) -> int:
+        if self._closed:
+            raise ValueError("write to closed GpgEncryptStream")
+        self._buffer += data
+        if len(self._buffer) >= self.block_size:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        self.bytes_in += len(data)
+        return len(data)
+
+    def flush(self):
+        pass # Blocks go out as they fill; close() sends the rest
+
+    def tell(self) -> int:
+        return self.bytes_in
+
+    def writable(self) -> bool:
+        return True
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def _put(self, block: Optional[bytes]):
+        started = time.monotonic()
+        while True:
+            if self._error is not None:
+                raise self._failure()
+            try:
+                self._queue.put(block, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+        self.producer_wait_seconds += time.monotonic() - started
+
+    def _feed(self):
+        try:
+            while True:
+                block = self._queue.get()
+                if block is None:
+                    break
+                started = time.monotonic()
+                self._process.stdin.write(block)
+                self.feeder_wait_seconds += time.monotonic() - started
+        except BaseException as e:
+            self._error = self._error or e
+        finally:
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+
+    def _drain(self):
+        try:
+            while True:
+                chunk = self._process.stdout.read1(self.block_size)
+                if not chunk:
+                    break
+                self.output.write(chunk)
+                self.bytes_out += len(chunk)
+        except BaseException as e:
+            self._error = self._error or e
+            self._process.kill() # Nobody reads its output any more
+
+    def close(self):
+        """Send the rest, wait for gpg and raise if any stage failed (idempotent)"""
+        if self._closed:
+            return
+        try:
+            if self._buffer:
+                self._put(bytes(self._buffer))
+                self._buffer.clear()
+            self._put(None)
+        finally:
+            self._closed = True
+        error = self._failure()
+        if error is not None:
+            raise error
+
+    def _failure(self) -> Optional[IOError]:
+        """Wait for gpg and both threads; describe the failure from gpg's stderr, if any"""
+        if self._returncode is None:
+            if self._error is not None:
+                self._queue_drop()
+            self._feeder.join()
+            self._drainer.join()
+            self._returncode = self._process.wait()
+            self._stderr.seek(0)
+            self._message = self._stderr.read().decode('utf-8', errors='replace').strip()
+            self._stderr.close()
+        if self._error is None and self._returncode == 0:
+            return None
+        return IOError(f"gpg --encrypt exited with {self._returncode}: {self._message or self._error}")
+
+    def _queue_drop(self):
+        """Unblock the feeder after a failure so it can see the end marker"""
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._queue.put(None)
+
+    def abort(self):
+        """Stop gpg without finishing the output"""
+        if self._closed:
+            return
+        self._closed = True
+        self._error = self._error or IOError("aborted")
+        self._process.kill()
+        self._failure()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'duration_seconds': round(time.monotonic() - self.started, 3),
+            'producer_wait_seconds': round(self.producer_wait_seconds, 3),
+            'feeder_wait_seconds': round(self.feeder_wait_seconds, 3)
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
 class GPGBackup:
     def __init__(self, config=None):
         """
@@ -191,6 +361,68 @@ class GPGBackup:
                     self.logger.warning(f"Could not delete partial decrypted file {output_file_path}: {e}")
             return None
 
+    def open_encrypt_stream(self, output, recipient: Optional[Union[str, List[str]]] = None,
+                            block_size: int = 1024 * 1024, queue_blocks: int = 8) -> GpgEncryptStream:
+        """
+        Start encrypting a stream for 'recipient' (default GPG_RECIPIENT_EMAIL; a list
+        encrypts for each of them) into the binary file object 'output'.
+
+        The data is expected to be compressed already, so gpg's own
+        compression is switched off (--compress-algo none). The recipient's
+        key must already be in the keyring; it is trusted as-is, as in
+        utils.gpg_backup. See GpgEncryptStream.
+        """
+        actual_recipient = recipient or self.recipient_email
+        if not actual_recipient:
+            raise ValueError("No GPG recipient specified for encryption.")
+        recipients = [actual_recipient] if isinstance(actual_recipient, str) else list(actual_recipient)
+        command = [
+            str(self.gpg_binary_path),
+            '--homedir', str(self.gpg_home_dir),
+            '--batch', '--yes',
+            '--trust-model', 'always',
+            '--auto-key-locate', 'local',
+            '--compress-algo', 'none',
+            '--encrypt'
+        ]
+        for name in recipients:
+            command += ['--recipient', name]
+        self.logger.debug(f"Running GPG command: {' '.join(command)}")
+        return GpgEncryptStream(command, output, block_size, queue_blocks)
+
+    @contextmanager
+    def open_decrypt_stream(self, input_file_path: Path, buffer_size: int = 1024 * 1024):
+        """
+        Decrypt a GPG encrypted file as a stream, without writing the plaintext anywhere.
+
+        Yields gpg's stdout as a binary reader; the pipe (and buffer_size of
+        read-ahead) is the only buffer, so gpg waits while the reader is busy.
+
+        Raises:
+            IOError: If gpg exits with an error (e.g. no secret key, or the
+                     integrity check at the end of the data failed)
+        """
+        command = [
+            str(self.gpg_binary_path),
+            '--homedir', str(self.gpg_home_dir),
+            '--batch', '--yes',
+            '--decrypt', str(input_file_path)
+        ]
+        self.logger.debug(f"Running GPG command: {' '.join(command)}")
+        # stderr goes to a file: an unread stderr pipe could fill up and stall gpg
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr, bufsize=buffer_size)
+            try:
+                yield process.stdout
+            finally:
+                process.stdout.close()
+                returncode = process.wait()
+            stderr.seek(0)
+            message = stderr.read().decode('utf-8', errors='replace').strip()
+        if returncode != 0:
+            self.logger.error(f"Failed to decrypt {input_file_path}: {message}")
+            raise IOError(f"gpg --decrypt exited with {returncode}: {message}")
+
     def export_public_key(self, key_id: str, output_path: Optional[Path] = None) -> Optional[Path]:
         """
         Exports a public key to a file.
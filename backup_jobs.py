@@ -0,0 +1,421 @@
+"""
+Background Backup Jobs
+Runs snapshot, compression and GPG encryption on a worker pool so the
+request thread only queues the job and returns its id
+"""
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Dict, List, Any, Tuple
+
+from backup_compression import get_codec
+from backup_differential import page_hash_path
+from models import db, BackupRecord
+
+
+class BackupJobManager:
+    """Queue backup jobs on a thread pool and track them through BackupRecord"""
+
+    # Job states as stored in BackupRecord.status
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+
+    # Progress of this many recent jobs is kept in memory for the events stream
+    PROGRESS_HISTORY = 100
+
+    def __init__(self, app, backup_manager, gpg_backup=None):
+        """
+        Initialize the job manager.
+
+        Args:
+            app: Flask application (workers push their own app context)
+            backup_manager: DatabaseBackup instance
+            gpg_backup: utils.gpg_backup.GPGBackup instance used for encryption
+        """
+        self.app = app
+        self.backup_manager = backup_manager
+        self.gpg_backup = gpg_backup
+        self.logger = logging.getLogger('backup')
+
+        max_workers = int(app.config.get('BACKUP_JOB_WORKERS', 2))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='backup-job')
+
+        # Queued/running snapshots by flight key, each with the (job id, options) sharing it
+        self._flights: Dict[str, List[Tuple[int, Dict[str, Any]]]] = {}
+        self._flights_lock = threading.Lock()
+        # (user id, idempotency key) -> (job id, time submitted)
+        self._idempotency: Dict[Tuple[Optional[int], str], Tuple[int, float]] = {}
+        self.idempotency_ttl = float(app.config.get('BACKUP_IDEMPOTENCY_TTL_SECONDS', 600))
+
+        # Latest progress event per job, plus a version counter that wakes event streams
+        self._progress: Dict[int, Dict[str, Any]] = {}
+        self._progress_version = 0
+        self._progress_cond = threading.Condition()
+
+    def submit(self, format: str = 'zip', include_attachments: bool = False, encrypt_gpg: bool = False,
+               gpg_email: Optional[str] = None, user_id: Optional[int] = None,
+               codec: Optional[str] = None, level: Optional[int] = None,
+               backup_type: str = 'manual', idempotency_key: Optional[str] = None,
+               encryption_engine: Optional[str] = None) -> BackupRecord:
+        """
+        Queue a backup job.
+
+        Jobs asking for the same snapshot (format, codec, level, type) while
+        one is queued or running join it as a flight: the database is copied
+        and compressed once, and only GPG encryption runs per job.
+
+        With BACKUP_GPG_PIPELINE_ENABLED, encrypted jobs instead pipe the
+        compressed snapshot through gpg as it is taken (see
+        DatabaseBackup.create_backup's encrypt_to), so no plaintext file is
+        written; such jobs only share a flight with jobs for the same recipient,
+        as each recipient needs its own gpg stream (and so its own snapshot).
+        The 'aes-gcm' engine always encrypts that way. Dedup and differential
+        backups cannot be encrypted (see DatabaseBackup.check_encryptable).
+
+        Args:
+            format: Backup format requested by the UI ('zip', 'gz', 'bz2', 'xz', 'db', 'dedup', 'chunked', 'json', 'csv')
+            include_attachments: Passed through to DatabaseBackup.create_backup
+            encrypt_gpg: Encrypt the finished backup for gpg_email
+            gpg_email: Recipient of the encrypted backup
+            encryption_engine: 'gpg' or 'aes-gcm'; defaults to BACKUP_ENCRYPTION_ENGINE ('chunked' is always aes-gcm)
+            user_id: ID of the user creating the backup
+            codec: Compression codec name; overrides the one implied by format
+            level: Compression level for the codec
+            backup_type: 'manual' for a full backup or 'differential'
+            idempotency_key: Client token; repeating it within BACKUP_IDEMPOTENCY_TTL_SECONDS
+                             returns the job it first created
+
+        Returns:
+            The queued BackupRecord; its id is the job id
+
+        Raises:
+            ValueError: If the codec is unknown or the backup cannot be encrypted (see
+                        DatabaseBackup.check_encryptable)
+        """
+        backup_codec = self.backup_manager.resolve_codec(format, codec)
+        if encrypt_gpg:
+            self.backup_manager.check_encryptable(format, backup_type)
+        encryption_engine = self.backup_manager.resolve_encryption_engine(encryption_engine, format) if encrypt_gpg else None
+        encrypt_to = None
+        if encrypt_gpg and (encryption_engine != 'gpg' or self.app.config.get('BACKUP_GPG_PIPELINE_ENABLED', True)):
+            encrypt_to = gpg_email
+        flight_key = json.dumps([format, backup_codec.name, None if level is None else str(level),
+                                 backup_type, include_attachments, encrypt_to, encrypt_to and encryption_engine])
+
+        with self._flights_lock:
+            if idempotency_key:
+                record = self._find_idempotent_job(user_id, idempotency_key)
+                if record:
+                    self.logger.info(f"Backup request repeated (idempotency key); returning job {record.id}")
+                    return record
+
+            # Placeholder name until the worker knows the real one
+            expected_name = (self.backup_manager.app_paths.get_backup_filename(backup_type=backup_type)
+                             + self.backup_manager.backup_extension(format, backup_codec))
+
+            record = BackupRecord.create_backup_record(
+                filename=expected_name,
+                backup_type='encrypted' if encrypt_gpg else 'regular',
+                user_id=user_id,
+                description='Customer database backup' + (
+                    f" ({'GPG' if encryption_engine == 'gpg' else 'AES-GCM'} encrypted)" if encrypt_gpg else ''),
+                status=self.QUEUED,
+                compression_type=backup_codec.name if backup_codec.compresses else None
+            )
+            if idempotency_key:
+                self._idempotency[(user_id, idempotency_key)] = (record.id, time.monotonic())
+
+            options = {
+                'format': format,
+                'codec': backup_codec.name,
+                'level': level,
+                'backup_type': backup_type,
+                'include_attachments': include_attachments,
+                'encrypt_gpg': encrypt_gpg,
+                'gpg_email': gpg_email,
+                'encryption_engine': encryption_engine,
+                'encrypt_to': encrypt_to
+            }
+            flight = self._flights.get(flight_key)
+            if flight is not None:
+                flight.append((record.id, options))
+                self.logger.info(f"Backup job {record.id} joined the snapshot of job {flight[0][0]}")
+            else:
+                self._flights[flight_key] = [(record.id, options)]
+                self.executor.submit(self._run_flight, flight_key)
+                self.logger.info(f"Backup job {record.id} queued ({options['codec']}, encrypted={encrypt_gpg})")
+        return record
+
+    def _find_idempotent_job(self, user_id: Optional[int], idempotency_key: str) -> Optional[BackupRecord]:
+        """Job created earlier for the same user and key, if still within the TTL (caller holds _flights_lock)"""
+        now = time.monotonic()
+        for key, (_, created) in list(self._idempotency.items()):
+            if now - created > self.idempotency_ttl:
+                del self._idempotency[key]
+        entry = self._idempotency.get((user_id, idempotency_key))
+        return db.session.get(BackupRecord, entry[0]) if entry else None
+
+    def _run_flight(self, flight_key: str):
+        """Worker entry point: take one snapshot, then finish every job that joined it"""
+        with self.app.app_context():
+            backup_file_path = None
+            error = None
+            try:
+                with self._flights_lock:
+                    leader_options = self._flights[flight_key][0][1]
+                report = self._flight_reporter(flight_key)
+                report({'stage': 'snapshot', 'fraction': 0.0}) # Marks the jobs queued so far as running
+                if leader_options['encrypt_to']:
+                    self._check_encryption_key(leader_options['encrypt_to'], leader_options['encryption_engine'])
+
+                # Encrypted after the snapshot: the plaintext is removed once every job has its copy
+                discard_output = leader_options['encrypt_gpg'] and not leader_options['encrypt_to']
+                backup_file_path = self.backup_manager.create_backup(
+                    format=leader_options['format'],
+                    include_attachments=leader_options['include_attachments'],
+                    backup_type=leader_options['backup_type'],
+                    progress_callback=report,
+                    codec=leader_options['codec'],
+                    level=leader_options['level'],
+                    # An encrypting flight deletes its plaintext, so it must not share another run's file
+                    coalesce=not leader_options['encrypt_gpg'],
+                    encrypt_to=leader_options['encrypt_to'],
+                    encryption_engine=leader_options['encryption_engine'],
+                    discard_output=discard_output
+                )
+                if not backup_file_path or not backup_file_path.exists():
+                    raise RuntimeError('Backup creation failed.')
+            except Exception as e:
+                self.logger.error(f"Backup snapshot for {flight_key} failed: {str(e)}", exc_info=True)
+                error = e
+            finally:
+                # Later requests start a new flight with a fresh snapshot
+                with self._flights_lock:
+                    members = self._flights.pop(flight_key)
+
+            try:
+                # Encrypt every job's copy first; none is reported completed while the plaintext exists
+                finished = [(job_id, options, self._finish_job(job_id, options, backup_file_path, error))
+                            for job_id, options in members]
+                if (backup_file_path and backup_file_path.exists() and not members[0][1]['encrypt_to']
+                        and all(options['encrypt_gpg'] for _, options in members)):
+                    # Never leave a plaintext copy behind when encryption was requested. The leader
+                    # asked for discard_output, so this name is always the one this flight created
+                    # (a hard link at most), never an earlier backup returned as unchanged.
+                    self.logger.info(f"Deleting original unencrypted file: {backup_file_path}")
+                    for path in (backup_file_path, page_hash_path(backup_file_path),
+                                 backup_file_path.with_suffix(backup_file_path.suffix + '.meta')):
+                        if path.exists():
+                            path.unlink()
+                    self.backup_manager.catalog.remove(backup_file_path.name)
+                for job_id, options, final_path in finished:
+                    if final_path:
+                        self._complete_job(job_id, options, final_path)
+            finally:
+                db.session.remove()
+
+    def _finish_job(self, job_id: int, options: Dict[str, Any], backup_file_path: Optional[Path],
+                    error: Optional[Exception]) -> Optional[Path]:
+        """Encrypt (if requested) one job of a finished flight; returns its file, or None once marked failed"""
+        try:
+            record = db.session.get(BackupRecord, job_id)
+            if not record:
+                self.logger.error(f"Backup job {job_id} vanished before it finished")
+                return None
+            if error:
+                raise error
+
+            if options['encrypt_gpg'] and not options['encrypt_to']:
+                if record.status != self.RUNNING:
+                    record.mark_running()
+                return self._encrypt(backup_file_path, options['gpg_email'], options['encryption_engine'],
+                                     self._progress_reporter(job_id))
+            return backup_file_path
+
+        except Exception as e:
+            self._fail_job(job_id, options, e, logged=e is error)
+            return None
+
+    def _complete_job(self, job_id: int, options: Dict[str, Any], final_path: Path):
+        """Record a finished job's file and tell its clients it is done"""
+        try:
+            record = db.session.get(BackupRecord, job_id)
+            if not record:
+                self.logger.error(f"Backup job {job_id} vanished before it finished")
+                return
+            record.filename = final_path.name
+            record.file_path = str(final_path)
+            record.is_encrypted = options['encrypt_gpg']
+            record.encryption_engine = options['encryption_engine']
+            # Dedup manifests are plain JSON; their chunks carry the job's codec
+            codec = get_codec(options['codec'])
+            record.compression_type = codec.name if codec.compresses else None
+            # Read from the sidecar for plain backups; GPG output is hashed here
+            record.mark_completed(file_size=final_path.stat().st_size,
+                                  checksum=self.backup_manager.backup_checksum(final_path))
+            self._publish(job_id, {'stage': 'done', 'status': self.COMPLETED, 'fraction': 1.0})
+            self.logger.info(f"Backup job {job_id} completed: {final_path}")
+
+        except Exception as e:
+            self._fail_job(job_id, options, e)
+
+    def _fail_job(self, job_id: int, options: Dict[str, Any], e: Exception, logged: bool = False):
+        """Mark a job failed and publish its final event"""
+        if not logged:
+            self.logger.error(f"Backup job {job_id} failed: {str(e)}", exc_info=True)
+        db.session.rollback()
+        record = db.session.get(BackupRecord, job_id)
+        if record:
+            record.mark_failed(self._describe_error(e, options.get('gpg_email')))
+        self._publish(job_id, {'stage': 'done', 'status': self.FAILED})
+
+    def _flight_reporter(self, flight_key: str):
+        """Progress callback that fans snapshot progress out to every job in a flight"""
+        reporters: Dict[int, Any] = {}
+
+        def report(event: Dict[str, Any]):
+            with self._flights_lock:
+                job_ids = [job_id for job_id, _ in self._flights.get(flight_key, [])]
+            for job_id in job_ids:
+                if job_id not in reporters:
+                    reporters[job_id] = self._progress_reporter(job_id)
+                    record = db.session.get(BackupRecord, job_id)
+                    if record:
+                        record.mark_running()
+                reporters[job_id](event)
+
+        return report
+
+    def _check_encryption_key(self, gpg_email: str, engine: str = 'gpg'):
+        """Make sure the recipient's key is available before a pipelined encrypted snapshot starts"""
+        if engine != 'gpg':
+            if not self.backup_manager.envelope.has_public_key(gpg_email):
+                raise RuntimeError(f"No public key found for {gpg_email}")
+            return
+        if not self.gpg_backup:
+            raise RuntimeError('GPG encryption not available.')
+        if not self.gpg_backup.ensure_encryption_key(gpg_email):
+            raise RuntimeError(f"No public key found for {gpg_email}")
+
+    def _encrypt(self, backup_file_path: Path, gpg_email: str, engine: str = 'gpg', progress_callback=None) -> Path:
+        """Encrypt a finished backup into its own .gpg/.enc file (the plaintext is left for the flight to remove)"""
+        if engine == 'gpg' and not self.gpg_backup:
+            raise RuntimeError('GPG encryption not available.')
+
+        # Jobs sharing a snapshot each get their own ciphertext
+        suffix = self.backup_manager.ENCRYPTION_ENGINES[engine]
+        base, _, extensions = backup_file_path.name.partition('.')
+        output_path = backup_file_path.with_name(f"{backup_file_path.name}{suffix}")
+        sequence = 1
+        while output_path.exists():
+            sequence += 1
+            output_path = backup_file_path.with_name(f"{base}_{sequence}.{extensions}{suffix}")
+
+        if engine != 'gpg':
+            self._check_encryption_key(gpg_email, engine)
+            self.logger.info(f"Starting {engine} encryption for {gpg_email}")
+            return self.backup_manager.envelope.encrypt_file(backup_file_path, [gpg_email], output_path)
+
+        self.logger.info(f"Starting GPG encryption for {gpg_email}")
+        encrypted_file_path = self.gpg_backup.create_encrypted_backup(
+            input_filepath=backup_file_path,
+            recipient_email=gpg_email,
+            progress_callback=progress_callback,
+            output_filepath=output_path
+        )
+        if not encrypted_file_path or not encrypted_file_path.exists():
+            raise RuntimeError("GPG encryption failed: No encrypted file returned.")
+        return encrypted_file_path
+
+    def _progress_reporter(self, job_id: int):
+        """Build the progress callback for one job, adding elapsed time, ETA and throughput per stage"""
+        stage_started: Dict[str, float] = {}
+        last_event = [time.monotonic()]
+
+        def report(event: Dict[str, Any]):
+            now = time.monotonic()
+            # A stage starts where the previous one left off, so its first chunk is timed too
+            elapsed = now - stage_started.setdefault(event['stage'], last_event[0])
+            last_event[0] = now
+            event = dict(event, elapsed_seconds=round(elapsed, 2))
+
+            fraction = event.get('fraction')
+            if fraction is not None and elapsed > 0:
+                event['eta_seconds'] = round(elapsed * (1 - fraction) / fraction, 1) if fraction > 0 else None
+            bytes_done = event.get('bytes_encrypted', event.get('bytes_compressed'))
+            if bytes_done and elapsed > 0:
+                event['throughput_mb_s'] = round(bytes_done / elapsed / (1024 * 1024), 2)
+
+            self._publish(job_id, event)
+
+        return report
+
+    def _publish(self, job_id: int, event: Dict[str, Any]):
+        """Store the latest progress event for a job and wake any event streams"""
+        with self._progress_cond:
+            self._progress_version += 1
+            self._progress[job_id] = dict(event, job_id=job_id, version=self._progress_version)
+            while len(self._progress) > self.PROGRESS_HISTORY:
+                self._progress.pop(next(iter(self._progress)))
+            self._progress_cond.notify_all()
+
+    def wait_for_progress(self, job_id: int, last_version: Optional[int] = None,
+                          timeout: float = 15.0) -> Tuple[Optional[int], Optional[Dict[str, Any]]]:
+        """
+        Block until the job publishes a progress event newer than last_version.
+
+        Progress lives in this process only; with several worker processes a
+        stream served by another worker sees no events and falls back on the
+        job status stored in BackupRecord.
+
+        Returns:
+            (version, event), or (last_version, None) on timeout
+        """
+        def has_update():
+            event = self._progress.get(job_id)
+            return event is not None and event['version'] != last_version
+
+        with self._progress_cond:
+            if self._progress_cond.wait_for(has_update, timeout=timeout):
+                event = dict(self._progress[job_id])
+                return event['version'], event
+        return last_version, None
+
+    @staticmethod
+    def _describe_error(error: Exception, gpg_email: Optional[str]) -> str:
+        """Turn a worker exception into the message shown to the user"""
+        message = str(error)
+        if 'no public key' in message.lower():
+            return f'No public key found for {gpg_email}. Please import the key first.'
+        if 'gpg' in message.lower():
+            return f'GPG encryption error: {message}'
+        return message or 'Backup creation failed.'
+
+    def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Return the state of a job, or None if no such job exists"""
+        record = db.session.get(BackupRecord, job_id, populate_existing=True)
+        if not record:
+            return None
+        return {
+            'job_id': record.id,
+            'status': record.status,
+            'completed': record.status == self.COMPLETED,
+            'failed': record.status == self.FAILED,
+            'filename': record.filename,
+            'encrypted': bool(record.is_encrypted),
+            'encryption_engine': record.encryption_engine,
+            'file_size': record.file_size,
+            'error': record.error_message,
+            'created_at': record.created_at.isoformat() if record.created_at else None,
+            'completed_at': record.completed_at.isoformat() if record.completed_at else None
+        }
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting jobs and optionally wait for running ones"""
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,135 @@
+"""
+Backup Coordination
+Serializes snapshot work across threads, worker processes and hosts that
+share backup_dir, and hands waiting callers the result of the run in flight
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Callable, Dict, Any
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows; runs are then only serialized within this process
+    fcntl = None
+
+
+class BackupCoordinator:
+    """
+    Run backups one at a time under a flock on backup_dir/backup.lock.
+
+    The holder records the run it is doing in backup_dir/coordinator_state.json
+    and, when it finishes, its result. A caller that finds an identical run
+    (same key) in flight when it arrives waits for the lock and returns that
+    run's file instead of copying the database again. Anything else waits
+    its turn and runs its own backup.
+
+    The lock is taken on a file opened per call, so threads of one process
+    exclude each other as well. flock also works for hosts sharing backup_dir
+    over NFS (Linux maps it onto NFS byte-range locks).
+    """
+
+    LOCK_FILE = 'backup.lock'
+    STATE_FILE = 'coordinator_state.json'
+    # Results kept for callers that were still waiting when later runs finished
+    RECENT_RESULTS = 20
+
+    def __init__(self, backup_dir: Path, logger, timeout_seconds: float = 3600):
+        self.lock_path = Path(backup_dir) / self.LOCK_FILE
+        self.state_path = Path(backup_dir) / self.STATE_FILE
+        self.logger = logger
+        self.timeout_seconds = timeout_seconds
+        self._local_lock = threading.Lock() # Stands in for flock where fcntl is missing
+
+    def run(self, key: str, func: Callable[[], Optional[Path]], coalesce: bool = True) -> Optional[Path]:
+        """
+        Run 'func' under the backup lock, or share an identical run in flight.
+
+        Args:
+            key: Identifies runs that produce interchangeable backups
+            func: Creates the backup; returns its path or None
+            coalesce: Allow returning the result of an in-flight run with the same key
+
+        Returns:
+            Path returned by func (ours or the shared run's), or None
+
+        Raises:
+            TimeoutError: If the lock is not acquired within timeout_seconds
+        """
+        inflight = self._load_state().get('inflight') if coalesce else None
+        joinable = inflight if inflight and inflight.get('key') == key else None
+        if joinable:
+            self.logger.info(f"Backup already running in process {joinable.get('pid')}; waiting for its result")
+
+        with self.locked():
+            state = self._load_state()
+            if joinable:
+                result = state.get('results', {}).get(joinable['id'])
+                if result and result.get('path') and Path(result['path']).exists():
+                    self.logger.info(f"Sharing in-flight backup {Path(result['path']).name}")
+                    return Path(result['path'])
+
+            run_id = uuid.uuid4().hex
+            state['inflight'] = {'id': run_id, 'key': key, 'pid': os.getpid(), 'started': time.time()}
+            self._save_state(state)
+            path = None
+            try:
+                path = func()
+                return path
+            finally:
+                state = self._load_state()
+                state['inflight'] = None
+                results = state.get('results', {})
+                results[run_id] = {'key': key, 'path': str(path) if path else None, 'finished': time.time()}
+                newest = sorted(results.items(), key=lambda item: item[1]['finished'])[-self.RECENT_RESULTS:]
+                state['results'] = dict(newest)
+                self._save_state(state)
+
+    def inflight(self) -> Optional[Dict[str, Any]]:
+        """The run currently holding the lock, if any (as recorded by its holder)"""
+        return self._load_state().get('inflight')
+
+    @contextmanager
+    def locked(self):
+        """Hold the backup lock for work that must not overlap a backup (e.g. chunk garbage collection)"""
+        deadline = time.monotonic() + self.timeout_seconds
+        if fcntl is None:
+            if not self._local_lock.acquire(timeout=self.timeout_seconds):
+                raise TimeoutError(f"Timed out after {self.timeout_seconds}s waiting for the backup lock")
+            try:
+                yield
+            finally:
+                self._local_lock.release()
+            return
+
+        with open(self.lock_path, 'a') as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError(f"Timed out after {self.timeout_seconds}s waiting for the backup lock")
+                    time.sleep(0.1)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_state(self) -> Dict[str, Any]:
+        try:
+            with self.state_path.open('r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, state: Dict[str, Any]):
+        temp_path = self.state_path.with_name(f"{self.state_path.name}.{os.getpid()}.tmp")
+        with temp_path.open('w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.state_path)
@@ -0,0 +1,308 @@
+"""
+Backup Retention
+Grandfather-father-son retention: plans which backups to keep in one pass
+over backup_dir and deletes the rest in background batches
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional, Dict, List, Any, Iterable
+
+from backup_catalog import is_backup_file_name, backup_time
+from backup_compression import codec_for_path
+from backup_dedup import MANIFEST_SUFFIX
+from backup_differential import PAGE_HASH_SUFFIX, is_differential, read_differential_header
+from models import db, BackupRecord
+
+
+SIDECAR_SUFFIXES = ('.meta', PAGE_HASH_SUFFIX)
+# Sidecars without a backup are only removed once this old (their backup may still be being written)
+ORPHAN_GRACE_SECONDS = 3600
+
+# Tier name -> bucket a backup time falls into; the newest backup of each bucket is kept
+_TIER_BUCKETS = (
+    ('hourly', lambda t: t.strftime('%Y-%m-%d %H')),
+    ('daily', lambda t: t.strftime('%Y-%m-%d')),
+    ('weekly', lambda t: '%d-W%02d' % t.isocalendar()[:2]),
+    ('monthly', lambda t: t.strftime('%Y-%m')),
+)
+
+
+class RetentionPolicy:
+    """
+    How many backups each tier keeps.
+
+    A backup survives if any rule keeps it: one of the keep_last newest, the
+    newest backup of each of the last N hours/days/ISO weeks/months that
+    have backups, or anything younger than keep_within_days.
+    """
+
+    def __init__(self, keep_last: int = 3, hourly: int = 24, daily: int = 7, weekly: int = 4,
+                 monthly: int = 12, keep_within_days: float = 0):
+        # At least the newest backup always survives
+        self.keep_last = max(1, keep_last)
+        self.tiers = {'hourly': hourly, 'daily': daily, 'weekly': weekly, 'monthly': monthly}
+        self.keep_within_days = keep_within_days
+
+    @classmethod
+    def from_config(cls, config) -> 'RetentionPolicy':
+        return cls(
+            keep_last=int(config.get('BACKUP_RETENTION_KEEP_LAST', 3)),
+            hourly=int(config.get('BACKUP_RETENTION_HOURLY', 24)),
+            daily=int(config.get('BACKUP_RETENTION_DAILY', 7)),
+            weekly=int(config.get('BACKUP_RETENTION_WEEKLY', 4)),
+            monthly=int(config.get('BACKUP_RETENTION_MONTHLY', 12)),
+            keep_within_days=float(config.get('BACKUP_RETENTION_KEEP_WITHIN_DAYS', 0))
+        )
+
+    def describe(self) -> Dict[str, Any]:
+        return dict(self.tiers, keep_last=self.keep_last, keep_within_days=self.keep_within_days)
+
+
+def plan_retention(backup_dir: Path, policy: RetentionPolicy, protected: Optional[Dict[str, str]] = None,
+                   now: Optional[datetime] = None) -> Dict[str, Any]:
+    """
+    Decide which backups to keep, from a single os.scandir pass over backup_dir.
+
+    Backups are dated like the catalog does (mtime, or created_at for a name
+    hard-linked to an unchanged earlier backup). Kept differentials keep
+    their base backup. Nothing is deleted here; hand the plan to
+    RetentionExecutor (or just report it, for a dry run).
+
+    Args:
+        backup_dir: Directory holding the backups
+        policy: Tiers to apply
+        protected: Backup names to keep whatever the tiers say, with the reason
+        now: Reference time for keep_within_days (defaults to now)
+
+    Returns:
+        Dict with 'keep' (name -> reasons), 'delete' (backups with their
+        sidecar files, oldest first), 'orphans' (sidecars without a backup)
+        and 'bytes_to_free'
+    """
+    backup_dir = Path(backup_dir)
+    now = now or datetime.now()
+    backups: Dict[str, Dict[str, Any]] = {}
+    sidecars: Dict[str, List[str]] = {}
+    sidecar_times: Dict[str, float] = {}
+
+    with os.scandir(backup_dir) as entries:
+        for entry in entries:
+            if not entry.name.startswith('backup_'):
+                continue
+            try:
+                if entry.name.endswith(SIDECAR_SUFFIXES):
+                    owner = entry.name.rsplit('.', 1)[0]
+                    sidecar_times[entry.name] = entry.stat().st_mtime
+                    sidecars.setdefault(owner, []).append(entry.name)
+                elif is_backup_file_name(entry.name) and entry.is_file():
+                    stat = entry.stat()
+                    backups[entry.name] = {'name': entry.name, 'size': stat.st_size,
+                                           'time': datetime.fromtimestamp(backup_time(Path(entry.path), stat))}
+            except FileNotFoundError:
+                continue # Deleted while scanning
+
+    newest_first = sorted(backups.values(), key=lambda b: (b['time'], b['name']), reverse=True)
+    keep: Dict[str, List[str]] = {}
+
+    def mark(name: str, reason: str):
+        keep.setdefault(name, []).append(reason)
+
+    for backup in newest_first[:policy.keep_last]:
+        mark(backup['name'], 'last')
+    for tier, bucket_of in _TIER_BUCKETS:
+        count = policy.tiers[tier]
+        buckets = set()
+        for backup in newest_first:
+            if len(buckets) >= count:
+                break
+            bucket = bucket_of(backup['time'])
+            if bucket not in buckets:
+                buckets.add(bucket)
+                mark(backup['name'], tier)
+    if policy.keep_within_days:
+        cutoff = now - timedelta(days=policy.keep_within_days)
+        for backup in newest_first:
+            if backup['time'] < cutoff:
+                break
+            mark(backup['name'], 'within')
+    for name, reason in (protected or {}).items():
+        if name in backups:
+            mark(name, reason)
+
+    # A differential is useless without its base
+    for name in [name for name in keep if is_differential(Path(name))]:
+        base = _differential_base(backup_dir / name)
+        if base in backups:
+            mark(base, f'base of {name}')
+
+    delete = []
+    for backup in reversed(newest_first):
+        if backup['name'] not in keep:
+            delete.append(dict(backup, files=[backup['name']] + sidecars.get(backup['name'], [])))
+    orphan_cutoff = now.timestamp() - ORPHAN_GRACE_SECONDS
+    orphans = sorted(name for owner, names in sidecars.items() if owner not in backups
+                     for name in names if sidecar_times[name] < orphan_cutoff)
+
+    return {
+        'created_at': now,
+        'policy': policy.describe(),
+        'keep': keep,
+        'delete': delete,
+        'orphans': orphans,
+        'bytes_to_free': sum(backup['size'] for backup in delete)
+    }
+
+
+def _differential_base(backup_path: Path) -> Optional[str]:
+    """Name of the full backup a differential applies to (from its .meta, else its header)"""
+    try:
+        with backup_path.with_suffix(backup_path.suffix + '.meta').open('r') as f:
+            base = json.load(f).get('base_backup')
+        if base:
+            return base
+    except (OSError, ValueError):
+        pass
+    try:
+        with codec_for_path(backup_path).open_reader(backup_path) as f_in:
+            return read_differential_header(f_in)['base_backup']
+    except Exception as e:
+        logging.getLogger('backup').warning(f"Could not read base of differential {backup_path.name}: {str(e)}")
+        return None
+
+
+class RetentionExecutor:
+    """
+    Carry out retention plans on a background thread, in batches.
+
+    For each batch the catalog rows and BackupRecord rows are removed and
+    committed together first, then the files and their sidecars are
+    unlinked. A file left behind (unlink failed, or the process died in
+    between) is listed again by the catalog's next sync and deleted by a
+    later plan. Only one plan runs at a time.
+    """
+
+    def __init__(self, backup_manager, batch_size: int = 100, batch_pause_seconds: float = 0.05):
+        self.backup_manager = backup_manager
+        self.logger = backup_manager.logger
+        self.batch_size = max(1, batch_size)
+        self.batch_pause_seconds = batch_pause_seconds
+        # Flask app, attached by the app factory; BackupRecord rows are only removed when set
+        self.app = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last_result: Optional[Dict[str, Any]] = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def submit(self, plan: Dict[str, Any]) -> bool:
+        """Start deleting what the plan says; False if a previous plan is still running"""
+        with self._lock:
+            if self.is_running():
+                self.logger.info("Retention run already in progress; skipping this plan")
+                return False
+            self._thread = threading.Thread(target=self._run, args=(plan,), name='backup-retention', daemon=True)
+            self._thread.start()
+            return True
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the running plan; True once nothing is running"""
+        thread = self._thread
+        if thread:
+            thread.join(timeout)
+        return not self.is_running()
+
+    def _run(self, plan: Dict[str, Any]):
+        result = {'deleted': 0, 'bytes_freed': 0, 'failed': 0, 'orphans': 0}
+        started = time.monotonic()
+        try:
+            delete = plan['delete']
+            for start in range(0, len(delete), self.batch_size):
+                batch = self._delete_batch(delete[start:start + self.batch_size])
+                result['deleted'] += len(batch)
+                result['bytes_freed'] += sum(backup['size'] for backup in batch)
+                result['failed'] += min(self.batch_size, len(delete) - start) - len(batch)
+                if self.batch_pause_seconds:
+                    time.sleep(self.batch_pause_seconds) # Leave the disk to foreground work between batches
+
+            for name in plan['orphans']:
+                try:
+                    (self.backup_manager.app_paths.backup_dir / name).unlink()
+                    result['orphans'] += 1
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    self.logger.error(f"Failed to delete orphaned {name}: {str(e)}")
+
+            if any(backup['name'].endswith(MANIFEST_SUFFIX) for backup in delete):
+                self.backup_manager.collect_chunk_garbage()
+        except Exception as e:
+            self.logger.error(f"Retention run failed: {str(e)}", exc_info=True)
+        finally:
+            result['duration_seconds'] = round(time.monotonic() - started, 3)
+            self.last_result = result
+            self.logger.info(f"Retention completed: {result['deleted']} backups deleted "
+                             f"({result['bytes_freed']} bytes), {result['failed']} failed, "
+                             f"{result['orphans']} orphaned sidecars removed")
+
+    def _delete_batch(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Delete one batch; returns the backups actually removed"""
+        # Rows first: once they are committed nothing lists these backups, so no restore or
+        # download can pick one up while its file is going away
+        self._remove_rows([backup['name'] for backup in batch])
+
+        backup_dir = self.backup_manager.app_paths.backup_dir
+        deleted = []
+        for backup in batch:
+            try:
+                (backup_dir / backup['name']).unlink()
+            except FileNotFoundError:
+                pass # Already gone; still drop its sidecars
+            except OSError as e:
+                # Still on disk, so the catalog's next sync lists it again and a later plan retries
+                self.logger.error(f"Failed to delete {backup['name']}: {str(e)}")
+                continue
+            for name in backup['files'][1:]:
+                try:
+                    (backup_dir / name).unlink()
+                except FileNotFoundError:
+                    pass
+            deleted.append(backup)
+            self.logger.info(f"Deleted old backup: {backup['name']}")
+        return deleted
+
+    def _remove_rows(self, names: List[str]):
+        with self.backup_manager.catalog.transaction() as conn:
+            conn.executemany("DELETE FROM backups WHERE name = ?", [(name,) for name in names])
+            if self.app is None:
+                return
+            with self.app.app_context():
+                try:
+                    # Per-object deletes, so the BackupStats mapper events see every row
+                    for record in BackupRecord.query.filter(BackupRecord.filename.in_(names)).all():
+                        db.session.delete(record)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    raise # Rolls the catalog transaction back too
+                finally:
+                    db.session.remove()
+
+
+def format_plan(plan: Dict[str, Any]) -> Iterable[str]:
+    """Human-readable lines describing a plan (for dry runs)"""
+    yield f"Policy: {plan['policy']}"
+    for name, reasons in sorted(plan['keep'].items(), reverse=True):
+        yield f"  keep    {name} ({', '.join(reasons)})"
+    for backup in plan['delete']:
+        yield f"  delete  {backup['name']} ({backup['size']} bytes, {backup['time'].isoformat()})"
+    for name in plan['orphans']:
+        yield f"  orphan  {name}"
+    yield (f"{len(plan['keep'])} kept, {len(plan['delete'])} to delete "
+           f"({plan['bytes_to_free']} bytes), {len(plan['orphans'])} orphaned sidecars")
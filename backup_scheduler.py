@@ -0,0 +1,185 @@
+"""
+Scheduled Backups
+Runs periodic backups, retention cleanup and stats reconciliation inside
+the app process, driven by AUTO_BACKUP_ENABLED / BACKUP_SCHEDULE_HOURS /
+BACKUP_RETENTION_* / BACKUP_STATS_RECONCILE_HOURS
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Dict
+
+import schedule
+
+from models import BackupStats
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows; every process then schedules on its own
+    fcntl = None
+
+
+class BackupScheduler:
+    """
+    Run backups, retention cleanup and stats reconciliation on a background thread.
+
+    Jobs use the 'schedule' library with a randomised interval (for backups,
+    BACKUP_SCHEDULE_HOURS) plus up to BACKUP_SCHEDULE_JITTER_MINUTES, so
+    several deployments sharing storage do not all fire at once. Missed runs
+    are coalesced: however long the process was down or busy, an overdue job
+    runs once. The time of the last run is kept in
+    backup_dir/scheduler_state.json so a restart does not trigger an early
+    backup, and only the process holding backup_dir/scheduler.lock runs jobs;
+    the other workers wait to take over if it exits.
+    """
+
+    STATE_FILE = 'scheduler_state.json'
+    LOCK_FILE = 'scheduler.lock'
+
+    def __init__(self, app, backup_manager, backup_jobs=None):
+        """
+        Initialize the scheduler.
+
+        Args:
+            app: Flask application (jobs push their own app context)
+            backup_manager: DatabaseBackup instance
+            backup_jobs: BackupJobManager used to run backups; backups run inline when None
+        """
+        self.app = app
+        self.backup_manager = backup_manager
+        self.backup_jobs = backup_jobs
+        self.logger = logging.getLogger('backup')
+
+        config = app.config
+        self.interval_minutes = max(1, int(float(config.get('BACKUP_SCHEDULE_HOURS', 24)) * 60))
+        self.jitter_minutes = max(0, int(config.get('BACKUP_SCHEDULE_JITTER_MINUTES', 10)))
+        self.reconcile_minutes = max(1, int(float(config.get('BACKUP_STATS_RECONCILE_HOURS', 24)) * 60))
+        self.backup_format = config.get('BACKUP_SCHEDULE_FORMAT', 'zip')
+        self.poll_seconds = float(config.get('BACKUP_SCHEDULER_POLL_SECONDS', 30))
+
+        self.state_path = backup_manager.app_paths.backup_dir / self.STATE_FILE
+        self.scheduler = schedule.Scheduler()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_file = None
+
+    # --- Lifecycle ---
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='backup-scheduler', daemon=True)
+        self._thread.start()
+        self.logger.info(f"Backup scheduler started: every {self.interval_minutes} min "
+                         f"(+ up to {self.jitter_minutes} min jitter)")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.poll_seconds + 5)
+        self.scheduler.clear()
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def is_leader(self) -> bool:
+        """True if this process holds the scheduler lock and runs the jobs"""
+        return self._lock_file is not None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if not self.is_leader() and self._acquire_lock():
+                    self._schedule_jobs()
+                if self.is_leader():
+                    self.scheduler.run_pending()
+            except Exception as e:
+                self.logger.error(f"Backup scheduler error: {str(e)}", exc_info=True)
+            self._stop.wait(self.poll_seconds)
+
+    def _acquire_lock(self) -> bool:
+        lock_file = open(self.backup_manager.app_paths.backup_dir / self.LOCK_FILE, 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False # Another worker process is scheduling
+        self._lock_file = lock_file
+        self.logger.info(f"Backup scheduler active in process {os.getpid()}")
+        return True
+
+    # --- Jobs ---
+
+    def _schedule_jobs(self):
+        """Register the jobs, resuming from the last recorded runs"""
+        self.scheduler.clear()
+        state = self._load_state()
+        jobs = (('backup', self.run_backup, self.interval_minutes),
+                ('cleanup', self.run_cleanup, self.interval_minutes),
+                ('reconcile', self.run_reconcile, self.reconcile_minutes))
+        for name, func, interval in jobs:
+            job = self.scheduler.every(interval).to(interval + self.jitter_minutes).minutes.do(self._run_job, name, func)
+            last_run = state.get(name)
+            if last_run is None:
+                continue # First start: wait one interval like the 'schedule' default
+            # Coalesce: an overdue job runs once now, otherwise it resumes where the last process left off
+            due = datetime.fromtimestamp(last_run) + timedelta(
+                minutes=interval + random.randint(0, self.jitter_minutes))
+            job.next_run = max(datetime.now(), due)
+
+    def _run_job(self, name: str, func):
+        started = time.time()
+        try:
+            func()
+        finally:
+            # Recorded even on failure, so a broken backup does not retry every poll
+            state = self._load_state()
+            state[name] = started
+            self._save_state(state)
+
+    def run_backup(self):
+        """Start one scheduled backup"""
+        with self.app.app_context():
+            if self.backup_jobs:
+                record = self.backup_jobs.submit(format=self.backup_format, backup_type='scheduled')
+                self.logger.info(f"Scheduled backup queued as job {record.id}")
+            else:
+                backup_path = self.backup_manager.create_backup(format=self.backup_format, backup_type='scheduled',
+                                                                description='Scheduled backup')
+                if not backup_path:
+                    self.logger.error("Scheduled backup failed")
+
+    def run_cleanup(self):
+        """Apply the retention policy (deletions continue in the background)"""
+        with self.app.app_context():
+            planned = self.backup_manager.cleanup_old_backups()
+        self.logger.info(f"Scheduled cleanup queued {planned} backups for deletion")
+
+    def run_reconcile(self):
+        """Recompute the running backup statistics from their sources"""
+        self.backup_manager.reconcile_stats()
+        with self.app.app_context():
+            BackupStats.reconcile()
+
+    def next_runs(self) -> Dict[str, Optional[datetime]]:
+        """Next run time of each job (empty unless this process is the leader)"""
+        return {job.job_func.args[0]: job.next_run for job in self.scheduler.get_jobs()}
+
+    # --- State ---
+
+    def _load_state(self) -> Dict[str, float]:
+        try:
+            with self.state_path.open('r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, state: Dict[str, float]):
+        temp_path = self.state_path.with_name(self.state_path.name + '.tmp')
+        with temp_path.open('w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.state_path)
@@ -0,0 +1,372 @@
+"""
+Bulk Backup Verification
+Checks the whole backup set on a process pool: checksum, in-memory rebuild
+and PRAGMA quick_check, within a memory and I/O budget
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Dict, List, Any, Callable
+
+from backup_catalog import ENCRYPTED_SUFFIXES, is_backup_file_name
+from backup_compression import CHECKSUM_ALGORITHM, codec_for_path, file_checksum
+from backup_container import ContainerReader, read_container_header, CONTAINER_SUFFIX
+from backup_dedup import ChunkStore, MANIFEST_SUFFIX
+from backup_differential import (is_differential, read_differential_header, apply_differential,
+                                 apply_differential_to_image)
+
+# Connection.deserialize arrived in Python 3.11; without it images are always rebuilt in a temp file
+_CAN_DESERIALIZE = hasattr(sqlite3.Connection, 'deserialize')
+
+
+class _Throttle:
+    """Keeps one worker's reads under bytes_per_second (unlimited when 0)"""
+
+    def __init__(self, bytes_per_second: float):
+        self.bytes_per_second = bytes_per_second
+        self.started = time.monotonic()
+        self.consumed = 0
+
+    def consume(self, n: int):
+        if not self.bytes_per_second:
+            return
+        self.consumed += n
+        ahead = self.consumed / self.bytes_per_second - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class _CheckedFile:
+    """Raw backup file read through the I/O budget and hashed on the way, so the checksum costs no extra read"""
+
+    def __init__(self, path: Path, throttle: _Throttle, algorithm: str = CHECKSUM_ALGORITHM):
+        self.name = str(path)
+        self.mode = 'rb'
+        self._file = open(path, 'rb')
+        self._throttle = throttle
+        self._hash = hashlib.new(algorithm)
+
+    def read(self, n: int = -1) -> bytes:
+        data = self._file.read(n)
+        self._hash.update(data)
+        self._throttle.consume(len(data))
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        self._file.close()
+
+    def hexdigest(self) -> str:
+        # Whatever the decompressor left unread still counts (e.g. trailing padding)
+        while self.read(1024 * 1024):
+            pass
+        return self._hash.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class _ImageBuilder:
+    """
+    Collects a rebuilt database in memory, spilling to a temp file past
+    memory_limit bytes (or from the start where sqlite3 cannot deserialize)
+    """
+
+    def __init__(self, memory_limit: int, temp_dir: Path):
+        self.memory_limit = memory_limit
+        self.temp_dir = temp_dir
+        self.image: Optional[bytearray] = bytearray() if _CAN_DESERIALIZE else None
+        self.path: Optional[Path] = None
+        self._file = None
+
+    def write(self, data: bytes):
+        if self.image is not None and len(self.image) + len(data) > self.memory_limit:
+            self._spill()
+        if self.image is not None:
+            self.image += data
+        else:
+            if self._file is None:
+                self._spill()
+            self._file.write(data)
+
+    def _spill(self):
+        fd, name = tempfile.mkstemp(prefix='verify_', suffix='.db', dir=self.temp_dir)
+        self.path = Path(name)
+        self._file = os.fdopen(fd, 'wb')
+        if self.image:
+            self._file.write(self.image)
+        self.image = None
+
+    def finish(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        return self
+
+    def discard(self):
+        self.finish()
+        if self.path and self.path.exists():
+            self.path.unlink()
+
+
+def _read_metadata(backup_path: Path) -> Dict[str, Any]:
+    try:
+        with backup_path.with_suffix(backup_path.suffix + '.meta').open('r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _build_image(backup_path: Path, builder: _ImageBuilder, throttle: _Throttle, chunk_root: Path) -> Optional[str]:
+    """
+    Rebuild the database a backup holds into builder; returns the raw file's
+    checksum (None for manifests and containers, hashed separately)
+    """
+    if backup_path.suffix == MANIFEST_SUFFIX:
+        for chunk in ChunkStore(chunk_root).iter_backup(backup_path):
+            throttle.consume(len(chunk))
+            builder.write(chunk)
+        return None
+    if backup_path.suffix == CONTAINER_SUFFIX:
+        # Every chunk is checked against the container's index as it is opened
+        with ContainerReader(backup_path) as container:
+            for number, chunk in enumerate(container.iter_chunks()):
+                throttle.consume(container.stored_length(number))
+                builder.write(chunk)
+        return None
+
+    with _CheckedFile(backup_path, throttle) as raw:
+        with codec_for_path(backup_path).open_reader(raw) as f_in:
+            if is_differential(backup_path):
+                header = read_differential_header(f_in)
+                base_path = backup_path.parent / header['base_backup']
+                if not base_path.exists() or is_differential(base_path):
+                    raise IOError(f"Base backup {header['base_backup']} is missing")
+                _build_image(base_path, builder, throttle, chunk_root)
+                builder.finish()
+                if builder.image is not None:
+                    apply_differential_to_image(f_in, header, builder.image)
+                else:
+                    apply_differential(f_in, header, builder.path)
+            else:
+                for chunk in iter(lambda: f_in.read(1024 * 1024), b''):
+                    builder.write(chunk)
+            # Before the reader closes: for plain backups it is the raw file itself
+            return raw.hexdigest()
+
+
+def verify_file(backup_path: str, chunk_root: str, temp_dir: str, deep: bool = True,
+                memory_limit: int = 256 * 1024 * 1024, io_bytes_per_second: float = 0) -> Dict[str, Any]:
+    """
+    Verify one backup (runs in a pool worker; arguments and result are picklable).
+
+    The fast check compares the file's checksum with the one recorded in its
+    metadata. The deep check also rebuilds the database, in memory through
+    sqlite3 deserialize when it fits in memory_limit and Python has it (else
+    via a temp file), and runs PRAGMA quick_check. The checksum is taken
+    from the same read.
+
+    Returns:
+        Dict with name, status ('ok', 'failed' or 'skipped'), checks run, error and timing
+    """
+    path = Path(backup_path)
+    started = time.monotonic()
+    result = {'name': path.name, 'path': backup_path, 'status': 'ok', 'deep': deep, 'checksum_ok': None,
+              'quick_check': None, 'error': None, 'in_memory': None, 'size': 0}
+    builder = None
+    try:
+        result['size'] = path.stat().st_size
+        if path.suffix in ENCRYPTED_SUFFIXES or (deep and path.suffix == CONTAINER_SUFFIX
+                                                 and read_container_header(path).get('encryption')):
+            result['status'] = 'skipped'
+            result['error'] = 'Encrypted backups can only be checked after decryption'
+            return result
+
+        metadata = _read_metadata(path)
+        expected = metadata.get('checksum')
+        algorithm = metadata.get('checksum_algorithm', CHECKSUM_ALGORITHM)
+        throttle = _Throttle(io_bytes_per_second)
+
+        if not deep:
+            if not expected:
+                result['status'] = 'skipped'
+                result['error'] = 'No checksum recorded'
+                return result
+            with _CheckedFile(path, throttle, algorithm) as raw:
+                result['checksum_ok'] = raw.hexdigest() == expected
+        else:
+            builder = _ImageBuilder(memory_limit, Path(temp_dir))
+            actual = _build_image(path, builder, throttle, Path(chunk_root))
+            builder.finish()
+            if expected:
+                if actual is None or algorithm != CHECKSUM_ALGORITHM:
+                    actual = file_checksum(path, algorithm)
+                result['checksum_ok'] = actual == expected
+
+            result['in_memory'] = builder.image is not None
+            if builder.image is not None:
+                conn = sqlite3.connect(':memory:')
+                conn.deserialize(builder.image) # Copied once, into SQLite's own allocation
+                builder.image = None # Freed before quick_check runs
+            else:
+                conn = sqlite3.connect(f"file:{builder.path}?mode=ro", uri=True)
+            try:
+                rows = [row[0] for row in conn.execute("PRAGMA quick_check")]
+            finally:
+                conn.close()
+            result['quick_check'] = 'ok' if rows == ['ok'] else '; '.join(rows[:5])
+
+        if result['checksum_ok'] is False:
+            result['status'] = 'failed'
+            result['error'] = 'Checksum mismatch'
+        elif result['quick_check'] not in (None, 'ok'):
+            result['status'] = 'failed'
+            result['error'] = f"quick_check: {result['quick_check']}"
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    finally:
+        if builder:
+            builder.discard()
+        result['duration_seconds'] = round(time.monotonic() - started, 3)
+    return result
+
+
+class BackupVerifier:
+    """
+    Verify every backup in backup_dir on a process pool.
+
+    Concurrency, the per-worker memory limit and the total read budget come
+    from BACKUP_VERIFY_CONCURRENCY (0 = one per CPU), BACKUP_VERIFY_MEMORY_MB
+    and BACKUP_VERIFY_IO_MB_S (0 = unlimited; split evenly between workers).
+    Results are written to the backups' .meta (deep passes count as
+    verified for retention) and, when an app is attached, to BackupRecord.
+    One sweep runs at a time.
+    """
+
+    def __init__(self, backup_manager):
+        self.backup_manager = backup_manager
+        self.logger = backup_manager.logger
+        # Flask app, attached by the app factory; BackupRecord rows are only updated when set
+        self.app = None
+        config = backup_manager.config
+        self.concurrency = int(config.get('BACKUP_VERIFY_CONCURRENCY', 0)) or os.cpu_count() or 1
+        self.memory_limit = int(float(config.get('BACKUP_VERIFY_MEMORY_MB', 256)) * 1024 * 1024)
+        self.io_bytes_per_second = float(config.get('BACKUP_VERIFY_IO_MB_S', 0)) * 1024 * 1024
+        self._lock = threading.Lock()
+        self._thread = None
+        self.progress: Dict[str, Any] = {}
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, deep: bool = True) -> bool:
+        """Run a sweep on a background thread; False if one is already running"""
+        with self._lock:
+            if self.is_running():
+                return False
+            self.progress = {'started_at': datetime.now().isoformat(), 'deep': deep}
+            self._thread = threading.Thread(target=self.verify_all, kwargs={'deep': deep},
+                                            name='backup-verify', daemon=True)
+            self._thread.start()
+            return True
+
+    def status(self) -> Dict[str, Any]:
+        return dict(self.progress, running=self.is_running())
+
+    def verify_all(self, deep: bool = True, names: Optional[List[str]] = None,
+                   on_result: Optional[Callable[[Dict[str, Any]], None]] = None) -> List[Dict[str, Any]]:
+        """
+        Verify the given backups (all of them by default) and record the results.
+
+        Returns:
+            One result dict per backup (see verify_file)
+        """
+        backup_dir = self.backup_manager.app_paths.backup_dir
+        temp_dir = self.backup_manager.app_paths.temp_dir
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        if names is None:
+            with os.scandir(backup_dir) as entries:
+                names = [entry.name for entry in entries if is_backup_file_name(entry.name) and entry.is_file()]
+        names = sorted(names)
+
+        workers = max(1, min(self.concurrency, len(names)))
+        per_worker_io = self.io_bytes_per_second / workers if self.io_bytes_per_second else 0
+        self.progress = {'started_at': datetime.now().isoformat(), 'deep': deep, 'total': len(names),
+                         'done': 0, 'ok': 0, 'failed': 0, 'skipped': 0}
+        self.logger.info(f"Verifying {len(names)} backups ({'deep' if deep else 'checksum'}) "
+                         f"with {workers} workers")
+        started = time.monotonic()
+        results = []
+        pending_records = []
+        if names:
+            # spawn, not fork: the app process has threads (and their locks) we must not copy
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                futures = [pool.submit(verify_file, str(backup_dir / name), str(self.backup_manager.chunk_store.root),
+                                       str(temp_dir), deep, self.memory_limit, per_worker_io)
+                           for name in names]
+                for future in as_completed(futures):
+                    result = future.result()
+                    results.append(result)
+                    self._record_metadata(result)
+                    pending_records.append(result)
+                    if len(pending_records) >= 50:
+                        self._record_results(pending_records)
+                        pending_records = []
+                    self.progress['done'] += 1
+                    self.progress[result['status']] += 1
+                    if result['status'] == 'failed':
+                        self.logger.error(f"Verification failed for {result['name']}: {result['error']}")
+                    if on_result:
+                        on_result(result)
+        self._record_results(pending_records)
+
+        self.progress['duration_seconds'] = round(time.monotonic() - started, 3)
+        self.progress['finished_at'] = datetime.now().isoformat()
+        self.logger.info(f"Verification finished in {self.progress['duration_seconds']}s: {self.progress['ok']} ok, "
+                         f"{self.progress['failed']} failed, {self.progress['skipped']} skipped")
+        return results
+
+    def _record_metadata(self, result: Dict[str, Any]):
+        if result['status'] != 'ok':
+            return
+        path = Path(result['path'])
+        fields = {}
+        if result['checksum_ok']:
+            fields['checksum_verified_at'] = datetime.now().isoformat()
+        if result['deep']:
+            fields['verified_at'] = datetime.now().isoformat()
+        if fields:
+            self.backup_manager._update_metadata(path, **fields)
+
+    def _record_results(self, results: List[Dict[str, Any]]):
+        """Write a batch of results to the matching BackupRecord rows"""
+        if not results or self.app is None:
+            return
+        from models import db, BackupRecord
+        by_name = {result['name']: result for result in results}
+        with self.app.app_context():
+            try:
+                for record in BackupRecord.query.filter(BackupRecord.filename.in_(list(by_name))).all():
+                    record.record_verification(by_name[record.filename]['status'], by_name[record.filename]['error'])
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self.logger.error(f"Failed to record verification results: {str(e)}")
+            finally:
+                db.session.remove()
@@ -0,0 +1,488 @@
+"""
+WAL Archiving and Point-in-Time Recovery
+Ships committed WAL frames of the live database into backup_dir in
+segments, and replays them onto a base snapshot up to a chosen time
+"""
+
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Callable, Dict, List, Tuple, Any
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows; archiving then assumes a single process
+    fcntl = None
+
+from backup_compression import get_codec
+
+
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER_SIZE = 24
+_WAL_MAGICS = (0x377f0682, 0x377f0683)
+_SALT_MASK = 0xFFFFFFFF
+
+GENERATION_FILE = 'generation.json'
+BASE_FILE = 'base.db.gz'
+SEGMENT_SUFFIX = '.frames.gz'
+
+
+class WalGapError(Exception):
+    """WAL frames were checkpointed away before they could be archived"""
+
+
+def parse_wal_header(header: bytes) -> Optional[Tuple[int, int, int]]:
+    """(page_size, salt1, salt2) of a WAL file header, or None if it is missing or invalid"""
+    if len(header) < WAL_HEADER_SIZE:
+        return None
+    magic, _, page_size, _, salt1, salt2 = struct.unpack('>6I', header[:24])
+    if magic not in _WAL_MAGICS:
+        return None
+    return page_size, salt1, salt2
+
+
+def _segment_time(segment: Path) -> float:
+    """Archive time (epoch seconds) encoded in a segment name: <seq>_<epoch ms>.frames.gz"""
+    return int(segment.name.split('_', 1)[1].split('.', 1)[0]) / 1000
+
+
+def list_generations(archive_dir: Path) -> List[Dict[str, Any]]:
+    """Archived generations, oldest first, each with its base time and segment list"""
+    generations = []
+    if not archive_dir.exists():
+        return generations
+    for generation_file in archive_dir.glob(f'*/{GENERATION_FILE}'):
+        try:
+            with generation_file.open('r') as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        segments = sorted(generation_file.parent.glob(f'*{SEGMENT_SUFFIX}'))
+        info['path'] = generation_file.parent
+        info['segments'] = segments
+        info['last_ts'] = _segment_time(segments[-1]) if segments else info['created_ts']
+        generations.append(info)
+    return sorted(generations, key=lambda g: g['created_ts'])
+
+
+def recovery_window(archive_dir: Path) -> Optional[Dict[str, datetime]]:
+    """Earliest and latest point the archive can restore to"""
+    generations = list_generations(archive_dir)
+    if not generations:
+        return None
+    return {
+        'earliest': datetime.fromtimestamp(generations[0]['created_ts']),
+        'latest': datetime.fromtimestamp(max(g['last_ts'] for g in generations))
+    }
+
+
+def restore_to_time(archive_dir: Path, target_path: Path, timestamp: float) -> Dict[str, Any]:
+    """
+    Rebuild the database as of 'timestamp' from an archive generation.
+
+    The newest generation whose base is not after the timestamp is restored,
+    then its segments archived at or before the timestamp are replayed frame
+    by frame. A segment's time is when it was shipped, so every commit it
+    holds happened no later than that.
+
+    Returns:
+        Dict with the generation used, segments/frames applied and the time recovered to
+
+    Raises:
+        ValueError: If no generation covers the timestamp
+    """
+    candidates = [g for g in list_generations(archive_dir) if g['created_ts'] <= timestamp]
+    if not candidates:
+        raise ValueError(f"No archived base at or before {datetime.fromtimestamp(timestamp).isoformat()}")
+    generation = candidates[-1]
+    page_size = generation['page_size']
+    gzip_codec = get_codec('gzip')
+
+    with gzip_codec.open_reader(generation['path'] / BASE_FILE) as f_in, Path(target_path).open('wb') as f_out:
+        for chunk in iter(lambda: f_in.read(1024 * 1024), b''):
+            f_out.write(chunk)
+
+    result = {'generation': generation['id'], 'segments': 0, 'frames': 0, 'recovered_to': generation['created_ts']}
+    frame_size = WAL_FRAME_HEADER_SIZE + page_size
+    with Path(target_path).open('r+b') as f_out:
+        for segment in generation['segments']:
+            segment_ts = _segment_time(segment)
+            if segment_ts > timestamp:
+                break
+            with gzip_codec.open_reader(segment) as f_in:
+                data = f_in.read()
+            for offset in range(0, len(data) - frame_size + 1, frame_size):
+                pgno, commit_size = struct.unpack('>II', data[offset:offset + 8])
+                f_out.seek((pgno - 1) * page_size)
+                f_out.write(data[offset + WAL_FRAME_HEADER_SIZE:offset + frame_size])
+                if commit_size:
+                    f_out.truncate(commit_size * page_size)
+                result['frames'] += 1
+            result['segments'] += 1
+            result['recovered_to'] = segment_ts
+    return result
+
+
+def prune_generations(archive_dir: Path, cutoff_ts: float, keep: Optional[Path] = None) -> int:
+    """Delete generations with nothing newer than cutoff_ts; the newest one and 'keep' always stay"""
+    generations = list_generations(archive_dir)
+    removed = 0
+    for generation in generations[:-1]:
+        if generation['last_ts'] >= cutoff_ts or generation['path'] == keep:
+            continue
+        for entry in generation['path'].iterdir():
+            entry.unlink()
+        generation['path'].rmdir()
+        removed += 1
+    return removed
+
+
+class WalArchiver:
+    """
+    Continuously archive the live database's WAL for point-in-time recovery.
+
+    A generation starts with a base snapshot (WAL checkpointed and empty) and
+    is followed by segments of committed WAL frames, shipped every
+    BACKUP_WAL_ARCHIVE_INTERVAL_SECONDS. Between syncs the archiver keeps a
+    read transaction open, which stops other connections' checkpoints from
+    restarting the WAL over frames not yet archived. Frames are copied under
+    a brief write lock so no transaction is half written, then compressed and
+    fsynced once it is released. The archiver runs the checkpoints itself
+    right after a sync. If the WAL salt shows a
+    restart the archiver did not expect, a new generation is started.
+
+    Only one process archives at a time (flock on archive_dir/archiver.lock).
+    """
+
+    def __init__(self, backup_manager):
+        config = backup_manager.config
+        self.backup_manager = backup_manager
+        self.logger = backup_manager.logger
+        self.database_file = backup_manager.app_paths.database_file
+        self.wal_file = Path(f"{self.database_file}-wal")
+        self.archive_dir = backup_manager.app_paths.backup_dir / 'wal'
+
+        self.interval = float(config.get('BACKUP_WAL_ARCHIVE_INTERVAL_SECONDS', 10))
+        self.checkpoint_seconds = float(config.get('BACKUP_WAL_CHECKPOINT_SECONDS', 300))
+        self.checkpoint_frames = int(config.get('BACKUP_WAL_CHECKPOINT_FRAMES', 1000))
+        self.generation_seconds = float(config.get('BACKUP_WAL_GENERATION_HOURS',
+                                                   config.get('BACKUP_SCHEDULE_HOURS', 24))) * 3600
+
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_file = None
+        self._reader = None
+        self._writer = None
+
+        self._generation: Optional[Path] = None
+        self._generation_started = 0.0
+        self._new_generation_requested = False
+        self._salt: Optional[Tuple[int, int]] = None
+        self._expected_salt1: Optional[int] = None
+        self._offset = WAL_HEADER_SIZE
+        self._segment_seq = 0
+        self._frames_since_checkpoint = 0
+        self._last_checkpoint = time.monotonic()
+
+    # --- Lifecycle ---
+
+    def start(self):
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='wal-archiver', daemon=True)
+        self._thread.start()
+        self.logger.info(f"WAL archiver started (every {self.interval}s into {self.archive_dir})")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + 30)
+        with self._lock:
+            self._close_connections()
+            self._generation = None
+            if self._lock_file:
+                self._lock_file.close()
+                self._lock_file = None
+
+    def is_active(self) -> bool:
+        """True while this process is archiving a generation"""
+        return self._generation is not None and not self._stop.is_set()
+
+    @property
+    def current_generation(self) -> Optional[Path]:
+        """Directory of the generation being archived, or None when not archiving"""
+        return self._generation
+
+    @contextmanager
+    def paused(self):
+        """Hold off archiving with the archiver's connections closed (e.g. while the database file is swapped)"""
+        with self._lock:
+            self._close_connections()
+            self._generation = None
+            yield
+
+    def request_new_generation(self):
+        """Start a fresh generation on the next tick (e.g. after the database was restored)"""
+        self._new_generation_requested = True
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._acquire_process_lock():
+                    self.tick()
+            except Exception as e:
+                self.logger.error(f"WAL archiving failed, starting a new generation next time: {str(e)}")
+                with self._lock:
+                    self._generation = None
+                    self._close_connections()
+            self._stop.wait(self.interval)
+
+    def _acquire_process_lock(self) -> bool:
+        if self._lock_file:
+            return True
+        if fcntl is None:
+            self._lock_file = open(self.archive_dir / 'archiver.lock', 'a')
+            return True
+        lock_file = open(self.archive_dir / 'archiver.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False # Another worker process is archiving
+        self._lock_file = lock_file
+        return True
+
+    # --- Connections ---
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.database_file), isolation_level=None, check_same_thread=False, timeout=30)
+        return conn
+
+    def _ensure_connections(self):
+        if self._reader is None:
+            self._writer = self._connect()
+            mode = self._writer.execute("PRAGMA journal_mode=WAL").fetchone()[0].lower()
+            if mode != 'wal':
+                raise RuntimeError(f"Could not switch the database to WAL mode (journal_mode={mode})")
+            self._reader = self._connect()
+
+    def _close_connections(self):
+        for conn in (self._reader, self._writer):
+            if conn is not None:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+        self._reader = self._writer = None
+
+    def _begin_read(self):
+        self._reader.execute("BEGIN")
+        self._reader.execute("SELECT count(*) FROM sqlite_master").fetchone()
+
+    def _end_read(self):
+        if self._reader is not None and self._reader.in_transaction:
+            self._reader.execute("ROLLBACK")
+
+    @contextmanager
+    def _write_locked(self):
+        """Hold the database write lock so no transaction is mid-way through the WAL"""
+        self._writer.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        finally:
+            self._writer.execute("ROLLBACK")
+
+    def _read_wal_header(self) -> Optional[Tuple[int, int, int]]:
+        # SQLite takes no POSIX locks on the -wal file itself, so it may be opened and closed freely
+        try:
+            with self.wal_file.open('rb') as f:
+                return parse_wal_header(f.read(WAL_HEADER_SIZE))
+        except FileNotFoundError:
+            return None
+
+    # --- Archiving ---
+
+    def tick(self):
+        """Start a generation if needed, ship new frames, and checkpoint when due"""
+        with self._lock:
+            generation_age = time.monotonic() - self._generation_started
+            if self._generation is None or self._new_generation_requested or generation_age > self.generation_seconds:
+                self._start_generation()
+            try:
+                with self._write_locked():
+                    frames = self._sync()
+            except WalGapError as e:
+                self.logger.warning(f"WAL archive gap ({str(e)}); starting a new generation")
+                self._start_generation()
+                return
+            # Compressed and fsynced once writers are free to commit again
+            self._write_segment(frames)
+            due = time.monotonic() - self._last_checkpoint >= self.checkpoint_seconds
+            if due or self._frames_since_checkpoint >= self.checkpoint_frames:
+                self.checkpoint()
+
+    def _sync(self) -> Optional[memoryview]:
+        """
+        Copy committed frames added since the last sync (write lock must be held).
+
+        Returns the frames for _write_segment, which callers run after
+        releasing the write lock, or None if there are none.
+        """
+        header = self._read_wal_header()
+        if header is None:
+            return None
+        page_size, salt1, salt2 = header
+
+        if self._salt != (salt1, salt2):
+            # The WAL was restarted: fine after our own checkpoint (salt-1 goes up by exactly one),
+            # otherwise frames may have been checkpointed and overwritten before we saw them
+            if self._salt is not None and self._expected_salt1 is None:
+                raise WalGapError("WAL restarted without an archiver checkpoint")
+            if self._expected_salt1 is not None and salt1 != self._expected_salt1:
+                raise WalGapError(f"WAL salt jumped to {salt1}, expected {self._expected_salt1}")
+            self._salt = (salt1, salt2)
+            self._expected_salt1 = None
+            self._offset = WAL_HEADER_SIZE
+
+        with self.wal_file.open('rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+
+        frame_size = WAL_FRAME_HEADER_SIZE + page_size
+        committed_end = 0
+        frames = 0
+        for offset in range(0, len(data) - frame_size + 1, frame_size):
+            _, commit_size, frame_salt1, frame_salt2 = struct.unpack('>4I', data[offset:offset + 16])
+            if (frame_salt1, frame_salt2) != self._salt:
+                break # Left over from before the last restart
+            if commit_size:
+                committed_end = offset + frame_size
+                frames = committed_end // frame_size
+
+        if not committed_end:
+            return None
+        self._offset += committed_end
+        self._frames_since_checkpoint += frames
+        return memoryview(data)[:committed_end]
+
+    def _write_segment(self, frames: Optional[memoryview]):
+        """
+        Write frames from _sync as the generation's next segment.
+
+        A failure raises, and the archiver then starts a new generation: the
+        frames are already past self._offset and cannot be shipped again.
+        """
+        if frames is None:
+            return
+        self._segment_seq += 1
+        name = f"{self._segment_seq:08d}_{int(time.time() * 1000)}{SEGMENT_SUFFIX}"
+        path = self._generation / name
+        temp_path = path.with_name(name + '.tmp')
+        with temp_path.open('wb') as f:
+            f.write(get_codec('gzip').block_compressor(6)(frames))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    def checkpoint(self, during: Optional[Callable[[], None]] = None) -> bool:
+        """
+        Ship outstanding frames and checkpoint the WAL into the database file.
+
+        Runs under the write lock, so no frame can slip in between the last
+        sync and the checkpoint. 'during' is called while the lock is still
+        held and the database file is fully up to date, which is when a
+        file-level snapshot can start its read transaction.
+
+        Returns:
+            True if every WAL frame was checkpointed (and 'during' ran)
+        """
+        with self._lock:
+            if self._reader is None:
+                return False
+            self._end_read()
+            frames = None
+            try:
+                with self._write_locked():
+                    frames = self._sync()
+                    busy, log_frames, checkpointed = self._reader.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+                    complete = busy == 0 and log_frames == checkpointed
+                    if complete and self._salt is not None:
+                        # The next writer restarts the WAL; any further restart means lost frames
+                        self._expected_salt1 = (self._salt[0] + 1) & _SALT_MASK
+                    if during and complete:
+                        during()
+                    # Re-open our read before the lock drops so no commit lands unguarded
+                    self._begin_read()
+            finally:
+                if not self._reader.in_transaction:
+                    self._begin_read()
+            self._write_segment(frames)
+            self._frames_since_checkpoint = 0
+            self._last_checkpoint = time.monotonic()
+            return complete
+
+    def _start_generation(self):
+        """Checkpoint the WAL empty and copy the database file as the base of a new generation"""
+        self._ensure_connections()
+        if self._generation is not None and self._salt is not None:
+            try:
+                with self._write_locked():
+                    frames = self._sync() # Finish the old generation with what is still in the WAL
+                self._write_segment(frames)
+            except WalGapError:
+                pass
+        self._end_read()
+
+        for attempt in range(3):
+            header = self._read_wal_header()
+            self._reader.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._begin_read()
+            if not self.wal_file.exists() or self.wal_file.stat().st_size == 0:
+                break
+            # A writer got in between the checkpoint and our read; drain again
+            self._end_read()
+            time.sleep(0.05 * (attempt + 1))
+        else:
+            raise RuntimeError("WAL could not be drained to start an archive generation")
+
+        # Our read transaction saw an empty WAL, so no checkpoint can touch the file until it ends
+        page_size = self._reader.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self._reader.execute("PRAGMA page_count").fetchone()[0]
+        created = datetime.now()
+        generation = self.archive_dir / created.strftime('gen_%Y%m%d_%H%M%S_%f')
+        generation.mkdir(parents=True)
+
+        fd = self.backup_manager._get_snapshot_fd()
+        temp_base = generation / (BASE_FILE + '.tmp')
+        with self.backup_manager._open_backup_writer(temp_base, get_codec('gzip')) as f_out:
+            position, size = 0, page_size * page_count
+            while position < size:
+                data = os.pread(fd, min(1024 * 1024, size - position), position)
+                if not data:
+                    raise IOError(f"Short read from database at offset {position}")
+                f_out.write(data)
+                position += len(data)
+        base_checksum = self.backup_manager._take_checksum(temp_base)
+        os.replace(temp_base, generation / BASE_FILE)
+
+        with (generation / GENERATION_FILE).open('w') as f:
+            json.dump({'id': generation.name, 'created_at': created.isoformat(), 'created_ts': created.timestamp(),
+                       'page_size': page_size, 'page_count': page_count, 'base': BASE_FILE,
+                       'base_checksum': base_checksum}, f, indent=2)
+
+        self._generation = generation
+        self._generation_started = time.monotonic()
+        self._new_generation_requested = False
+        self._salt = None
+        self._expected_salt1 = (header[1] + 1) & _SALT_MASK if header else None
+        self._offset = WAL_HEADER_SIZE
+        self._segment_seq = 0
+        self._frames_since_checkpoint = 0
+        self._last_checkpoint = time.monotonic()
+        self.logger.info(f"WAL archive generation {generation.name} started ({page_count} pages)")
@@ -1,17 +1,22 @@
 from flask import (
     Blueprint, render_template, request, jsonify, session, redirect, url_for,
-    flash, send_file, current_app # Import current_app
+    flash, send_file, current_app, Response, stream_with_context # Import current_app
 )
-from flask_login import login_required
+from flask_login import login_required, current_user
 from pathlib import Path
+import json
 import sqlite3
+import time
+import uuid
 from datetime import datetime
 backup_bp = Blueprint('backup', __name__)
 
 
 # Import models directly assuming they are initialized with your app
 # In a larger app, you might pass db to blueprints or get it via current_app
-from models import db, User, BackupRecord, CustomerService 
+from models import db, User, BackupRecord, CustomerService, DatabaseManager
+from backup_compression import parse_level, AUTO_LEVEL
+from backup_dedup import MANIFEST_SUFFIX
 
 # We will get config, backup_manager, gpg_backup from current_app.extensions
 # which you'll set up in your main app.py/init.py
@@ -42,11 +47,13 @@ def backup_page():
     # Placeholder for data if needed on the /backup page itself
     last_backup_timestamp = None 
     previous_backups = []
+    backup_stats = {}
     
     try:
         # Assuming these managers are set on current_app.extensions
         backup_manager = current_app.extensions.get('backup_manager')
         if backup_manager:
+            backup_stats = BackupRecord.get_backup_stats()
             recent_records = BackupRecord.query.order_by(BackupRecord.created_at.desc()).first()
             if recent_records:
                 last_backup_timestamp = recent_records.created_at
@@ -69,7 +76,9 @@ def backup_page():
 
     return render_template('backup/index.html', 
                            last_backup_timestamp=last_backup_timestamp,
-                           previous_backups=previous_backups)
+                           previous_backups=previous_backups,
+                           backup_stats=backup_stats,
+                           idempotency_key=uuid.uuid4().hex)
 
 
 @backup_bp.route('/create', methods=['POST'])
@@ -88,9 +97,41 @@ def create_backup_route():
         include_attachments = 'include_attachments' in request.form
         encrypt_gpg = 'encrypt_gpg' in request.form
         gpg_email = request.form.get('gpg_email')
+        backup_type = request.form.get('backup_type', 'manual')
+        if backup_type not in ('manual', 'differential'):
+            return jsonify({'success': False, 'error': f'Unknown backup type: {backup_type}'}), 400
+
+        # --- Resolve the compression codec before queueing so bad input fails fast ---
+        try:
+            codec = backup_manager.resolve_codec(backup_format, request.form.get('codec'))
+            compression_level = parse_level(request.form.get('compression_level'))
+            if compression_level != AUTO_LEVEL:
+                codec.resolve_level(compression_level)
+        except ValueError as codec_error:
+            return jsonify({'success': False, 'error': str(codec_error)}), 400
+
+        # --- Encryption: refused for backups that cannot be restored once sealed; engine 'gpg' or 'aes-gcm' ---
+        encryption_engine = None
+        if encrypt_gpg:
+            try:
+                backup_manager.check_encryptable(backup_format, backup_type)
+                encryption_engine = backup_manager.resolve_encryption_engine(request.form.get('encryption_engine'),
+                                                                             backup_format)
+            except ValueError as encryption_error:
+                return jsonify({'success': False, 'error': str(encryption_error)}), 400
+
+        if encrypt_gpg and encryption_engine != 'gpg':
+            if not gpg_email:
+                return jsonify({'success': False, 'error': 'Email address is required for encryption.'}), 400
+            if not backup_manager.envelope.has_public_key(gpg_email):
+                return jsonify({
+                    'success': False,
+                    'error': f'No {encryption_engine} public key for {gpg_email}. '
+                             f'Generate one with "python backup.py keygen {gpg_email}".'
+                }), 400
 
         # --- IMPROVED: Use unified key resolution for validation ---
-        if encrypt_gpg:
+        if encrypt_gpg and encryption_engine == 'gpg':
             if not gpg_backup:
                 return jsonify({
                     'success': False, 
@@ -136,99 +177,36 @@ def create_backup_route():
                     'error': 'Unable to validate GPG key. Please try again or contact administrator.'
                 }), 500
 
-        compress = backup_format in ('zip', 'gz')
-
-        # --- Step 1: Create raw backup ---
-        current_app.logger.info(f"Creating backup with format: {backup_format}, compression: {compress}")
-        backup_file_path = backup_manager.create_backup(
-            format='gz' if compress else 'db',
-            include_attachments=include_attachments
-        )
-
-        if not backup_file_path or not backup_file_path.exists():
-            current_app.logger.error(f"Backup creation failed: {backup_file_path}")
-            db.session.rollback()
-            return jsonify({'success': False, 'error': 'Backup creation failed.'}), 500
-
-        current_app.logger.info(f"Raw backup created: {backup_file_path}")
-
-        # --- Step 2: Record initial backup entry ---
-        backup_record = BackupRecord(
-            filename=backup_file_path.name,
-            backup_type='encrypted' if encrypt_gpg else 'regular',
-            description='Customer database backup' + (' (GPG encrypted)' if encrypt_gpg else ''),
+        backup_jobs = current_app.extensions.get('backup_jobs')
+        if not backup_jobs:
+            return jsonify({'success': False, 'error': 'Backup job queue not initialized'}), 500
+
+        # --- Queue the snapshot/compress/encrypt work; a worker thread runs it ---
+        current_app.logger.info(f"Queueing backup with format: {backup_format}, codec: {codec.name}, encryption: {encrypt_gpg}")
+        job = backup_jobs.submit(
+            format=backup_format,
+            codec=codec.name,
+            level=compression_level,
+            backup_type=backup_type,
+            include_attachments=include_attachments,
+            encrypt_gpg=encrypt_gpg,
+            gpg_email=gpg_email,
+            encryption_engine=encryption_engine,
             user_id=session.get('user_id'),
-            file_size=backup_file_path.stat().st_size
+            # Double-clicks and client retries resend the same key and get the same job back
+            idempotency_key=request.form.get('idempotency_key') or request.headers.get('Idempotency-Key')
         )
-        db.session.add(backup_record)
-        db.session.commit()
-
-        # --- Step 3: If GPG encryption is requested ---
-        final_download_path = backup_file_path  # Default: unencrypted file
-        if encrypt_gpg and gpg_backup and gpg_email:
-            try:
-                current_app.logger.info(f"Starting GPG encryption for {gpg_email}")
-                
-                encrypted_file_path = gpg_backup.create_encrypted_backup(
-                    input_filepath=backup_file_path,
-                    recipient_email=gpg_email
-                )
-                
-                # Debug logging to understand what create_encrypted_backup returns
-                current_app.logger.info(f"Encryption result: {encrypted_file_path}")
-                current_app.logger.info(f"File exists: {encrypted_file_path.exists() if encrypted_file_path else 'N/A'}")
-                
-                if not encrypted_file_path or not encrypted_file_path.exists():
-                    raise Exception("GPG encryption failed: No encrypted file returned.")
-
-                # Delete original unencrypted file
-                current_app.logger.info(f"Deleting original unencrypted file: {backup_file_path}")
-                backup_file_path.unlink()
-
-                # Update database record with encrypted file info
-                final_download_path = encrypted_file_path
-                backup_record.filename = encrypted_file_path.name
-                backup_record.file_size = encrypted_file_path.stat().st_size
-                db.session.commit()
-                
-                current_app.logger.info(f"GPG encryption completed successfully: {encrypted_file_path}")
 
-            except Exception as e:
-                current_app.logger.error(f"GPG encryption error: {str(e)}", exc_info=True)
-                
-                # Cleanup: remove the unencrypted backup file and database record
-                try:
-                    if backup_file_path.exists():
-                        backup_file_path.unlink()
-                        current_app.logger.info(f"Cleaned up failed backup file: {backup_file_path}")
-                except Exception as cleanup_error:
-                    current_app.logger.error(f"Failed to cleanup backup file: {cleanup_error}")
-                
-                # Rollback database changes
-                db.session.rollback()
-                
-                # Return detailed error to help with debugging
-                error_message = 'Encryption failed. Backup was not saved.'
-                if 'no public key' in str(e).lower():
-                    error_message = f'No public key found for {gpg_email}. Please import the key first.'
-                elif 'gpg' in str(e).lower():
-                    error_message = f'GPG encryption error: {str(e)}'
-                
-                return jsonify({
-                    'success': False,
-                    'error': error_message
-                }), 500
-
-        # --- Step 4: Return download URL for the final file ---
-        current_app.logger.info(f"Backup creation completed successfully: {final_download_path}")
         return jsonify({
             'success': True,
-            'job_id': 'direct_download',
-            'completed': True,
-            'download_url': url_for('backup.download_backup', backup_name=final_download_path.name),
-            'filename': final_download_path.name,
-            'encrypted': encrypt_gpg
-        })
+            'job_id': job.id,
+            'status': job.status,
+            'completed': False,
+            'status_url': url_for('backup.backup_job_status', job_id=job.id),
+            'events_url': url_for('backup.backup_job_events', job_id=job.id),
+            'encrypted': encrypt_gpg,
+            'encryption_engine': encryption_engine
+        }), 202
 
     except Exception as e:
         current_app.logger.error(f"Backup failed: {str(e)}", exc_info=True)
@@ -236,6 +214,107 @@ def create_backup_route():
         return jsonify({'success': False, 'error': f'Backup creation failed: {str(e)}'}), 500
 
 
+@backup_bp.route('/jobs/<int:job_id>')
+@login_required
+def backup_job_status(job_id):
+    """Return the state of a queued backup job"""
+    try:
+        backup_jobs = current_app.extensions.get('backup_jobs')
+        if not backup_jobs:
+            return jsonify({'success': False, 'error': 'Backup job queue not initialized'}), 500
+
+        job = backup_jobs.get_job(job_id)
+        if not job:
+            return jsonify({'success': False, 'error': 'Backup job not found'}), 404
+
+        if job['completed']:
+            job['download_url'] = url_for('backup.download_backup', backup_name=job['filename'])
+
+        return jsonify({'success': True, **job})
+
+    except Exception as e:
+        current_app.logger.error(f"Failed to read backup job {job_id}: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@backup_bp.route('/jobs/<int:job_id>/events')
+@login_required
+def backup_job_events(job_id):
+    """
+    Stream progress of a backup job as Server-Sent Events.
+    Sends 'progress' events (pages copied, bytes compressed/encrypted, ETA)
+    and a final 'done' event carrying the job status and download URL.
+    """
+    backup_jobs = current_app.extensions.get('backup_jobs')
+    if not backup_jobs:
+        return jsonify({'success': False, 'error': 'Backup job queue not initialized'}), 500
+    if not backup_jobs.get_job(job_id):
+        return jsonify({'success': False, 'error': 'Backup job not found'}), 404
+
+    heartbeat = current_app.config.get('BACKUP_EVENTS_HEARTBEAT_SECONDS', 15)
+
+    def format_event(event_type, payload):
+        return f"event: {event_type}\ndata: {json.dumps(payload, default=str)}\n\n"
+
+    def generate():
+        version = None
+        last_sent = 0.0
+        while True:
+            # Progress is coalesced: at most a few events per second, always the latest one
+            time.sleep(max(0.0, 0.25 - (time.monotonic() - last_sent)))
+            new_version, progress = backup_jobs.wait_for_progress(job_id, version, timeout=heartbeat)
+            if progress:
+                version = new_version
+                last_sent = time.monotonic()
+                yield format_event('progress', progress)
+
+            job = backup_jobs.get_job(job_id)
+            db.session.rollback() # Release the SQLite read snapshot between events
+            if not job:
+                break
+            if job['completed'] or job['failed']:
+                if job['completed']:
+                    job['download_url'] = url_for('backup.download_backup', backup_name=job['filename'])
+                yield format_event('done', {'success': True, **job})
+                break
+            if not progress:
+                yield ": keep-alive\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@backup_bp.route('/verify-all', methods=['GET', 'POST'])
+@login_required
+def verify_all_backups():
+    """
+    Admin only. POST starts verifying every backup in the background
+    ('fast': true checks checksums only); GET reports the progress of the last run.
+    """
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'error': 'Administrator access required'}), 403
+    try:
+        backup_manager = current_app.extensions.get('backup_manager')
+        if not backup_manager:
+            return jsonify({'success': False, 'error': 'Backup manager not initialized'}), 500
+        verifier = backup_manager.verifier
+
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            if not verifier.start(deep=not data.get('fast', False)):
+                return jsonify({'success': False, 'error': 'Verification already running', **verifier.status()}), 409
+            return jsonify({'success': True, **verifier.status()}), 202
+
+        return jsonify({'success': True, **verifier.status()})
+
+    except Exception as e:
+        current_app.logger.error(f"Bulk verification failed: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 @backup_bp.route('/validate-key', methods=['POST'])
 @login_required
 def validate_gpg_key():
@@ -423,11 +502,20 @@ def download_backup(backup_name):
             flash('Backup file not found on server storage.', 'error')
             return redirect(url_for('dashboard'))
 
+        if backup_path.suffix == MANIFEST_SUFFIX:
+            # A manifest alone is useless to the user; stream the reassembled database instead
+            return Response(
+                stream_with_context(backup_manager.chunk_store.iter_backup(backup_path)),
+                mimetype='application/octet-stream',
+                headers={'Content-Disposition': f'attachment; filename="{backup_path.stem}"'}
+            )
+
+        download_mimetypes = {'.gz': 'application/gzip', '.bz2': 'application/x-bzip2', '.xz': 'application/x-xz'}
         return send_file(
             str(backup_path),
             as_attachment=True,
             download_name=backup_name,
-            mimetype='application/gzip' if backup_path.suffix == '.gz' else 'application/octet-stream'
+            mimetype=download_mimetypes.get(backup_path.suffix, 'application/octet-stream')
         )
 
     except Exception as e:
@@ -470,21 +558,15 @@ def restore_backup():
         if not backup_path.exists():
             return jsonify({'success': False, 'error': 'Backup file not found on server storage.'}), 404
 
-        # Create a pre-restore backup (important safety measure)
-        # Fixed: Use correct method signature for create_backup
-        current_backup = backup_manager.create_backup(
-            format='gz',
-            backup_type='pre_restore'
-        )
-        if not current_backup:
-            return jsonify({'success': False, 'error': 'Failed to create pre-restore backup'}), 500
-
-        success = backup_manager.restore_backup(backup_path)
+        # Keep the current database as a pre-restore backup (important safety measure);
+        # by default it is hard-linked at the swap and compressed afterwards (see restore_backup)
+        success = backup_manager.restore_backup(backup_path, keep_current=True)
 
         # After restore, ensure database tables are created if the backup was empty or corrupting
         if success:
             with current_app.app_context():
                 db.create_all() # Re-create tables based on models if they got dropped during restore
+                DatabaseManager.ensure_schema() # Older backups may predate some columns
 
             flash(f'Database restored from {backup_path.name}', 'success')
             return jsonify({
@@ -500,6 +582,54 @@ def restore_backup():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@backup_bp.route('/restore/point-in-time', methods=['GET', 'POST'])
+@login_required
+def restore_point_in_time():
+    """Report the WAL archive's recovery window (GET) or restore to a point inside it (POST)"""
+    try:
+        backup_manager = current_app.extensions.get('backup_manager')
+        if not backup_manager:
+            return jsonify({'success': False, 'error': 'Backup manager not initialized'}), 500
+
+        window = backup_manager.get_recovery_window()
+        window_json = {key: value.isoformat() for key, value in window.items()} if window else None
+        if request.method == 'GET':
+            return jsonify({'success': True, 'recovery_window': window_json})
+
+        if not window:
+            return jsonify({'success': False, 'error': 'No WAL archive available for point-in-time restore'}), 404
+
+        try:
+            point_in_time = datetime.fromisoformat(request.form.get('timestamp', ''))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'timestamp must be an ISO date/time (e.g. 2024-05-01T13:45:00)'}), 400
+        if point_in_time < window['earliest']:
+            return jsonify({'success': False, 'error': 'Timestamp is before the recovery window',
+                            'recovery_window': window_json}), 400
+
+        # Keep the current database as a pre-restore backup (important safety measure)
+        success = backup_manager.restore_point_in_time(point_in_time, keep_current=True)
+
+        if success:
+            with current_app.app_context():
+                db.create_all()
+                DatabaseManager.ensure_schema()
+
+            flash(f'Database restored to {point_in_time.isoformat()}', 'success')
+            return jsonify({
+                'success': True,
+                'message': f'Restored to {point_in_time.isoformat()}',
+                'recovery_window': window_json
+            })
+        else:
+            flash('Point-in-time restore failed.', 'error')
+            return jsonify({'success': False, 'error': 'Point-in-time restore failed.'}), 500
+
+    except Exception as e:
+        current_app.logger.error(f"Point-in-time restore failed: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 # --- GPG Routes ---
 
 @backup_bp.route('/gpg/search', methods=['POST'])
@@ -54,6 +54,70 @@ class Config:
     MAX_BACKUP_AGE_DAYS = int(os.environ.get('MAX_BACKUP_AGE_DAYS', '30'))
     AUTO_BACKUP_ENABLED = os.environ.get('AUTO_BACKUP_ENABLED', 'True').lower() == 'true'
     BACKUP_SCHEDULE_HOURS = int(os.environ.get('BACKUP_SCHEDULE_HOURS', '24'))
+    BACKUP_SCHEDULE_JITTER_MINUTES = int(os.environ.get('BACKUP_SCHEDULE_JITTER_MINUTES', '10'))
+    BACKUP_SCHEDULE_FORMAT = os.environ.get('BACKUP_SCHEDULE_FORMAT', 'zip')
+    BACKUP_SCHEDULER_POLL_SECONDS = int(os.environ.get('BACKUP_SCHEDULER_POLL_SECONDS', '30'))
+    BACKUP_STATS_RECONCILE_HOURS = int(os.environ.get('BACKUP_STATS_RECONCILE_HOURS', '24'))
+    BACKUP_RETENTION_KEEP_LAST = int(os.environ.get('BACKUP_RETENTION_KEEP_LAST', '3'))
+    BACKUP_RETENTION_HOURLY = int(os.environ.get('BACKUP_RETENTION_HOURLY', '24'))
+    BACKUP_RETENTION_DAILY = int(os.environ.get('BACKUP_RETENTION_DAILY', '7'))
+    BACKUP_RETENTION_WEEKLY = int(os.environ.get('BACKUP_RETENTION_WEEKLY', '4'))
+    BACKUP_RETENTION_MONTHLY = int(os.environ.get('BACKUP_RETENTION_MONTHLY', '12'))
+    BACKUP_RETENTION_KEEP_WITHIN_DAYS = float(os.environ.get('BACKUP_RETENTION_KEEP_WITHIN_DAYS', '0'))
+    BACKUP_RETENTION_BATCH_SIZE = int(os.environ.get('BACKUP_RETENTION_BATCH_SIZE', '100'))
+    # Bulk verification (verify-all): worker processes (0 = one per CPU), total read budget in MB/s
+    # (0 = unlimited) and the largest database a worker rebuilds in memory before using a temp file
+    BACKUP_VERIFY_CONCURRENCY = int(os.environ.get('BACKUP_VERIFY_CONCURRENCY', '0'))
+    BACKUP_VERIFY_IO_MB_S = float(os.environ.get('BACKUP_VERIFY_IO_MB_S', '0'))
+    BACKUP_VERIFY_MEMORY_MB = int(os.environ.get('BACKUP_VERIFY_MEMORY_MB', '256'))
+    BACKUP_RESTORE_INTEGRITY_CHECK = os.environ.get('BACKUP_RESTORE_INTEGRITY_CHECK', 'quick')  # 'quick', 'full' or 'off'
+    BACKUP_PRE_RESTORE_MODE = os.environ.get('BACKUP_PRE_RESTORE_MODE', 'link')  # 'link' (keep the replaced file) or 'full'
+    BACKUP_PRE_RESTORE_CODEC = os.environ.get('BACKUP_PRE_RESTORE_CODEC', 'gzip')  # Background compression of kept files; 'none' keeps the .db
+    # Encrypt while compressing, so no plaintext copy is written. Each recipient needs its own gpg
+    # stream, so concurrent jobs for different recipients take separate snapshots; turn this off to
+    # share one snapshot per flight and encrypt it per job afterwards (a plaintext file exists meanwhile)
+    BACKUP_GPG_PIPELINE_ENABLED = os.environ.get('BACKUP_GPG_PIPELINE_ENABLED', 'True').lower() == 'true'
+    BACKUP_ENCRYPT_QUEUE_BLOCKS = int(os.environ.get('BACKUP_ENCRYPT_QUEUE_BLOCKS', '8'))  # Blocks of BACKUP_STREAM_BUFFER_SIZE queued for gpg
+    # Encryption engine for new encrypted backups: 'gpg' or 'aes-gcm' (utils.encryption, keys in
+    # paths.encryption_keys_dir); restores pick the engine from the file suffix
+    BACKUP_ENCRYPTION_ENGINE = os.environ.get('BACKUP_ENCRYPTION_ENGINE', 'gpg')
+    BACKUP_ENCRYPTION_KEY_PASSPHRASE = os.environ.get('BACKUP_ENCRYPTION_KEY_PASSPHRASE') or None
+    BACKUP_ENCRYPTION_CHUNK_SIZE = int(os.environ.get('BACKUP_ENCRYPTION_CHUNK_SIZE', str(1024 * 1024)))
+    BACKUP_ENCRYPTION_WORKERS = int(os.environ.get('BACKUP_ENCRYPTION_WORKERS', '0'))  # 0 = one per CPU
+    # Uncompressed bytes per chunk of a 'chunked' (.bkc) backup; rounded up to a multiple of 64 KiB
+    BACKUP_CONTAINER_CHUNK_SIZE = int(os.environ.get('BACKUP_CONTAINER_CHUNK_SIZE', str(1024 * 1024)))
+    BACKUP_STREAMING_ENABLED = os.environ.get('BACKUP_STREAMING_ENABLED', 'True').lower() == 'true'
+    BACKUP_STREAM_BUFFER_SIZE = int(os.environ.get('BACKUP_STREAM_BUFFER_SIZE', str(1024 * 1024)))
+    BACKUP_COMPRESSION_THREADS = int(os.environ.get('BACKUP_COMPRESSION_THREADS', '0'))  # 0 = one per CPU
+    BACKUP_COMPRESSION_BLOCK_SIZE = int(os.environ.get('BACKUP_COMPRESSION_BLOCK_SIZE', str(1024 * 1024)))
+    BACKUP_COMPRESSION_EXECUTOR = os.environ.get('BACKUP_COMPRESSION_EXECUTOR', 'thread')  # 'thread' or 'process'
+    BACKUP_DEFAULT_CODEC = os.environ.get('BACKUP_DEFAULT_CODEC', 'gzip')  # gzip, bz2, lzma or none
+    BACKUP_COMPRESSION_LEVEL = os.environ.get('BACKUP_COMPRESSION_LEVEL') or None  # Number or 'auto'
+    BACKUP_PAGE_HASHES_ENABLED = os.environ.get('BACKUP_PAGE_HASHES_ENABLED', 'True').lower() == 'true'
+    BACKUP_SKIP_UNCHANGED = os.environ.get('BACKUP_SKIP_UNCHANGED', 'link')  # 'link', 'skip' or 'off'
+    # Tables left out of the unchanged-database fingerprint (backup jobs write their own bookkeeping there)
+    BACKUP_FINGERPRINT_IGNORE_TABLES = os.environ.get('BACKUP_FINGERPRINT_IGNORE_TABLES', 'backup_records,backup_stats')
+    BACKUP_DEDUP_CODEC = os.environ.get('BACKUP_DEDUP_CODEC', 'gzip')
+    BACKUP_DEDUP_AVG_CHUNK_SIZE = int(os.environ.get('BACKUP_DEDUP_AVG_CHUNK_SIZE', str(64 * 1024)))
+    BACKUP_DEDUP_GC_GRACE_SECONDS = int(os.environ.get('BACKUP_DEDUP_GC_GRACE_SECONDS', '3600'))
+    BACKUP_AUTO_TARGET_SECONDS = float(os.environ.get('BACKUP_AUTO_TARGET_SECONDS', '60'))
+    BACKUP_AUTO_TARGET_MB_S = float(os.environ.get('BACKUP_AUTO_TARGET_MB_S', '0'))  # 0 = no throughput target
+    BACKUP_AUTO_SAMPLE_CHUNKS = int(os.environ.get('BACKUP_AUTO_SAMPLE_CHUNKS', '4'))
+    BACKUP_AUTO_RESAMPLE_HOURS = float(os.environ.get('BACKUP_AUTO_RESAMPLE_HOURS', '24'))
+    BACKUP_INCREMENTAL_ENABLED = os.environ.get('BACKUP_INCREMENTAL_ENABLED', 'True').lower() == 'true'
+    BACKUP_STEP_PAGES = int(os.environ.get('BACKUP_STEP_PAGES', '64'))
+    BACKUP_WRITER_LATENCY_BUDGET_MS = int(os.environ.get('BACKUP_WRITER_LATENCY_BUDGET_MS', '50'))
+    BACKUP_STEP_SLEEP_MS = int(os.environ.get('BACKUP_STEP_SLEEP_MS', '25'))
+    BACKUP_MAX_RESTARTS = int(os.environ.get('BACKUP_MAX_RESTARTS', '5'))
+    BACKUP_JOB_WORKERS = int(os.environ.get('BACKUP_JOB_WORKERS', '2'))
+    BACKUP_LOCK_TIMEOUT_SECONDS = int(os.environ.get('BACKUP_LOCK_TIMEOUT_SECONDS', '3600'))
+    BACKUP_IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('BACKUP_IDEMPOTENCY_TTL_SECONDS', '600'))
+    BACKUP_EVENTS_HEARTBEAT_SECONDS = int(os.environ.get('BACKUP_EVENTS_HEARTBEAT_SECONDS', '15'))
+    BACKUP_WAL_ARCHIVING_ENABLED = os.environ.get('BACKUP_WAL_ARCHIVING_ENABLED', 'False').lower() == 'true'
+    BACKUP_WAL_ARCHIVE_INTERVAL_SECONDS = float(os.environ.get('BACKUP_WAL_ARCHIVE_INTERVAL_SECONDS', '10'))
+    BACKUP_WAL_CHECKPOINT_SECONDS = float(os.environ.get('BACKUP_WAL_CHECKPOINT_SECONDS', '300'))
+    BACKUP_WAL_CHECKPOINT_FRAMES = int(os.environ.get('BACKUP_WAL_CHECKPOINT_FRAMES', '1000'))
+    BACKUP_WAL_GENERATION_HOURS = float(os.environ.get('BACKUP_WAL_GENERATION_HOURS', '24'))  # New base snapshot this often
 
     # GPG settings
     @property
@@ -112,6 +176,64 @@ class Config:
             'GPG_BINARY_PATH': getattr(self, 'GPG_BINARY_PATH', None), # For DevelopmentConfig specific
             'GPG_KEYSERVER': self.GPG_KEYSERVER,
             'LOG_LEVEL': self.LOG_LEVEL,
+            'MAX_BACKUP_AGE_DAYS': self.MAX_BACKUP_AGE_DAYS,
+            'AUTO_BACKUP_ENABLED': self.AUTO_BACKUP_ENABLED,
+            'BACKUP_SCHEDULE_HOURS': self.BACKUP_SCHEDULE_HOURS,
+            'BACKUP_SCHEDULE_JITTER_MINUTES': self.BACKUP_SCHEDULE_JITTER_MINUTES,
+            'BACKUP_SCHEDULE_FORMAT': self.BACKUP_SCHEDULE_FORMAT,
+            'BACKUP_SCHEDULER_POLL_SECONDS': self.BACKUP_SCHEDULER_POLL_SECONDS,
+            'BACKUP_STATS_RECONCILE_HOURS': self.BACKUP_STATS_RECONCILE_HOURS,
+            'BACKUP_RETENTION_KEEP_LAST': self.BACKUP_RETENTION_KEEP_LAST,
+            'BACKUP_RETENTION_HOURLY': self.BACKUP_RETENTION_HOURLY,
+            'BACKUP_RETENTION_DAILY': self.BACKUP_RETENTION_DAILY,
+            'BACKUP_RETENTION_WEEKLY': self.BACKUP_RETENTION_WEEKLY,
+            'BACKUP_RETENTION_MONTHLY': self.BACKUP_RETENTION_MONTHLY,
+            'BACKUP_RETENTION_KEEP_WITHIN_DAYS': self.BACKUP_RETENTION_KEEP_WITHIN_DAYS,
+            'BACKUP_RETENTION_BATCH_SIZE': self.BACKUP_RETENTION_BATCH_SIZE,
+            'BACKUP_VERIFY_CONCURRENCY': self.BACKUP_VERIFY_CONCURRENCY,
+            'BACKUP_VERIFY_IO_MB_S': self.BACKUP_VERIFY_IO_MB_S,
+            'BACKUP_VERIFY_MEMORY_MB': self.BACKUP_VERIFY_MEMORY_MB,
+            'BACKUP_RESTORE_INTEGRITY_CHECK': self.BACKUP_RESTORE_INTEGRITY_CHECK,
+            'BACKUP_PRE_RESTORE_MODE': self.BACKUP_PRE_RESTORE_MODE,
+            'BACKUP_PRE_RESTORE_CODEC': self.BACKUP_PRE_RESTORE_CODEC,
+            'BACKUP_GPG_PIPELINE_ENABLED': self.BACKUP_GPG_PIPELINE_ENABLED,
+            'BACKUP_ENCRYPT_QUEUE_BLOCKS': self.BACKUP_ENCRYPT_QUEUE_BLOCKS,
+            'BACKUP_ENCRYPTION_ENGINE': self.BACKUP_ENCRYPTION_ENGINE,
+            'BACKUP_ENCRYPTION_KEY_PASSPHRASE': self.BACKUP_ENCRYPTION_KEY_PASSPHRASE,
+            'BACKUP_ENCRYPTION_CHUNK_SIZE': self.BACKUP_ENCRYPTION_CHUNK_SIZE,
+            'BACKUP_ENCRYPTION_WORKERS': self.BACKUP_ENCRYPTION_WORKERS,
+            'BACKUP_CONTAINER_CHUNK_SIZE': self.BACKUP_CONTAINER_CHUNK_SIZE,
+            'BACKUP_STREAMING_ENABLED': self.BACKUP_STREAMING_ENABLED,
+            'BACKUP_STREAM_BUFFER_SIZE': self.BACKUP_STREAM_BUFFER_SIZE,
+            'BACKUP_COMPRESSION_THREADS': self.BACKUP_COMPRESSION_THREADS,
+            'BACKUP_COMPRESSION_BLOCK_SIZE': self.BACKUP_COMPRESSION_BLOCK_SIZE,
+            'BACKUP_COMPRESSION_EXECUTOR': self.BACKUP_COMPRESSION_EXECUTOR,
+            'BACKUP_DEFAULT_CODEC': self.BACKUP_DEFAULT_CODEC,
+            'BACKUP_COMPRESSION_LEVEL': self.BACKUP_COMPRESSION_LEVEL,
+            'BACKUP_PAGE_HASHES_ENABLED': self.BACKUP_PAGE_HASHES_ENABLED,
+            'BACKUP_SKIP_UNCHANGED': self.BACKUP_SKIP_UNCHANGED,
+            'BACKUP_FINGERPRINT_IGNORE_TABLES': self.BACKUP_FINGERPRINT_IGNORE_TABLES,
+            'BACKUP_DEDUP_CODEC': self.BACKUP_DEDUP_CODEC,
+            'BACKUP_DEDUP_AVG_CHUNK_SIZE': self.BACKUP_DEDUP_AVG_CHUNK_SIZE,
+            'BACKUP_DEDUP_GC_GRACE_SECONDS': self.BACKUP_DEDUP_GC_GRACE_SECONDS,
+            'BACKUP_AUTO_TARGET_SECONDS': self.BACKUP_AUTO_TARGET_SECONDS,
+            'BACKUP_AUTO_TARGET_MB_S': self.BACKUP_AUTO_TARGET_MB_S,
+            'BACKUP_AUTO_SAMPLE_CHUNKS': self.BACKUP_AUTO_SAMPLE_CHUNKS,
+            'BACKUP_AUTO_RESAMPLE_HOURS': self.BACKUP_AUTO_RESAMPLE_HOURS,
+            'BACKUP_INCREMENTAL_ENABLED': self.BACKUP_INCREMENTAL_ENABLED,
+            'BACKUP_STEP_PAGES': self.BACKUP_STEP_PAGES,
+            'BACKUP_WRITER_LATENCY_BUDGET_MS': self.BACKUP_WRITER_LATENCY_BUDGET_MS,
+            'BACKUP_STEP_SLEEP_MS': self.BACKUP_STEP_SLEEP_MS,
+            'BACKUP_MAX_RESTARTS': self.BACKUP_MAX_RESTARTS,
+            'BACKUP_JOB_WORKERS': self.BACKUP_JOB_WORKERS,
+            'BACKUP_LOCK_TIMEOUT_SECONDS': self.BACKUP_LOCK_TIMEOUT_SECONDS,
+            'BACKUP_IDEMPOTENCY_TTL_SECONDS': self.BACKUP_IDEMPOTENCY_TTL_SECONDS,
+            'BACKUP_EVENTS_HEARTBEAT_SECONDS': self.BACKUP_EVENTS_HEARTBEAT_SECONDS,
+            'BACKUP_WAL_ARCHIVING_ENABLED': self.BACKUP_WAL_ARCHIVING_ENABLED,
+            'BACKUP_WAL_ARCHIVE_INTERVAL_SECONDS': self.BACKUP_WAL_ARCHIVE_INTERVAL_SECONDS,
+            'BACKUP_WAL_CHECKPOINT_SECONDS': self.BACKUP_WAL_CHECKPOINT_SECONDS,
+            'BACKUP_WAL_CHECKPOINT_FRAMES': self.BACKUP_WAL_CHECKPOINT_FRAMES,
+            'BACKUP_WAL_GENERATION_HOURS': self.BACKUP_WAL_GENERATION_HOURS,
             'APP_PATHS': self.paths # Crucial for app.py to get paths from app.config
         }
 
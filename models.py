@@ -1,10 +1,12 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import event, inspect
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 import sqlite3
 import os
 import json
+import logging
 from typing import List, Dict, Optional, Any
 
 db = SQLAlchemy()
@@ -96,20 +98,28 @@ class BackupRecord(db.Model):
     filename = db.Column(db.String(255), nullable=False)
     backup_type = db.Column(db.String(50), nullable=False)  # 'regular', 'encrypted', 'pre_restore', etc.
     description = db.Column(db.Text, nullable=True)
-    file_size = db.Column(db.BigInteger, nullable=True)  # Size in bytes
+    # Columns feeding BackupStats load their previous value on change (active_history), so the
+    # mapper events below can move a record's contribution even after a commit expired it
+    file_size = db.column_property(db.Column(db.BigInteger, nullable=True), active_history=True)  # Size in bytes
     file_path = db.Column(db.String(500), nullable=True)  # Full path to backup file
     checksum = db.Column(db.String(64), nullable=True)  # SHA256 checksum for integrity
-    is_encrypted = db.Column(db.Boolean, default=False)
-    compression_type = db.Column(db.String(20), nullable=True)  # 'gzip', 'zip', etc.
-    status = db.Column(db.String(20), default='completed')  # 'in_progress', 'completed', 'failed'
+    is_encrypted = db.column_property(db.Column(db.Boolean, default=False), active_history=True)
+    encryption_engine = db.Column(db.String(20), nullable=True)  # 'gpg' or 'aes-gcm'; None when not encrypted
+    compression_type = db.column_property(db.Column(db.String(20), nullable=True), active_history=True)  # Codec name: 'gzip', 'bz2', 'lzma'; None when uncompressed
+    status = db.column_property(db.Column(db.String(20), default='completed'), active_history=True)  # 'queued', 'running', 'in_progress', 'completed', 'failed'
     error_message = db.Column(db.Text, nullable=True)
     
     # Foreign key to user who created the backup
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
     
     # Timestamps
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.column_property(db.Column(db.DateTime, default=datetime.utcnow), active_history=True)
     completed_at = db.Column(db.DateTime, nullable=True)
+
+    # Last bulk verification (see backup_verify)
+    verified_at = db.Column(db.DateTime, nullable=True)
+    verification_status = db.Column(db.String(20), nullable=True)  # 'ok', 'failed', 'skipped'
+    verification_error = db.Column(db.Text, nullable=True)
     
     def __repr__(self):
         return f'<BackupRecord {self.filename}>'
@@ -125,15 +135,24 @@ class BackupRecord(db.Model):
             'file_path': self.file_path,
             'checksum': self.checksum,
             'is_encrypted': self.is_encrypted,
+            'encryption_engine': self.encryption_engine,
             'compression_type': self.compression_type,
             'status': self.status,
             'error_message': self.error_message,
             'user_id': self.user_id,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'completed_at': self.completed_at.isoformat() if self.completed_at else None,
+            'verified_at': self.verified_at.isoformat() if self.verified_at else None,
+            'verification_status': self.verification_status,
+            'verification_error': self.verification_error,
             'user': self.user.username if self.user else None
         }
     
+    def mark_running(self):
+        """Mark a queued backup as running."""
+        self.status = 'running'
+        db.session.commit()
+    
     def mark_completed(self, file_size: int = None, checksum: str = None):
         """Mark backup as completed."""
         self.status = 'completed'
@@ -151,9 +170,16 @@ class BackupRecord(db.Model):
         self.completed_at = datetime.utcnow()
         db.session.commit()
     
+    def record_verification(self, status: str, error: str = None):
+        """Record a verification result (the caller commits, so results can be batched)."""
+        self.verified_at = datetime.utcnow()
+        self.verification_status = status
+        self.verification_error = error
+    
     @classmethod
     def create_backup_record(cls, filename: str, backup_type: str, user_id: int = None,
-                           description: str = None, file_path: str = None) -> 'BackupRecord':
+                           description: str = None, file_path: str = None,
+                           status: str = 'in_progress', compression_type: str = None) -> 'BackupRecord':
         """Create a new backup record."""
         record = cls(
             filename=filename,
@@ -161,7 +187,8 @@ class BackupRecord(db.Model):
             description=description,
             file_path=file_path,
             user_id=user_id,
-            status='in_progress'
+            status=status,
+            compression_type=compression_type
         )
         db.session.add(record)
         db.session.commit()
@@ -174,25 +201,167 @@ class BackupRecord(db.Model):
     
     @classmethod
     def get_backup_stats(cls) -> Dict[str, Any]:
-        """Get backup statistics."""
-        total_backups = cls.query.count()
-        successful_backups = cls.query.filter_by(status='completed').count()
-        failed_backups = cls.query.filter_by(status='failed').count()
-        encrypted_backups = cls.query.filter_by(is_encrypted=True).count()
-        
-        # Calculate total backup size
-        total_size = db.session.query(db.func.sum(cls.file_size)).filter(
-            cls.status == 'completed'
-        ).scalar() or 0
-        
+        """Get backup statistics (read from the running totals in BackupStats)."""
+        return BackupStats.get_stats()
+
+
+class BackupStats(db.Model):
+    """
+    Running totals over backup_records, kept in a single row.
+
+    The counters are adjusted by mapper events in the same flush that inserts,
+    updates or deletes a BackupRecord, so reading them is one primary-key
+    lookup. reconcile() recomputes them from backup_records.
+    """
+    
+    __tablename__ = 'backup_stats'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    total_backups = db.Column(db.Integer, nullable=False, default=0)
+    successful_backups = db.Column(db.Integer, nullable=False, default=0)
+    failed_backups = db.Column(db.Integer, nullable=False, default=0)
+    encrypted_backups = db.Column(db.Integer, nullable=False, default=0)
+    compressed_backups = db.Column(db.Integer, nullable=False, default=0)  # Completed only
+    total_size_bytes = db.Column(db.BigInteger, nullable=False, default=0)  # Completed only
+    oldest_backup = db.Column(db.DateTime, nullable=True)  # Oldest completed backup
+    newest_backup = db.Column(db.DateTime, nullable=True)  # Newest completed backup
+    reconciled_at = db.Column(db.DateTime, nullable=True)
+    
+    COUNTERS = ('total_backups', 'successful_backups', 'failed_backups', 'encrypted_backups',
+                'compressed_backups', 'total_size_bytes')
+    
+    def __repr__(self):
+        return f'<BackupStats {self.total_backups} backups>'
+    
+    @staticmethod
+    def contribution(status: Optional[str], file_size: Optional[int], is_encrypted: Optional[bool],
+                     compression_type: Optional[str]) -> Dict[str, int]:
+        """What one backup record adds to each counter."""
+        completed = status == 'completed'
+        return {
+            'total_backups': 1,
+            'successful_backups': int(completed),
+            'failed_backups': int(status == 'failed'),
+            'encrypted_backups': int(bool(is_encrypted)),
+            'compressed_backups': int(completed and compression_type is not None),
+            'total_size_bytes': (file_size or 0) if completed else 0
+        }
+    
+    @classmethod
+    def get_stats(cls) -> Dict[str, Any]:
+        """Backup statistics from the running totals."""
+        stats = db.session.get(cls, 1)
+        if stats is None:
+            stats = cls.reconcile()
+        total_size = stats.total_size_bytes
         return {
-            'total_backups': total_backups,
-            'successful_backups': successful_backups,
-            'failed_backups': failed_backups,
-            'encrypted_backups': encrypted_backups,
+            'total_backups': stats.total_backups,
+            'successful_backups': stats.successful_backups,
+            'failed_backups': stats.failed_backups,
+            'encrypted_backups': stats.encrypted_backups,
+            'compressed_backups': stats.compressed_backups,
+            'uncompressed_backups': stats.successful_backups - stats.compressed_backups,
             'total_size_bytes': total_size,
-            'total_size_mb': round(total_size / (1024 * 1024), 2) if total_size > 0 else 0
+            'total_size_mb': round(total_size / (1024 * 1024), 2) if total_size > 0 else 0,
+            'oldest_backup': stats.oldest_backup,
+            'newest_backup': stats.newest_backup
         }
+    
+    @classmethod
+    def reconcile(cls) -> 'BackupStats':
+        """Recompute the totals from backup_records, logging any counter that had drifted."""
+        record = BackupRecord
+        completed = record.status == 'completed'
+        row = db.session.query(
+            db.func.count(record.id),
+            db.func.sum(db.case((completed, 1), else_=0)),
+            db.func.sum(db.case((record.status == 'failed', 1), else_=0)),
+            db.func.sum(db.case((record.is_encrypted.is_(True), 1), else_=0)),
+            db.func.sum(db.case((db.and_(completed, record.compression_type.isnot(None)), 1), else_=0)),
+            db.func.sum(db.case((completed, record.file_size), else_=0)),
+            db.func.min(db.case((completed, record.created_at))),
+            db.func.max(db.case((completed, record.created_at)))
+        ).one()
+        values = dict(zip(cls.COUNTERS, (value or 0 for value in row[:6])))
+        
+        stats = db.session.get(cls, 1)
+        if stats is None:
+            stats = cls(id=1)
+            db.session.add(stats)
+        else:
+            drift = {name: (getattr(stats, name), value) for name, value in values.items()
+                     if getattr(stats, name) != value}
+            if drift:
+                logging.getLogger('backup').warning(f"Backup record totals had drifted: {drift}")
+        for name, value in values.items():
+            setattr(stats, name, value)
+        stats.oldest_backup, stats.newest_backup = row[6], row[7]
+        stats.reconciled_at = datetime.utcnow()
+        db.session.commit()
+        return stats
+
+
+def _apply_backup_stats(connection, old: Optional[Dict[str, Any]], new: Optional[Dict[str, Any]]):
+    """Move one record's contribution to BackupStats from its old values to its new ones."""
+    table = BackupStats.__table__
+    deltas = dict.fromkeys(BackupStats.COUNTERS, 0)
+    if old:
+        for name, value in BackupStats.contribution(old['status'], old['file_size'], old['is_encrypted'],
+                                                    old['compression_type']).items():
+            deltas[name] -= value
+    if new:
+        for name, value in BackupStats.contribution(new['status'], new['file_size'], new['is_encrypted'],
+                                                    new['compression_type']).items():
+            deltas[name] += value
+    
+    values = {name: table.c[name] + delta for name, delta in deltas.items() if delta}
+    was_completed = bool(old) and old['status'] == 'completed'
+    is_completed = bool(new) and new['status'] == 'completed'
+    if is_completed and new['created_at']:
+        created = new['created_at']
+        values['oldest_backup'] = db.case((table.c.oldest_backup.is_(None), created),
+                                          (table.c.oldest_backup > created, created), else_=table.c.oldest_backup)
+        values['newest_backup'] = db.case((table.c.newest_backup.is_(None), created),
+                                          (table.c.newest_backup < created, created), else_=table.c.newest_backup)
+    elif was_completed and old['created_at']:
+        # Only a removed endpoint needs a rescan of the completed records
+        completed = BackupRecord.__table__.c
+        values['oldest_backup'] = db.case(
+            (table.c.oldest_backup == old['created_at'],
+             db.select(db.func.min(completed.created_at)).where(completed.status == 'completed').scalar_subquery()),
+            else_=table.c.oldest_backup)
+        values['newest_backup'] = db.case(
+            (table.c.newest_backup == old['created_at'],
+             db.select(db.func.max(completed.created_at)).where(completed.status == 'completed').scalar_subquery()),
+            else_=table.c.newest_backup)
+    if values:
+        # Relative updates, so concurrent workers never overwrite each other's counts
+        connection.execute(table.update().where(table.c.id == 1).values(**values))
+
+
+_STATS_FIELDS = ('status', 'file_size', 'is_encrypted', 'compression_type', 'created_at')
+
+
+@event.listens_for(BackupRecord, 'after_insert')
+def _backup_record_inserted(mapper, connection, target):
+    _apply_backup_stats(connection, None, {name: getattr(target, name) for name in _STATS_FIELDS})
+
+
+@event.listens_for(BackupRecord, 'after_update')
+def _backup_record_updated(mapper, connection, target):
+    state = inspect(target)
+    old = {}
+    for name in _STATS_FIELDS:
+        history = state.attrs[name].history
+        old[name] = history.deleted[0] if history.deleted else getattr(target, name)
+    new = {name: getattr(target, name) for name in _STATS_FIELDS}
+    if old != new:
+        _apply_backup_stats(connection, old, new)
+
+
+@event.listens_for(BackupRecord, 'after_delete')
+def _backup_record_deleted(mapper, connection, target):
+    _apply_backup_stats(connection, {name: getattr(target, name) for name in _STATS_FIELDS}, None)
 
 
 class Customer(db.Model):
@@ -391,9 +560,29 @@ class DatabaseManager:
         """Initialize database with tables."""
         with app.app_context():
             db.create_all()
+            DatabaseManager.ensure_schema()
             # Create default admin user
             UserService.create_default_admin()
     
+    @staticmethod
+    def ensure_schema():
+        """
+        Add columns missing from existing tables (create_all only creates new tables).
+        Only nullable columns without server defaults are added, which SQLite can do in place.
+        """
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                with db.engine.begin() as conn:
+                    conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+                logging.getLogger(__name__).info(f"Added column {table.name}.{column.name}")
+    
     @staticmethod
     def backup_database(backup_path: str) -> bool:
         """Create a backup of the SQLite database."""
@@ -3,7 +3,7 @@
 import os
 from pathlib import Path
 from typing import Optional, Dict
-from datetime import datetime, timedelta
+from datetime import datetime
 
 class AppPaths:
     """Centralized path management using pathlib"""
@@ -80,6 +80,10 @@ class AppPaths:
     def gpg_keys_dir(self) -> Path:
         return self.gpg_home_dir / "keys"
 
+    @property
+    def encryption_keys_dir(self) -> Path:
+        return Path(os.environ.get('BACKUP_ENCRYPTION_KEY_DIR', self.data_dir / "encryption_keys"))
+
     # --- Logging paths ---
     @property
     def log_dir(self) -> Path:
@@ -158,17 +162,3 @@ class AppPaths:
 
     def get_gpg_backup_filename(self, original_filename: str) -> str:
         return f"{original_filename}.gpg"
-
-    def cleanup_old_backups(self, max_age_days=30) -> int:
-        cutoff = datetime.now() - timedelta(days=max_age_days)
-        count = 0
-        if not self.backup_dir.exists():
-            return 0
-        try:
-            for f in self.backup_dir.glob("backup_*.db*"):
-                if f.is_file() and datetime.fromtimestamp(f.stat().st_mtime) < cutoff:
-                    f.unlink()
-                    count += 1
-        except Exception as e:
-            print(f"Error during backup cleanup: {e}")
-        return count
\ No newline at end of file
@@ -63,7 +63,7 @@ def register_core_routes(app): # Removed config, db, backup_manager, gpg_backup
             recent_backups = []
             if backup_manager:
                 backup_stats = backup_manager.get_backup_stats()
-                recent_backups = backup_manager.list_backups()[:5]
+                recent_backups = backup_manager.list_backups(limit=5)
             
             db_info = {}
             if app_config and app_config.paths and app_config.paths.database_file:
@@ -1,5 +1,75 @@
 // main.js - Handles regular (non-GPG) backup form submission and triggers download
 
+// Poll a queued backup job until it completes or fails. Resolves with the final job data.
+async function pollBackupJob(statusUrl, intervalMs = 1000) {
+    while (true) {
+        const response = await fetch(statusUrl);
+        const job = await response.json();
+        if (!job.success) {
+            throw new Error(job.error || 'Could not read backup job status.');
+        }
+        if (job.completed) {
+            return job;
+        }
+        if (job.failed) {
+            throw new Error(job.error || 'Backup failed.');
+        }
+        await new Promise(resolve => setTimeout(resolve, intervalMs));
+    }
+}
+
+// Describe a progress event from /backup/jobs/<id>/events for display
+window.describeBackupProgress = function(event) {
+    const labels = {snapshot: 'Copying pages', compress: 'Compressing', encrypt: 'Encrypting'};
+    let text = labels[event.stage] || 'Working';
+    if (event.fraction !== undefined && event.fraction !== null) {
+        text += ` ${Math.round(event.fraction * 100)}%`;
+    }
+    if (event.throughput_mb_s) {
+        text += ` · ${event.throughput_mb_s} MB/s`;
+    }
+    if (event.eta_seconds) {
+        text += ` · ETA ${Math.ceil(event.eta_seconds)}s`;
+    }
+    return text;
+};
+
+// Wait for a queued backup job, streaming progress over Server-Sent Events when
+// available and falling back to polling the status URL otherwise.
+window.waitForBackupJob = function(job, onProgress) {
+    if (!job.events_url || typeof EventSource === 'undefined') {
+        return pollBackupJob(job.status_url);
+    }
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(job.events_url);
+        source.addEventListener('progress', e => {
+            if (onProgress) onProgress(JSON.parse(e.data));
+        });
+        source.addEventListener('done', e => {
+            source.close();
+            const result = JSON.parse(e.data);
+            if (result.completed) {
+                resolve(result);
+            } else {
+                reject(new Error(result.error || 'Backup failed.'));
+            }
+        });
+        source.onerror = () => {
+            // Stream dropped (proxy, restart); finish by polling instead
+            source.close();
+            pollBackupJob(job.status_url).then(resolve, reject);
+        };
+    });
+};
+
+// A new key per finished request: repeats of one request (double-clicks, retries) share a job
+window.renewIdempotencyKey = function() {
+    const input = document.getElementById('idempotencyKey');
+    if (input) {
+        input.value = window.crypto && crypto.randomUUID ? crypto.randomUUID() : Date.now() + '-' + Math.random();
+    }
+};
+
 document.addEventListener('DOMContentLoaded', function() {
     const backupForm = document.getElementById('backupForm');
     if (backupForm) {
@@ -7,13 +77,19 @@ document.addEventListener('DOMContentLoaded', function() {
             e.preventDefault();
             const formData = new FormData(backupForm);
             const createBtn = document.getElementById('createBackupBtn');
+            const createBtnHtml = createBtn ? createBtn.innerHTML : '';
             if (createBtn) createBtn.disabled = true;
             try {
                 const response = await fetch('/backup/create', {
                     method: 'POST',
                     body: formData
                 });
-                const data = await response.json();
+                let data = await response.json();
+                if (data.success && !data.completed && data.status_url) {
+                    data = await window.waitForBackupJob(data, progress => {
+                        if (createBtn) createBtn.textContent = window.describeBackupProgress(progress);
+                    });
+                }
                 if (data.success && data.download_url) {
                     window.location.href = data.download_url;
                 } else {
@@ -22,7 +98,11 @@ document.addEventListener('DOMContentLoaded', function() {
             } catch (err) {
                 alert('Backup failed: ' + err.message);
             } finally {
-                if (createBtn) createBtn.disabled = false;
+                if (createBtn) {
+                    createBtn.disabled = false;
+                    createBtn.innerHTML = createBtnHtml;
+                }
+                window.renewIdempotencyKey();
             }
         });
     }
@@ -0,0 +1,107 @@
+"""
+Shared fixtures: an application whose data, backups and logs live in a
+temporary directory, and helpers to seed the database and wait for jobs
+"""
+
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from paths import AppPaths  # noqa: E402
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Point AppPaths (which pins data/ and logs/ under the app root) at tmp_path"""
+    monkeypatch.setattr(AppPaths, 'data_dir', property(lambda self: tmp_path / 'data'))
+    monkeypatch.setattr(AppPaths, 'log_dir', property(lambda self: tmp_path / 'logs'))
+    for name in ('BACKUP_DIR', 'GPG_HOME_DIR', 'BACKUP_ENCRYPTION_KEY_DIR', 'DATABASE_URL'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('AUTO_BACKUP_ENABLED', 'False')
+    return tmp_path / 'data'
+
+
+@pytest.fixture
+def app(data_dir):
+    from app import create_app
+    app = create_app('development')
+    app.config['TESTING'] = True
+    app.config['LOGIN_DISABLED'] = True
+    app.config['BACKUP_SKIP_UNCHANGED'] = 'off'
+    yield app
+    app.extensions['backup_jobs'].shutdown()
+    with app.app_context():
+        from models import db
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def backup_manager(app):
+    return app.extensions['backup_manager']
+
+
+def add_rows(database_file: Path, count: int = 2000, table: str = 'notes'):
+    """Add rows of incompressible text to a table of the database"""
+    conn = sqlite3.connect(str(database_file))
+    try:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, body TEXT)")
+        conn.executemany(f"INSERT INTO {table} (body) VALUES (?)", [(os.urandom(64).hex(),) for _ in range(count)])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def count_rows(database_file: Path, table: str = 'notes') -> int:
+    conn = sqlite3.connect(str(database_file))
+    try:
+        return conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def wait_for_job(app, job_id: int, timeout: float = 30) -> dict:
+    """Poll a backup job until it completes or fails"""
+    jobs = app.extensions['backup_jobs']
+    deadline = time.monotonic() + timeout
+    with app.app_context():
+        while time.monotonic() < deadline:
+            job = jobs.get_job(job_id)
+            if job['completed'] or job['failed']:
+                return job
+            time.sleep(0.05)
+    raise AssertionError(f"Backup job {job_id} did not finish within {timeout}s")
+
+
+@pytest.fixture
+def gpg_recipient(app):
+    """Generate an unprotected ed25519 key pair in the app's GPG home and return its address"""
+    email = 'backups@example.com'
+    subprocess.run([app.config.get('GPG_BINARY_PATH', 'gpg'), '--homedir', str(app.config['APP_PATHS'].gpg_home_dir),
+                    '--batch', '--passphrase', '', '--pinentry-mode', 'loopback',
+                    '--quick-gen-key', email, 'ed25519', 'default', 'never'],
+                   check=True, capture_output=True)
+    subprocess.run([app.config.get('GPG_BINARY_PATH', 'gpg'), '--homedir', str(app.config['APP_PATHS'].gpg_home_dir),
+                    '--batch', '--passphrase', '', '--pinentry-mode', 'loopback',
+                    '--quick-add-key', _fingerprint(app, email), 'cv25519', 'encr', 'never'],
+                   check=True, capture_output=True)
+    return email
+
+
+def _fingerprint(app, email: str) -> str:
+    listing = subprocess.run([app.config.get('GPG_BINARY_PATH', 'gpg'), '--homedir',
+                              str(app.config['APP_PATHS'].gpg_home_dir), '--batch', '--with-colons',
+                              '--list-keys', email], check=True, capture_output=True, text=True).stdout
+    return next(line.split(':')[9] for line in listing.splitlines() if line.startswith('fpr:'))
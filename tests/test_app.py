@@ -0,0 +1,169 @@
+"""Backup routes and background jobs"""
+
+import json
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+from backup_catalog import backup_time
+from backup_scheduler import BackupScheduler
+from tests.conftest import add_rows, count_rows, wait_for_job
+
+
+def test_encrypted_dedup_backup_is_rejected(app, client, backup_manager):
+    add_rows(backup_manager.app_paths.database_file)
+    response = client.post('/backup/create', data={'format': 'dedup', 'encrypt_gpg': 'on',
+                                                   'gpg_email': 'ops@example.com', 'encryption_engine': 'aes-gcm'})
+    assert response.status_code == 400
+    assert 'cannot be encrypted' in response.json['error']
+    assert not list(backup_manager.app_paths.backup_dir.glob('backup_*'))
+
+
+def test_submit_refuses_encrypted_dedup(app, backup_manager):
+    jobs = app.extensions['backup_jobs']
+    with app.app_context():
+        with pytest.raises(ValueError, match='cannot be encrypted'):
+            jobs.submit(format='dedup', encrypt_gpg=True, gpg_email='ops@example.com', encryption_engine='aes-gcm')
+
+
+def test_encrypted_differential_backup_is_rejected(app, client, backup_manager):
+    add_rows(backup_manager.app_paths.database_file)
+    response = client.post('/backup/create', data={'format': 'gz', 'backup_type': 'differential', 'encrypt_gpg': 'on',
+                                                   'gpg_email': 'ops@example.com', 'encryption_engine': 'aes-gcm'})
+    assert response.status_code == 400
+    assert 'cannot be encrypted' in response.json['error']
+
+    jobs = app.extensions['backup_jobs']
+    with app.app_context():
+        with pytest.raises(ValueError, match='cannot be encrypted'):
+            jobs.submit(format='gz', backup_type='differential', encrypt_gpg=True, gpg_email='ops@example.com',
+                        encryption_engine='aes-gcm')
+    assert backup_manager.create_backup(format='gz', backup_type='differential', encrypt_to='ops@example.com',
+                                        encryption_engine='aes-gcm') is None
+    assert not list(backup_manager.app_paths.backup_dir.glob('backup_*'))
+
+
+def test_job_links_unchanged_database_despite_its_own_bookkeeping(app, backup_manager):
+    add_rows(backup_manager.app_paths.database_file)
+    app.config['BACKUP_SKIP_UNCHANGED'] = 'link'
+    jobs = app.extensions['backup_jobs']
+    with app.app_context():
+        first = wait_for_job(app, jobs.submit(format='gz').id)
+    first_path = backup_manager.app_paths.backup_dir / first['filename']
+    an_hour_ago = time.time() - 3600
+    os.utime(first_path, (an_hour_ago, an_hour_ago))
+    with app.app_context():
+        second = wait_for_job(app, jobs.submit(format='gz').id)
+    assert first['completed'] and second['completed']
+    second_path = backup_manager.app_paths.backup_dir / second['filename']
+    assert first_path != second_path
+    assert os.path.samefile(first_path, second_path)
+    metadata = json.loads(second_path.with_suffix(second_path.suffix + '.meta').read_text())
+    assert metadata['unchanged_from'] == first_path.name
+    # Each name keeps its own date: linking neither re-dates the original nor back-dates the link
+    assert abs(first_path.stat().st_mtime - an_hour_ago) < 1
+    for path in (first_path, second_path):
+        created = json.loads(path.with_suffix(path.suffix + '.meta').read_text())['created_at']
+        assert backup_time(path, path.stat()) == datetime.fromisoformat(created).timestamp()
+    assert time.time() - backup_time(second_path, second_path.stat()) < 60
+
+    add_rows(backup_manager.app_paths.database_file, count=10)
+    with app.app_context():
+        third = wait_for_job(app, jobs.submit(format='gz').id)
+    assert not os.path.samefile(first_path, backup_manager.app_paths.backup_dir / third['filename'])
+
+
+def test_encrypt_after_job_never_deletes_a_reused_backup(app, backup_manager, gpg_recipient):
+    add_rows(backup_manager.app_paths.database_file)
+    app.config['BACKUP_SKIP_UNCHANGED'] = 'skip'
+    app.config['BACKUP_GPG_PIPELINE_ENABLED'] = False
+    jobs = app.extensions['backup_jobs']
+    with app.app_context():
+        plain = wait_for_job(app, jobs.submit(format='gz').id)
+        sealed = wait_for_job(app, jobs.submit(format='gz', encrypt_gpg=True, gpg_email=gpg_recipient,
+                                               encryption_engine='gpg').id)
+    assert plain['completed'] and sealed['completed'], sealed.get('error')
+    backup_dir = backup_manager.app_paths.backup_dir
+    assert (backup_dir / plain['filename']).exists()
+    assert (backup_dir / sealed['filename']).suffix == '.gpg'
+    assert [path.name for path in backup_dir.glob('backup_*.gz')] == [plain['filename']]
+    assert not [path for path in backup_dir.glob('backup_*.meta') if path.name != plain['filename'] + '.meta']
+
+
+def test_encrypted_job_completes_only_once_its_plaintext_is_gone(app, backup_manager, gpg_recipient, monkeypatch):
+    add_rows(backup_manager.app_paths.database_file)
+    app.config['BACKUP_GPG_PIPELINE_ENABLED'] = False
+    jobs = app.extensions['backup_jobs']
+    backup_dir = backup_manager.app_paths.backup_dir
+    left_at_completion = []
+    complete_job = jobs._complete_job
+
+    def record_leftovers(job_id, options, final_path):
+        left_at_completion.extend(path.name for path in backup_dir.glob('backup_*') if path.suffix != '.gpg')
+        complete_job(job_id, options, final_path)
+
+    monkeypatch.setattr(jobs, '_complete_job', record_leftovers)
+    with app.app_context():
+        job = wait_for_job(app, jobs.submit(format='gz', encrypt_gpg=True, gpg_email=gpg_recipient,
+                                            encryption_engine='gpg').id)
+    assert job['completed'], job.get('error')
+    assert left_at_completion == []
+    assert [path.name for path in backup_dir.glob('backup_*')] == [job['filename']]
+    assert job['filename'][:-len('.gpg')] not in [backup['name'] for backup in backup_manager.catalog.list()]
+
+
+def test_backup_route_queues_a_job_that_can_be_restored(app, client, backup_manager):
+    database_file = backup_manager.app_paths.database_file
+    add_rows(database_file)
+    response = client.post('/backup/create', data={'format': 'gz', 'idempotency_key': 'create-1'})
+    assert response.status_code == 202
+    job_id = response.json['job_id']
+    # A retried request with the same key gets the same job
+    assert client.post('/backup/create', data={'format': 'gz', 'idempotency_key': 'create-1'}).json['job_id'] == job_id
+    assert response.json['status_url'].endswith(f'/backup/jobs/{job_id}')
+
+    wait_for_job(app, job_id)
+    status = client.get(f'/backup/jobs/{job_id}').json
+    assert status['completed'] and status['download_url'].endswith(status['filename'])
+    listed = {backup['filename']: backup for backup in client.get('/backup/list').json['backups']}
+    assert listed[status['filename']]['exists']
+
+    add_rows(database_file, count=100)
+    response = client.post('/backup/restore', data={'backup_name': status['filename']})
+    assert response.status_code == 200, response.json
+    assert count_rows(database_file) == 2000
+
+
+def test_job_events_stream_ends_with_the_job_status(app, client, backup_manager):
+    add_rows(backup_manager.app_paths.database_file)
+    job_id = client.post('/backup/create', data={'format': 'gz'}).json['job_id']
+    response = client.get(f'/backup/jobs/{job_id}/events')
+    assert response.mimetype == 'text/event-stream'
+    events = [block.split('\n', 1) for block in response.get_data(as_text=True).split('\n\n')
+              if block.startswith('event: ')]
+    assert events[-1][0] == 'event: done'
+    done = json.loads(events[-1][1][len('data: '):])
+    assert done['completed'] and done['download_url'].endswith(done['filename'])
+    for name, data in events[:-1]:
+        assert name == 'event: progress' and 0 <= json.loads(data[len('data: '):]).get('fraction', 0) <= 1
+
+    assert client.get('/backup/jobs/999999/events').status_code == 404
+
+
+def test_scheduler_resumes_its_cadence_and_runs_an_overdue_job_once(app, backup_manager):
+    scheduler = BackupScheduler(app, backup_manager)
+    started = time.time()
+    scheduler._save_state({'backup': started - 3 * 24 * 3600, 'cleanup': started - 60})
+    ran = []
+    scheduler.run_backup = lambda: ran.append('backup')
+    scheduler.run_cleanup = lambda: ran.append('cleanup')
+    scheduler._schedule_jobs()
+    scheduler.scheduler.run_pending()
+    scheduler.scheduler.run_pending()
+    # Three missed backups run once; cleanup keeps the interval since its last run
+    assert ran == ['backup']
+    assert scheduler._load_state()['backup'] >= started
+    # (less a millisecond: datetime.fromtimestamp rounds to whole microseconds)
+    assert scheduler.next_runs()['cleanup'].timestamp() >= started - 60.001 + scheduler.interval_minutes * 60
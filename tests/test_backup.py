@@ -0,0 +1,446 @@
+"""DatabaseBackup: snapshots and restore"""
+
+import io
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+import pytest
+
+import backup_verify
+from backup_compression import CompressionTuner, available_codecs, get_codec
+from backup_dedup import ContentDefinedChunker
+from backup_retention import RetentionPolicy
+from backup_wal import WalArchiver, restore_to_time
+from tests.conftest import add_rows, count_rows
+
+
+@pytest.mark.parametrize('streaming', [True, False])
+def test_gz_backup_streams_or_falls_back_to_a_temp_file(app, backup_manager, tmp_path, streaming):
+    # The stepped copy takes over in rollback-journal mode unless turned off
+    app.config.update(BACKUP_STREAMING_ENABLED=streaming, BACKUP_INCREMENTAL_ENABLED=False)
+    add_rows(backup_manager.app_paths.database_file, count=500)
+    backup = backup_manager.create_backup(format='gz')
+    assert backup is not None and backup.name.endswith('.db.gz')
+    metadata = json.loads(backup.with_suffix(backup.suffix + '.meta').read_text())
+    assert (metadata['backup_method'] == 'streaming_snapshot') is streaming
+    assert metadata['duration_seconds'] >= 0
+
+    restored = tmp_path / 'restored.db'
+    assert backup_manager.restore_backup(backup, target_path=restored)
+    assert count_rows(restored) == 500
+
+
+def _wait_for(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
+@pytest.mark.parametrize('format', ['gz', 'bz2', 'xz', 'db'])
+def test_backup_restores_over_the_live_database(backup_manager, format):
+    database_file = backup_manager.app_paths.database_file
+    add_rows(database_file, count=500)
+    backup = backup_manager.create_backup(format=format)
+    assert backup is not None and backup.exists()
+    metadata = json.loads(backup.with_suffix(backup.suffix + '.meta').read_text())
+    assert metadata['checksum'] == backup_manager.backup_checksum(backup)
+
+    add_rows(database_file, count=100)
+    assert backup_manager.restore_backup(backup, keep_current=True)
+    assert count_rows(database_file) == 500
+    # No staging file is left beside the database
+    assert not list(database_file.parent.glob(f'.{database_file.name}.restore-*'))
+
+    # The replaced database is kept as a pre_restore backup, compressed in the background
+    backup_dir = backup_manager.app_paths.backup_dir
+    _wait_for(lambda: list(backup_dir.glob('backup_pre_restore_*.db.gz'))
+              and not list(backup_dir.glob('backup_pre_restore_*.db')))
+    kept = next(backup_dir.glob('backup_pre_restore_*.db.gz'))
+    restored = backup_dir.parent / 'check.db'
+    assert backup_manager.restore_backup(kept, target_path=restored)
+    assert count_rows(restored) == 600
+
+
+def test_failed_restore_leaves_the_live_database_untouched(backup_manager):
+    database_file = backup_manager.app_paths.database_file
+    add_rows(database_file, count=500)
+    backup = backup_manager.create_backup(format='db')
+    add_rows(database_file, count=100)
+    data = bytearray(backup.read_bytes())
+    data[:16] = b'not a database!!'
+    backup.write_bytes(bytes(data))
+
+    assert not backup_manager.restore_backup(backup)
+    assert count_rows(database_file) == 600
+    assert not list(database_file.parent.glob(f'.{database_file.name}.restore-*'))
+
+
+@pytest.mark.parametrize('format', ['gz', 'db'])
+def test_fast_verify_checks_the_recorded_checksum(backup_manager, format):
+    add_rows(backup_manager.app_paths.database_file, count=200)
+    backup = backup_manager.create_backup(format=format)
+    assert backup_manager.verify_backup(backup, deep=False)
+
+    data = bytearray(backup.read_bytes())
+    data[len(data) // 2] ^= 0xFF
+    backup.write_bytes(bytes(data))
+    assert backup_manager.verify_checksum(backup) is False
+    assert not backup_manager.verify_backup(backup, deep=False)
+
+
+def test_stepped_copy_reports_progress_and_survives_writers(app, backup_manager, tmp_path):
+    database_file = backup_manager.app_paths.database_file
+    add_rows(database_file, count=2000)
+    app.config.update(BACKUP_STEP_PAGES=8, BACKUP_STEP_SLEEP_MS=0, BACKUP_MAX_RESTARTS=1)
+    copy = tmp_path / 'copy.db'
+    events = []
+
+    def write_while_copying(event):
+        events.append(event)
+        if len(events) in (3, 6): # A write makes SQLite restart the copy
+            add_rows(database_file, count=1)
+
+    source, target = sqlite3.connect(str(database_file)), sqlite3.connect(str(copy))
+    try:
+        result = backup_manager._copy_database_incrementally(source, target, write_while_copying)
+    finally:
+        target.close()
+        source.close()
+    assert result['restarts'] == 2 and result['copy_mode'] == 'single_step_fallback'
+    assert events[-1]['fraction'] == 1.0
+    assert count_rows(copy) == count_rows(database_file)
+
+
+def _gzip_members(data: bytes) -> int:
+    members = 0
+    while data:
+        stream = zlib.decompressobj(wbits=31)
+        stream.decompress(data)
+        data = stream.unused_data
+        members += 1
+    return members
+
+
+def test_parallel_gzip_writes_members_that_restore_as_one_stream(app, backup_manager, tmp_path):
+    app.config.update(BACKUP_COMPRESSION_THREADS=4, BACKUP_COMPRESSION_BLOCK_SIZE=64 * 1024)
+    add_rows(backup_manager.app_paths.database_file, count=3000)
+    backup = backup_manager.create_backup(format='gz')
+    assert _gzip_members(backup.read_bytes()) > 4
+
+    restored = tmp_path / 'restored.db'
+    assert backup_manager.restore_backup(backup, target_path=restored)
+    assert count_rows(restored) == 3000
+
+
+@pytest.mark.parametrize('name', available_codecs())
+def test_every_codec_round_trips_a_block(name, tmp_path):
+    codec = get_codec(name)
+    block = os.urandom(4096) + bytes(4096)
+    path = tmp_path / f'block{codec.extension}'
+    path.write_bytes(codec.block_compressor(codec.resolve_level(None))(block) * 2)
+    # Readers take concatenated blocks as one stream, as block-parallel backups are written
+    with codec.open_reader(path) as reader:
+        assert reader.read() == block * 2
+
+
+def test_compression_tuner_samples_once_and_honours_the_target(tmp_path):
+    codec = get_codec('gzip')
+    data = os.urandom(256 * 1024) + bytes(256 * 1024)
+    read_sample = lambda offset, length: data[offset:offset + length]
+    tuner = CompressionTuner(tmp_path / 'history.json', sample_size=64 * 1024)
+    level, details = tuner.choose_level(codec, read_sample, len(data))
+    assert details['sampled'] and details['met_target']
+    # Without a target the best ratio wins
+    ratios = tuner.history()['gzip']['levels']
+    assert ratios[str(level)]['ratio'] == min(stats['ratio'] for stats in ratios.values())
+    assert tuner.choose_level(codec, read_sample, len(data)) == (level, {**details, 'sampled': False})
+
+    # An unreachable target falls back to the fastest level, from the stored history
+    hurried = CompressionTuner(tmp_path / 'history.json', target_mb_s=1e9)
+    level, details = hurried.choose_level(codec, read_sample, len(data))
+    assert not details['sampled'] and not details['met_target']
+    assert ratios[str(level)]['mb_s'] == max(stats['mb_s'] for stats in ratios.values())
+
+
+def test_auto_level_backup_records_its_choice(backup_manager, tmp_path):
+    add_rows(backup_manager.app_paths.database_file, count=1000)
+    backup = backup_manager.create_backup(format='gz', level='auto')
+    metadata = json.loads(backup.with_suffix(backup.suffix + '.meta').read_text())
+    assert metadata['compression_level'] in get_codec('gzip').auto_levels
+    assert 'estimated_mb_s' in metadata['compression_auto']
+
+    restored = tmp_path / 'restored.db'
+    assert backup_manager.restore_backup(backup, target_path=restored)
+    assert count_rows(restored) == 1000
+
+
+def test_chunker_boundaries_survive_an_insertion():
+    chunker = ContentDefinedChunker(avg_size=4096)
+    data = random.Random(7).randbytes(1 << 20)
+    chunks = list(chunker.chunks(io.BytesIO(data), read_size=8192))
+    assert b''.join(chunks) == data
+    assert all(len(chunk) <= chunker.max_size for chunk in chunks)
+    assert all(len(chunk) > chunker.min_size for chunk in chunks[:-1])
+
+    edited = data[:1000] + b'inserted' + data[1000:]
+    edited_chunks = list(chunker.chunks(io.BytesIO(edited)))
+    assert b''.join(edited_chunks) == edited
+    # Only the chunks around the edit change
+    assert len(set(chunks) - set(edited_chunks)) <= 2
+
+
+def test_dedup_backups_share_chunks_restore_and_collect_garbage(backup_manager, tmp_path):
+    database_file = backup_manager.app_paths.database_file
+    add_rows(database_file, count=5000)
+    first = backup_manager.create_backup(format='dedup')
+    add_rows(database_file, count=10)
+    second = backup_manager.create_backup(format='dedup')
+    assert first.suffix == second.suffix == '.manifest'
+    chunk_files = lambda: [path for path in backup_manager.chunk_store.root.rglob('*') if path.is_file()]
+    first_chunks = {chunk[0] for chunk in json.loads(first.read_text())['chunks']}
+    second_chunks = {chunk[0] for chunk in json.loads(second.read_text())['chunks']}
+    assert len(first_chunks & second_chunks) > len(second_chunks - first_chunks)
+    assert len(chunk_files()) == len(first_chunks | second_chunks)
+
+    restored = tmp_path / 'restored.db'
+    assert backup_manager.restore_backup(first, target_path=restored)
+    assert count_rows(restored) == 5000
+
+    backup_manager.chunk_store.gc_grace_seconds = 0
+    second.unlink()
+    result = backup_manager.collect_chunk_garbage()
+    assert result['removed'] == len(second_chunks - first_chunks)
+    assert backup_manager.restore_backup(first, target_path=restored)
+    assert count_rows(restored) == 5000
+
+    first.unlink()
+    backup_manager.collect_chunk_garbage()
+    assert not chunk_files()
+
+
+def test_differential_backup_restores_onto_its_base(backup_manager, tmp_path):
+    database_file = backup_manager.app_paths.database_file
+    add_rows(database_file, count=3000)
+    base = backup_manager.create_backup(format='gz')
+    add_rows(database_file, count=50)
+    differential = backup_manager.create_backup(format='gz', backup_type='differential')
+    assert differential is not None and differential != base
+    assert differential.stat().st_size < base.stat().st_size / 4
+
+    restored = tmp_path / 'restored.db'
+    assert backup_manager.restore_backup(differential, target_path=restored)
+    assert count_rows(restored) == 3050
+
+
+def test_wal_segments_are_written_outside_the_write_lock(backup_manager, tmp_path):
+    database_file = backup_manager.app_paths.database_file
+    add_rows(database_file, count=10)
+    archiver = WalArchiver(backup_manager)
+    archiver.archive_dir.mkdir(parents=True, exist_ok=True)
+    archiver.tick()
+    marked = time.time()
+    time.sleep(0.01)
+    add_rows(database_file, count=500)
+
+    write_segment = archiver._write_segment
+    writable = []
+
+    def checking_write_segment(frames):
+        if frames is not None:
+            conn = sqlite3.connect(str(database_file), timeout=0)
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                writable.append(True)
+                conn.rollback()
+            finally:
+                conn.close()
+        write_segment(frames)
+    archiver._write_segment = checking_write_segment
+    try:
+        archiver.tick()
+        add_rows(database_file, count=500)
+        archiver.tick()
+    finally:
+        archiver.stop()
+    assert writable == [True, True]
+
+    restored = tmp_path / 'restored.db'
+    result = restore_to_time(archiver.archive_dir, restored, marked)
+    assert result['segments'] == 0 and count_rows(restored) == 10
+    restore_to_time(archiver.archive_dir, restored, time.time())
+    assert count_rows(restored) == 1010
+
+
+def test_callers_never_coalesce_onto_a_run_whose_output_is_discarded(backup_manager):
+    add_rows(backup_manager.app_paths.database_file)
+    discarded = backup_manager.create_backup(format='gz', coalesce=False, discard_output=True)
+    coordinator = backup_manager.coordinator
+    state = json.loads(coordinator.state_path.read_text())
+    run_id = next(run_id for run_id, result in state['results'].items() if result['path'] == str(discarded))
+    # Another process sees that run still in flight when it arrives
+    state['inflight'] = {'id': run_id, 'key': state['results'][run_id]['key'], 'pid': 0, 'started': 0}
+    coordinator.state_path.write_text(json.dumps(state))
+
+    kept = backup_manager.create_backup(format='gz')
+    assert kept is not None and kept != discarded
+
+
+def test_chunk_garbage_collection_waits_for_running_backups(backup_manager):
+    add_rows(backup_manager.app_paths.database_file, count=500)
+    manifest = backup_manager.create_backup(format='dedup')
+    backup_manager.chunk_store.gc_grace_seconds = 0
+    manifest.unlink()
+    results = []
+    with backup_manager.coordinator.locked():
+        collector = threading.Thread(target=lambda: results.append(backup_manager.collect_chunk_garbage()))
+        collector.start()
+        collector.join(0.5)
+        assert collector.is_alive() and not results
+    collector.join(10)
+    assert results[0]['removed'] > 0
+
+
+def _count_scans(monkeypatch, directory):
+    """Count os.scandir calls on one directory"""
+    scans = []
+    scandir = os.scandir
+
+    def counting_scandir(path='.'):
+        if Path(path) == Path(directory):
+            scans.append(path)
+        return scandir(path)
+    monkeypatch.setattr(os, 'scandir', counting_scandir)
+    return scans
+
+
+def test_catalog_sync_skips_scan_of_unchanged_directory(backup_manager, monkeypatch):
+    add_rows(backup_manager.app_paths.database_file)
+    backup = backup_manager.create_backup(format='gz')
+    catalog = backup_manager.catalog
+    catalog.sync()
+    catalog.list()
+    catalog.sync()
+    scans = _count_scans(monkeypatch, backup_manager.app_paths.backup_dir)
+
+    assert catalog.sync() == {'updated': 0, 'removed': 0}
+    assert catalog.get(backup.name)['name'] == backup.name
+    assert catalog.sync() == {'updated': 0, 'removed': 0}
+    assert not scans
+
+    backup.with_name('backup_manual_copy.db.gz').write_bytes(backup.read_bytes())
+    assert catalog.sync()['updated'] == 1
+    assert len(scans) == 1
+
+
+def test_backup_stats_do_not_scan_an_unchanged_backup_dir(backup_manager, monkeypatch):
+    add_rows(backup_manager.app_paths.database_file)
+    backup = backup_manager.create_backup(format='gz')
+    backup_manager.get_backup_stats()
+    scans = _count_scans(monkeypatch, backup_manager.app_paths.backup_dir)
+
+    for _ in range(3):
+        stats = backup_manager.get_backup_stats()
+        assert stats['total_backups'] == 1
+        assert stats['total_size'] == backup.stat().st_size
+    assert not scans
+
+
+def _aged_backups(backup_manager, count):
+    """Create count gz backups dated a day apart, oldest first"""
+    backups = []
+    for age in range(count, 0, -1):
+        add_rows(backup_manager.app_paths.database_file, count=10)
+        backup = backup_manager.create_backup(format='gz')
+        when = time.time() - age * 86400
+        os.utime(backup, (when, when))
+        backups.append(backup)
+    backup_manager.catalog.sync(force=True)
+    return backups
+
+
+def test_retention_keeps_the_policy_and_deletes_the_rest(app, backup_manager):
+    app.config.update(BACKUP_RETENTION_KEEP_LAST=1, BACKUP_RETENTION_HOURLY=0, BACKUP_RETENTION_DAILY=2,
+                      BACKUP_RETENTION_WEEKLY=0, BACKUP_RETENTION_MONTHLY=0)
+    backups = _aged_backups(backup_manager, 4)
+
+    plan = backup_manager.plan_retention(RetentionPolicy.from_config(app.config))
+    assert sorted(plan['keep']) == sorted(path.name for path in backups[-2:])
+    assert [backup['name'] for backup in plan['delete']] == [path.name for path in backups[:2]]
+    assert backup_manager.cleanup_old_backups(dry_run=True) == 2
+    assert all(path.exists() for path in backups)
+
+    assert backup_manager.cleanup_old_backups(wait=True) == 2
+    for path in backups[:2]:
+        assert not path.exists()
+        assert not path.with_suffix(path.suffix + '.meta').exists()
+        assert backup_manager.catalog.get(path.name) is None
+    assert all(path.exists() for path in backups[2:])
+    assert [backup['name'] for backup in backup_manager.list_backups()] == [path.name for path in reversed(backups[2:])]
+
+
+def test_retention_leaves_files_alone_when_their_rows_cannot_be_removed(app, backup_manager, monkeypatch):
+    app.config.update(BACKUP_RETENTION_KEEP_LAST=1, BACKUP_RETENTION_HOURLY=0, BACKUP_RETENTION_DAILY=0,
+                      BACKUP_RETENTION_WEEKLY=0, BACKUP_RETENTION_MONTHLY=0)
+    backups = _aged_backups(backup_manager, 3)
+
+    def failing_remove_rows(names):
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(backup_manager.retention, '_remove_rows', failing_remove_rows)
+    assert backup_manager.cleanup_old_backups(wait=True) == 0
+    assert all(path.exists() for path in backups)
+    assert len(backup_manager.list_backups()) == 3
+
+
+@pytest.mark.parametrize('in_memory', [True, False])
+def test_verify_file_detects_corruption(backup_manager, monkeypatch, tmp_path, in_memory):
+    if not in_memory:
+        # As on Python < 3.11, where sqlite3 has no deserialize
+        monkeypatch.setattr(backup_verify, '_CAN_DESERIALIZE', False)
+    elif not backup_verify._CAN_DESERIALIZE:
+        pytest.skip('sqlite3 deserialize needs Python 3.11+')
+    add_rows(backup_manager.app_paths.database_file)
+    backup = backup_manager.create_backup(format='gz')
+    chunk_root, temp_dir = str(backup_manager.chunk_store.root), str(tmp_path)
+
+    result = backup_verify.verify_file(str(backup), chunk_root, temp_dir)
+    assert result['status'] == 'ok', result['error']
+    assert result['checksum_ok'] and result['quick_check'] == 'ok'
+    assert result['in_memory'] is in_memory
+
+    data = bytearray(backup.read_bytes())
+    data[len(data) // 2] ^= 0xFF
+    backup.write_bytes(bytes(data))
+    result = backup_verify.verify_file(str(backup), chunk_root, temp_dir)
+    assert result['status'] == 'failed'
+    assert not list(tmp_path.glob('verify_*'))
+
+
+def test_verify_all_records_results_and_finds_corruption(backup_manager):
+    database_file = backup_manager.app_paths.database_file
+    add_rows(database_file, count=3000)
+    full = backup_manager.create_backup(format='gz')
+    add_rows(database_file, count=50)
+    differential = backup_manager.create_backup(format='gz', backup_type='differential')
+    dedup = backup_manager.create_backup(format='dedup')
+    corrupt = backup_manager.create_backup(format='db')
+    data = bytearray(corrupt.read_bytes())
+    data[len(data) // 2:len(data) // 2 + 64] = bytes(64)
+    corrupt.write_bytes(bytes(data))
+
+    verifier = backup_manager.verifier
+    verifier.concurrency = 2
+    results = {result['name']: result for result in verifier.verify_all()}
+    assert {name: result['status'] for name, result in results.items()} == {
+        full.name: 'ok', differential.name: 'ok', dedup.name: 'ok', corrupt.name: 'failed'}
+    assert results[corrupt.name]['error'] == 'Checksum mismatch'
+    assert verifier.progress['ok'] == 3 and verifier.progress['failed'] == 1
+    for path in (full, differential, dedup):
+        assert 'verified_at' in json.loads(path.with_suffix(path.suffix + '.meta').read_text())
+    assert 'verified_at' not in json.loads(corrupt.with_suffix(corrupt.suffix + '.meta').read_text())
@@ -0,0 +1,83 @@
+"""Encrypted backups: gpg and aes-gcm envelope streams, and chunked containers"""
+
+import json
+
+import pytest
+
+from backup_container import ContainerReader
+from tests.conftest import add_rows, count_rows, wait_for_job
+
+
+def _assert_restores(backup_manager, backup, tmp_path, rows):
+    restored = tmp_path / 'restored.db'
+    assert backup_manager.restore_backup(backup, target_path=restored)
+    assert count_rows(restored) == rows
+
+
+def test_gpg_backup_streams_and_restores(backup_manager, gpg_recipient, tmp_path):
+    add_rows(backup_manager.app_paths.database_file)
+    backup = backup_manager.create_backup(format='gz', encrypt_to=gpg_recipient, encryption_engine='gpg')
+    assert backup is not None and backup.name.endswith('.db.gz.gpg')
+    assert b'SQLite format 3' not in backup.read_bytes()
+    # Only the ciphertext is written
+    assert [path.name for path in backup.parent.glob('backup_*.db*') if not path.name.endswith('.meta')] == [backup.name]
+    metadata = json.loads(backup.with_suffix(backup.suffix + '.meta').read_text())
+    assert metadata['encrypted'] and metadata['encryption_engine'] == 'gpg'
+    assert backup_manager.verify_backup(backup, deep=False)
+    _assert_restores(backup_manager, backup, tmp_path, 2000)
+
+
+def test_gpg_job_encrypted_after_the_snapshot_restores(app, backup_manager, gpg_recipient, tmp_path):
+    add_rows(backup_manager.app_paths.database_file)
+    app.config['BACKUP_GPG_PIPELINE_ENABLED'] = False
+    with app.app_context():
+        job = wait_for_job(app, app.extensions['backup_jobs'].submit(
+            format='gz', encrypt_gpg=True, gpg_email=gpg_recipient, encryption_engine='gpg').id)
+    assert job['completed'], job['error']
+    backup = backup_manager.app_paths.backup_dir / job['filename']
+    assert backup.name.endswith('.db.gz.gpg')
+    assert not list(backup.parent.glob('backup_*.db.gz'))
+    _assert_restores(backup_manager, backup, tmp_path, 2000)
+
+
+def test_envelope_backup_round_trip(backup_manager, tmp_path):
+    add_rows(backup_manager.app_paths.database_file)
+    backup_manager.envelope.generate_keypair('ops@example.com')
+    backup = backup_manager.create_backup(format='xz', encrypt_to='ops@example.com', encryption_engine='aes-gcm')
+    assert backup is not None and backup.name.endswith('.db.xz.enc')
+    assert b'SQLite format 3' not in backup.read_bytes()
+    _assert_restores(backup_manager, backup, tmp_path, 2000)
+
+    data = bytearray(backup.read_bytes())
+    data[-100] ^= 0xFF
+    backup.write_bytes(bytes(data))
+    assert not backup_manager.restore_backup(backup, target_path=tmp_path / 'tampered.db')
+
+
+def test_envelope_backup_needs_the_recipient_key(backup_manager):
+    add_rows(backup_manager.app_paths.database_file)
+    assert backup_manager.create_backup(format='gz', encrypt_to='nobody@example.com',
+                                        encryption_engine='aes-gcm') is None
+    assert not list(backup_manager.app_paths.backup_dir.glob('backup_*'))
+
+
+@pytest.mark.parametrize('encrypted', [False, True])
+def test_container_backup_round_trip(backup_manager, tmp_path, encrypted):
+    add_rows(backup_manager.app_paths.database_file, count=5000)
+    options = {}
+    if encrypted:
+        backup_manager.envelope.generate_keypair('ops@example.com')
+        options = {'encrypt_to': 'ops@example.com'}
+    backup = backup_manager.create_backup(format='chunked', **options)
+    assert backup is not None and backup.suffix == '.bkc'
+    assert backup_manager.verify_container(backup)
+
+    _assert_restores(backup_manager, backup, tmp_path, 5000)
+
+    restored = (tmp_path / 'restored.db').read_bytes()
+    with ContainerReader(backup, envelope=backup_manager.envelope if encrypted else None) as container:
+        assert container.encrypted is encrypted
+        page_size = container.page_size
+        middle = len(restored) // page_size // 2
+        # Pages are read from the chunks that hold them, without extracting the rest
+        assert container.read_pages(middle, 2) == restored[(middle - 1) * page_size:(middle + 1) * page_size]
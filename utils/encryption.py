@@ -0,0 +1,528 @@
+"""
+Envelope encryption for backups: the 'aes-gcm' engine, used instead of gpg.
+
+Every file gets a random 256-bit data key. The key is wrapped once per
+recipient with that recipient's public key, X25519 (ECDH + HKDF + AES key
+wrap) or RSA-OAEP, and the stream is sealed with AES-256-GCM in chunks of
+chunk_size plaintext bytes. Each chunk is authenticated on its own, so
+chunks are sealed and opened on a thread pool, in order and with at most
+two per worker in flight.
+
+File layout (.enc):
+    magic      b'BKENVL1\\n'
+    u32        length of the header, then the header JSON (cipher, chunk size,
+               nonce prefix, one wrapped data key per recipient)
+    chunks     u32 length + ciphertext and tag, repeated
+
+Chunk nonces are the file's 7-byte random prefix, the chunk index (u32)
+and a final-chunk flag; the header bytes are the associated data of every
+chunk. Reordered, dropped or truncated chunks, or an edited header, fail
+authentication.
+
+Keys live in key_dir as <recipient>.pub.pem and <recipient>.key.pem
+(generate_keypair makes an X25519 pair). Only the holder of a private key
+can restore, so the private keys are best kept off the backup host.
+"""
+
+import base64
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Tuple, Union, Sequence
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.keywrap import aes_key_wrap, aes_key_unwrap
+
+ENGINE_NAME = 'aes-gcm'
+ENVELOPE_SUFFIX = '.enc'
+MAGIC = b'BKENVL1\n'
+CIPHER = 'AES-256-GCM'
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+PUBLIC_KEY_SUFFIX = '.pub.pem'
+PRIVATE_KEY_SUFFIX = '.key.pem'
+
+_LENGTH = struct.Struct('>I')
+_WRAP_INFO = b'backup-envelope-v1'
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii')
+
+
+def _public_bytes(public_key) -> bytes:
+    return public_key.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+def key_id(public_key) -> str:
+    """Short fingerprint of a public key, stored next to each wrapped data key"""
+    return hashlib.sha256(_public_bytes(public_key)).hexdigest()[:16]
+
+
+def _x25519_kek(shared: bytes, ephemeral: bytes, recipient: bytes) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                info=_WRAP_INFO + ephemeral + recipient).derive(shared)
+
+
+def _rsa_padding():
+    return padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+
+
+def wrap_data_key(data_key: bytes, recipient: str, public_key) -> Dict[str, Any]:
+    """Header entry holding data_key encrypted for one recipient"""
+    entry = {'recipient': recipient, 'key_id': key_id(public_key)}
+    if isinstance(public_key, X25519PublicKey):
+        ephemeral = X25519PrivateKey.generate()
+        ephemeral_bytes = ephemeral.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        recipient_bytes = public_key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        kek = _x25519_kek(ephemeral.exchange(public_key), ephemeral_bytes, recipient_bytes)
+        entry.update(type='x25519', ephemeral=_b64(ephemeral_bytes), wrapped_key=_b64(aes_key_wrap(kek, data_key)))
+    elif isinstance(public_key, rsa.RSAPublicKey):
+        entry.update(type='rsa', wrapped_key=_b64(public_key.encrypt(data_key, _rsa_padding())))
+    else:
+        raise ValueError(f"Unsupported key type for {recipient}: {type(public_key).__name__} (use X25519 or RSA)")
+    return entry
+
+
+def unwrap_data_key(entry: Dict[str, Any], private_key) -> bytes:
+    """Recover the data key from a header entry with the matching private key"""
+    wrapped = base64.b64decode(entry['wrapped_key'])
+    if entry['type'] == 'x25519':
+        ephemeral_bytes = base64.b64decode(entry['ephemeral'])
+        recipient_bytes = private_key.public_key().public_bytes(serialization.Encoding.Raw,
+                                                                serialization.PublicFormat.Raw)
+        shared = private_key.exchange(X25519PublicKey.from_public_bytes(ephemeral_bytes))
+        return aes_key_unwrap(_x25519_kek(shared, ephemeral_bytes, recipient_bytes), wrapped)
+    if entry['type'] == 'rsa':
+        return private_key.decrypt(wrapped, _rsa_padding())
+    raise ValueError(f"Unsupported wrapped key type: {entry['type']}")
+
+
+def _nonce(prefix: bytes, index: int, final: bool) -> bytes:
+    return prefix + index.to_bytes(4, 'big') + (b'\x01' if final else b'\x00')
+
+
+def seal_chunk(cipher: AESGCM, prefix: bytes, aad: bytes, index: int, final: bool, chunk: bytes) -> bytes:
+    """Encrypt chunk 'index' of a stream; 'final' marks the last one"""
+    return cipher.encrypt(_nonce(prefix, index, final), chunk, aad)
+
+
+def open_chunk(cipher: AESGCM, prefix: bytes, aad: bytes, index: int, final: bool, sealed: bytes) -> bytes:
+    """Decrypt and authenticate chunk 'index'; raises ValueError if it was altered or is out of place"""
+    try:
+        return cipher.decrypt(_nonce(prefix, index, final), sealed, aad)
+    except InvalidTag:
+        raise ValueError(f"Chunk {index} failed authentication (corrupt or truncated file, or wrong key)") from None
+
+
+def _read_exact(source, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        piece = source.read(size - len(data))
+        if not piece:
+            raise ValueError(f"Encrypted file is truncated ({len(data)} of {size} bytes)")
+        data += piece
+    return bytes(data)
+
+
+def read_header(source) -> Tuple[Dict[str, Any], bytes]:
+    """Parse the header of an envelope file; returns it and its raw bytes (the chunks' associated data)"""
+    magic = source.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError("Not an envelope-encrypted backup")
+    length_bytes = _read_exact(source, _LENGTH.size)
+    header_bytes = _read_exact(source, _LENGTH.unpack(length_bytes)[0])
+    header = json.loads(header_bytes)
+    if header.get('cipher') != CIPHER or not 0 < int(header.get('chunk_size', 0)) <= MAX_CHUNK_SIZE:
+        raise ValueError(f"Unsupported envelope header: cipher {header.get('cipher')}, "
+                         f"chunk size {header.get('chunk_size')}")
+    return header, magic + length_bytes + header_bytes
+
+
+class _ChunkPool:
+    """Runs chunk jobs on threads in submission order, at most two per worker in flight (inline for one worker)"""
+
+    def __init__(self, workers: int, name: str):
+        self.workers = max(1, workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=name) if self.workers > 1 else None
+        self._pending = collections.deque()
+
+    def submit(self, fn, *args):
+        if self._executor is None:
+            self._pending.append(fn(*args))
+        else:
+            self._pending.append(self._executor.submit(fn, *args))
+
+    def full(self) -> bool:
+        return len(self._pending) >= self.workers * 2
+
+    def __len__(self):
+        return len(self._pending)
+
+    def pop(self) -> bytes:
+        result = self._pending.popleft()
+        return result if self._executor is None else result.result()
+
+    def shutdown(self):
+        if self._executor is not None:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+        self._pending.clear()
+
+
+class EnvelopeEncryptStream:
+    """
+    Binary writer sealing everything written to it into an envelope file on 'output' (left open).
+
+    Full chunks are sealed as soon as more data follows them; the last one
+    is sealed with the final flag by close(). Leaving a with-block on an
+    exception abandons the output.
+    """
+
+    def __init__(self, output, data_key: bytes, header_bytes: bytes, nonce_prefix: bytes,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int = 1):
+        self.output = output
+        self.chunk_size = chunk_size
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.chunks = 0
+        self.started = time.monotonic()
+        self._cipher = AESGCM(data_key)
+        self._aad = header_bytes
+        self._prefix = nonce_prefix
+        self._pool = _ChunkPool(workers, 'envelope-seal')
+        self._buffer = bytearray()
+        self._closed = False
+        self._write_out(header_bytes)
+
+    def write(self, data) -> int:
+        if self._closed:
+            raise ValueError("write to closed EnvelopeEncryptStream")
+        self._buffer += data
+        self.bytes_in += len(data)
+        # Hold the last full chunk back until more data shows it is not the final one
+        while len(self._buffer) > self.chunk_size:
+            chunk = bytes(self._buffer[:self.chunk_size])
+            del self._buffer[:self.chunk_size]
+            self._submit(chunk, final=False)
+        return len(data)
+
+    def _submit(self, chunk: bytes, final: bool):
+        if self.chunks >= 2 ** 32:
+            raise ValueError("Too many chunks for one envelope file")
+        self._pool.submit(seal_chunk, self._cipher, self._prefix, self._aad, self.chunks, final, chunk)
+        self.chunks += 1
+        while self._pool.full():
+            self._write_chunk(self._pool.pop())
+
+    def _write_chunk(self, sealed: bytes):
+        self._write_out(_LENGTH.pack(len(sealed)))
+        self._write_out(sealed)
+
+    def _write_out(self, data: bytes):
+        self.output.write(data)
+        self.bytes_out += len(data)
+
+    def flush(self):
+        pass # Chunks are written once sealed; a partial chunk cannot be flushed early
+
+    def tell(self) -> int:
+        return self.bytes_in
+
+    def writable(self) -> bool:
+        return True
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def close(self):
+        """Seal the final chunk and write everything still in flight (idempotent)"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._submit(bytes(self._buffer), final=True)
+            self._buffer.clear()
+            while len(self._pool):
+                self._write_chunk(self._pool.pop())
+        finally:
+            self._pool.shutdown()
+
+    def abort(self):
+        """Stop without writing the final chunk (the output is left incomplete)"""
+        self._closed = True
+        self._pool.shutdown()
+
+    def stats(self) -> Dict[str, Any]:
+        duration = time.monotonic() - self.started
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'chunks': self.chunks,
+            'workers': self._pool.workers,
+            'duration_seconds': round(duration, 3),
+            'throughput_mb_s': round(self.bytes_in / (1024 * 1024) / duration, 1) if duration > 0 else None
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class EnvelopeDecryptReader:
+    """
+    Binary reader returning the plaintext of an envelope file positioned after its header.
+
+    Chunks are read ahead and opened on the pool; a chunk is only opened
+    once the next record (or the end of the file) shows whether it is the
+    final one, so truncation at a chunk boundary is caught too.
+    """
+
+    def __init__(self, source, data_key: bytes, header: Dict[str, Any], header_bytes: bytes, workers: int = 1):
+        self.source = source
+        self.chunk_size = int(header['chunk_size'])
+        self._cipher = AESGCM(data_key)
+        self._aad = header_bytes
+        self._prefix = bytes.fromhex(header['nonce_prefix'])
+        self._pool = _ChunkPool(workers, 'envelope-open')
+        self._held: Optional[Tuple[int, bytes]] = None
+        self._index = 0
+        self._eof = False
+        self._current = b''
+        self._position = 0
+
+    def _read_record(self):
+        length_bytes = self.source.read(_LENGTH.size)
+        if not length_bytes:
+            self._eof = True
+            if self._held is None:
+                raise ValueError("Encrypted file has no chunks")
+            self._open(*self._held, final=True)
+            self._held = None
+            return
+        if len(length_bytes) < _LENGTH.size:
+            length_bytes += _read_exact(self.source, _LENGTH.size - len(length_bytes))
+        length = _LENGTH.unpack(length_bytes)[0]
+        if length < TAG_SIZE or length > self.chunk_size + TAG_SIZE:
+            raise ValueError(f"Chunk {self._index} has an invalid length ({length})")
+        sealed = _read_exact(self.source, length)
+        if self._held is not None:
+            self._open(*self._held, final=False)
+        self._held = (self._index, sealed)
+        self._index += 1
+
+    def _open(self, index: int, sealed: bytes, final: bool):
+        self._pool.submit(open_chunk, self._cipher, self._prefix, self._aad, index, final, sealed)
+
+    def _next_chunk(self) -> Optional[bytes]:
+        while not self._eof and not self._pool.full():
+            self._read_record()
+        return self._pool.pop() if len(self._pool) else None
+
+    def read(self, n: int = -1) -> bytes:
+        parts = []
+        wanted = n if n is not None and n >= 0 else None
+        while wanted is None or wanted > 0:
+            if self._position >= len(self._current):
+                chunk = self._next_chunk()
+                if chunk is None:
+                    break
+                self._current, self._position = chunk, 0
+                continue
+            end = len(self._current) if wanted is None else min(len(self._current), self._position + wanted)
+            parts.append(self._current[self._position:end])
+            if wanted is not None:
+                wanted -= end - self._position
+            self._position = end
+        return b''.join(parts)
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class EnvelopeEncryption:
+    """
+    The 'aes-gcm' backup encryption engine: recipient keys in key_dir plus
+    streaming encryption and decryption of envelope files.
+    """
+
+    def __init__(self, key_dir: Union[str, Path], passphrase: Optional[str] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int = 0, logger=None):
+        """
+        Args:
+            key_dir: Directory of <recipient>.pub.pem / <recipient>.key.pem files
+            passphrase: Passphrase of the private keys, if they are encrypted
+            chunk_size: Plaintext bytes per authenticated chunk
+            workers: Threads sealing/opening chunks (0 = one per CPU)
+            logger: Logger; defaults to this module's
+        """
+        self.key_dir = Path(key_dir)
+        self.passphrase = passphrase
+        self.chunk_size = max(64 * 1024, min(int(chunk_size), MAX_CHUNK_SIZE))
+        self.workers = int(workers) or os.cpu_count() or 1
+        self.logger = logger or logging.getLogger(__name__)
+
+    @staticmethod
+    def _key_file_stem(recipient: str) -> str:
+        if not re.fullmatch(r'[\w.@+-]+', recipient or ''):
+            raise ValueError(f"Invalid recipient name: {recipient!r}")
+        return recipient
+
+    def public_key_path(self, recipient: str) -> Path:
+        return self.key_dir / (self._key_file_stem(recipient) + PUBLIC_KEY_SUFFIX)
+
+    def private_key_path(self, recipient: str) -> Path:
+        return self.key_dir / (self._key_file_stem(recipient) + PRIVATE_KEY_SUFFIX)
+
+    def has_public_key(self, recipient: str) -> bool:
+        try:
+            return self.public_key_path(recipient).is_file()
+        except ValueError:
+            return False
+
+    def load_public_key(self, recipient: str):
+        path = self.public_key_path(recipient)
+        if not path.is_file():
+            raise ValueError(f"No public key found for {recipient} (expected {path})")
+        return serialization.load_pem_public_key(path.read_bytes())
+
+    def generate_keypair(self, recipient: str, passphrase: Optional[str] = None) -> Dict[str, Path]:
+        """Create an X25519 key pair for 'recipient'; the private key is encrypted with 'passphrase' if given"""
+        public_path, private_path = self.public_key_path(recipient), self.private_key_path(recipient)
+        if public_path.exists() or private_path.exists():
+            raise ValueError(f"Keys for {recipient} already exist in {self.key_dir}")
+        self.key_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        private_key = X25519PrivateKey.generate()
+        encryption = (serialization.BestAvailableEncryption(passphrase.encode('utf-8')) if passphrase
+                      else serialization.NoEncryption())
+        private_pem = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, encryption)
+        fd = os.open(private_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(private_pem)
+        public_path.write_bytes(private_key.public_key().public_bytes(serialization.Encoding.PEM,
+                                                                     serialization.PublicFormat.SubjectPublicKeyInfo))
+        self.logger.info(f"Generated envelope key pair for {recipient} in {self.key_dir}")
+        return {'public_key': public_path, 'private_key': private_path}
+
+    def _private_keys(self) -> Dict[str, Any]:
+        """Private keys in key_dir by key id; keys that cannot be loaded are skipped with a warning"""
+        keys = {}
+        if not self.key_dir.is_dir():
+            return keys
+        password = self.passphrase.encode('utf-8') if self.passphrase else None
+        for path in sorted(self.key_dir.glob('*' + PRIVATE_KEY_SUFFIX)):
+            pem = path.read_bytes()
+            try:
+                try:
+                    private_key = serialization.load_pem_private_key(pem, password=password)
+                except TypeError:
+                    if password is None:
+                        raise
+                    # The passphrase is for the encrypted keys; this one is stored in the clear
+                    private_key = serialization.load_pem_private_key(pem, password=None)
+            except (ValueError, TypeError) as e:
+                self.logger.warning(f"Cannot load private key {path.name}: {str(e)}")
+                continue
+            keys[key_id(private_key.public_key())] = private_key
+        return keys
+
+    def new_data_key(self, recipients: Sequence[str]) -> Tuple[bytes, Dict[str, Any]]:
+        """
+        A random data key and the header fields describing it: cipher, a
+        random nonce prefix and the key wrapped for every recipient. Also
+        used by backup_container for encrypted chunked containers.
+        """
+        if not recipients:
+            raise ValueError("No recipient specified for encryption.")
+        data_key = AESGCM.generate_key(bit_length=256)
+        envelope = {
+            'cipher': CIPHER,
+            'nonce_prefix': os.urandom(NONCE_PREFIX_SIZE).hex(),
+            'recipients': [wrap_data_key(data_key, recipient, self.load_public_key(recipient))
+                           for recipient in recipients]
+        }
+        return data_key, envelope
+
+    def unwrap_data_key(self, envelope: Dict[str, Any], name: str = 'file') -> bytes:
+        """The data key of an envelope (see new_data_key), unwrapped with a matching private key from key_dir"""
+        private_keys = self._private_keys()
+        for entry in envelope.get('recipients', []):
+            private_key = private_keys.get(entry.get('key_id'))
+            if private_key is not None:
+                return unwrap_data_key(entry, private_key)
+        recipients = ', '.join(entry.get('recipient', '?') for entry in envelope.get('recipients', []))
+        raise ValueError(f"No private key in {self.key_dir} for {name} (recipients: {recipients})")
+
+    def open_encrypt_stream(self, output, recipients: Sequence[str]) -> EnvelopeEncryptStream:
+        """Start an envelope file on 'output' (a binary file object) for every recipient; see EnvelopeEncryptStream"""
+        data_key, envelope = self.new_data_key(recipients)
+        nonce_prefix = bytes.fromhex(envelope['nonce_prefix'])
+        header = {'version': 1, 'chunk_size': self.chunk_size, **envelope}
+        header_json = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        header_bytes = MAGIC + _LENGTH.pack(len(header_json)) + header_json
+        return EnvelopeEncryptStream(output, data_key, header_bytes, nonce_prefix, self.chunk_size, self.workers)
+
+    @contextmanager
+    def open_decrypt_stream(self, input_path: Union[str, Path]):
+        """
+        Yield a reader of the plaintext of an envelope file, unwrapped with a
+        matching private key from key_dir. Chunks are authenticated as they
+        are read; a damaged or truncated file raises ValueError.
+        """
+        input_path = Path(input_path)
+        with input_path.open('rb') as source:
+            header, header_bytes = read_header(source)
+            data_key = self.unwrap_data_key(header, input_path.name)
+            with EnvelopeDecryptReader(source, data_key, header, header_bytes, self.workers) as reader:
+                yield reader
+
+    def encrypt_file(self, input_path: Union[str, Path], recipients: Sequence[str],
+                     output_path: Optional[Union[str, Path]] = None) -> Path:
+        """Encrypt a finished file into <name>.enc (or output_path); a failed run leaves no output"""
+        input_path = Path(input_path)
+        output_path = Path(output_path) if output_path else input_path.with_name(input_path.name + ENVELOPE_SUFFIX)
+        temp_path = output_path.with_name(output_path.name + '.tmp')
+        try:
+            with temp_path.open('wb') as raw, input_path.open('rb') as f_in:
+                with self.open_encrypt_stream(raw, recipients) as sealed:
+                    for block in iter(lambda: f_in.read(self.chunk_size), b''):
+                        sealed.write(block)
+                self.logger.info(f"Encrypted {input_path.name} for {', '.join(recipients)}: {sealed.stats()}")
+            os.replace(temp_path, output_path)
+            return output_path
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
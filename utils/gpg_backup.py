@@ -4,10 +4,91 @@ import gnupg
 import logging
 from pathlib import Path
 import os
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Callable, Any
+
+
+class _ProgressReader:
+    """Wrap a binary file and report how many bytes have been handed to gpg"""
+
+    REPORT_EVERY = 1024 * 1024
+
+    def __init__(self, fileobj, total: int, callback: Callable[[Dict[str, Any]], None]):
+        self.fileobj = fileobj
+        self.total = total
+        self.callback = callback
+        self.bytes_read = 0
+        self._last_report = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        if not data or self.bytes_read - self._last_report >= self.REPORT_EVERY:
+            self._last_report = self.bytes_read
+            try:
+                self.callback({
+                    'stage': 'encrypt',
+                    'bytes_encrypted': self.bytes_read,
+                    'bytes_total': self.total,
+                    'fraction': round(self.bytes_read / self.total, 4) if self.total else 1.0
+                })
+            except Exception:
+                pass # Progress reporting must never break encryption
+        return data
+
 
 class GPGBackup:
     # ---------------- NEW helpers ----------------
+    def ensure_encryption_key(self, recipient_email: str) -> bool:
+        """
+        Make sure a usable public key for recipient_email is in the keyring,
+        importing it from the keyserver if needed. Returns True when ready.
+        """
+        # === IMPROVED: Use unified key resolution ===
+        key_status = self.get_key_with_status(recipient_email)
+        
+        if key_status['status'] == 'ready':
+            # Key exists locally, validate it for encryption
+            key_valid, error_msg = self.validate_key_for_encryption(recipient_email)
+            if not key_valid:
+                self.logger.error(f"Local key validation failed for {recipient_email}: {error_msg}")
+                return False
+            self.logger.info(f"Using local key for encryption: {recipient_email}")
+            
+        elif key_status['status'] == 'found':
+            # Key found on keyserver, need to import it
+            keys_to_import = key_status['keys']
+            if not keys_to_import:
+                self.logger.error(f"No keys to import for {recipient_email}")
+                return False
+                
+            # Import the first available key
+            identifiers = []
+            for key in keys_to_import:
+                if 'fingerprint' in key and key['fingerprint']:
+                    identifiers.append(key['fingerprint'])
+                elif 'key_id' in key and key['key_id']:
+                    identifiers.append(key['key_id'])
+                    
+            if not identifiers:
+                self.logger.error(f"No valid identifiers found for keys: {keys_to_import}")
+                return False
+                
+            self.logger.info(f"Importing key for {recipient_email}: {identifiers[0]}")
+            import_result = self.gpg.recv_keys(self.gpg_keyserver, identifiers[0])
+            
+            if not import_result.results:
+                self.logger.error(f"Failed to import key for {recipient_email}: {getattr(import_result, 'stderr', 'No error details')}")
+                return False
+                
+            self.logger.info(f"Key imported successfully for {recipient_email}")
+            
+        else:
+            # Key not found anywhere
+            self.logger.error(f"No key found for {recipient_email}: {key_status['message']}")
+            return False
+
+        return True
+
     def get_key_info_json(self, email: str) -> Dict:
         """Return key info in a JSON‑friendly structure."""
         info = self.get_key_info(email)
@@ -346,10 +427,14 @@ class GPGBackup:
             self.logger.error(f"Error searching GPG keys: {e}")
             return []
 
-    def create_encrypted_backup(self, input_filepath: Path, recipient_email: str) -> Optional[Path]:
+    def create_encrypted_backup(self, input_filepath: Path, recipient_email: str,
+                                progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+                                output_filepath: Optional[Path] = None) -> Optional[Path]:
         """
         Encrypts the given file using the recipient's public GPG key.
         Returns the path to the encrypted file or None on failure.
+        If progress_callback is given it receives 'encrypt' progress events.
+        output_filepath defaults to the input name plus .gpg in backup_dir.
         
         UPDATED: Uses local-first approach via get_key_with_status()
         """
@@ -361,59 +446,22 @@ class GPGBackup:
             self.logger.error("GPG recipient email not provided for encryption.")
             return None
 
-        # === IMPROVED: Use unified key resolution ===
-        key_status = self.get_key_with_status(recipient_email)
-        
-        if key_status['status'] == 'ready':
-            # Key exists locally, validate it for encryption
-            key_valid, error_msg = self.validate_key_for_encryption(recipient_email)
-            if not key_valid:
-                self.logger.error(f"Local key validation failed for {recipient_email}: {error_msg}")
-                return None
-            self.logger.info(f"Using local key for encryption: {recipient_email}")
-            
-        elif key_status['status'] == 'found':
-            # Key found on keyserver, need to import it
-            keys_to_import = key_status['keys']
-            if not keys_to_import:
-                self.logger.error(f"No keys to import for {recipient_email}")
-                return None
-                
-            # Import the first available key
-            identifiers = []
-            for key in keys_to_import:
-                if 'fingerprint' in key and key['fingerprint']:
-                    identifiers.append(key['fingerprint'])
-                elif 'key_id' in key and key['key_id']:
-                    identifiers.append(key['key_id'])
-                    
-            if not identifiers:
-                self.logger.error(f"No valid identifiers found for keys: {keys_to_import}")
-                return None
-                
-            self.logger.info(f"Importing key for {recipient_email}: {identifiers[0]}")
-            import_result = self.gpg.recv_keys(self.gpg_keyserver, identifiers[0])
-            
-            if not import_result.results:
-                self.logger.error(f"Failed to import key for {recipient_email}: {getattr(import_result, 'stderr', 'No error details')}")
-                return None
-                
-            self.logger.info(f"Key imported successfully for {recipient_email}")
-            
-        else:
-            # Key not found anywhere
-            self.logger.error(f"No key found for {recipient_email}: {key_status['message']}")
+        if not self.ensure_encryption_key(recipient_email):
             return None
 
         # === FIX 3: Access backup_dir and get_gpg_backup_filename correctly ===
-        output_filepath = self.backup_dir / self.app_paths.get_gpg_backup_filename(input_filepath.name)
+        if output_filepath is None:
+            output_filepath = self.backup_dir / self.app_paths.get_gpg_backup_filename(input_filepath.name)
 
         self.logger.info(f"Encrypting {input_filepath} for {recipient_email} to {output_filepath}")
 
         try:
             with open(input_filepath, 'rb') as f:
+                source = f
+                if progress_callback:
+                    source = _ProgressReader(f, input_filepath.stat().st_size, progress_callback)
                 # Use recipient_email directly with gnupg.GPG as it can resolve to key by email
-                status = self.gpg.encrypt_file(f, recipients=[recipient_email], output=str(output_filepath), always_trust=True)
+                status = self.gpg.encrypt_file(source, recipients=[recipient_email], output=str(output_filepath), always_trust=True)
 
             if status.ok:
                 self.logger.info(f"GPG encryption successful: {output_filepath}")